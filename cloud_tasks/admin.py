@@ -1,5 +1,3 @@
-import json
-
 from pygments import highlight
 from pygments.formatters.html import HtmlFormatter
 from pygments.lexers.data import JsonLexer
@@ -7,13 +5,15 @@ from pygments.lexers.data import JsonLexer
 from django.contrib import admin, messages
 from django.contrib.admin import register
 from django.urls import reverse
-from django.utils.html import format_html
+from django.utils.html import format_html, format_html_join
 from django.utils.safestring import mark_safe
 
-from cloud_tasks.models import Clock, TaskExecution, TaskSchedule, Task, Step
+from cloud_tasks import fastjson
+from cloud_tasks.paginators import ApproximateCountPaginator
+from cloud_tasks.models import Clock, Queue, TaskExecution, TaskSchedule, Task, Step, StepSnapshot
 from cloud_tasks.constants import \
     RUNNING, PAUSED, BROKEN, UNKNOWN, \
-    START, PAUSE, FIX, SYNC, \
+    START, PAUSE, FIX, SYNC, DELETE, \
     GCP, MANUAL
 
 
@@ -26,9 +26,16 @@ class StepInline(admin.TabularInline):
     model = Step
 
 
+@register(StepSnapshot)
+class StepSnapshotAdmin(admin.ModelAdmin):
+    list_display = ('hash', 'step', 'created', )
+    list_select_related = ('step', )
+    readonly_fields = ('hash', 'step', 'definition', 'created', )
+
+
 @register(Task)
 class TaskAdmin(admin.ModelAdmin):
-    list_display = ('name', '_actions')
+    list_display = ('name', 'dispatch', 'queue', 'results_policy', '_actions')
     inlines = (
         StepInline,
     )
@@ -43,7 +50,7 @@ class TaskAdmin(admin.ModelAdmin):
 
 @register(TaskSchedule)
 class TaskScheduleAdmin(admin.ModelAdmin):
-    list_display = ('name', 'task', 'clock', 'enabled', 'status', '_actions')
+    list_display = ('name', 'task', 'clock', 'enabled', 'stagger_offset', 'status', '_actions')
 
     def _actions(self, obj):
         url = reverse("cloud_tasks:taskschedule_run", kwargs={'pk': obj.id})
@@ -59,13 +66,16 @@ class TaskScheduleInline(admin.TabularInline):
 
 @register(Clock)
 class ClockAdmin(admin.ModelAdmin):
-    list_display = ('name', 'timezone', 'cron', 'management', 'status_info', '_actions')
+    list_display = ('name', 'timezone', 'cron', 'management', 'status_info', 'sync_pending', '_actions')
     fieldsets = (
         (None, {
-            'fields': ('name', 'timezone', 'cron', 'management', 'status', )
+            'fields': ('name', 'timezone', 'cron', 'interval_seconds', 'management', 'multiplexed', 'status', )
+        }),
+        ('Load', {
+            'fields': ('stagger_seconds', 'tick_shards', 'tick_load_preview', )
         }),
         ('Metadata', {
-            'fields': ('gcp_name', 'gcp_service_account', )
+            'fields': ('gcp_name', 'gcp_service_account', 'sync_pending', )
         })
     )
 
@@ -73,17 +83,50 @@ class ClockAdmin(admin.ModelAdmin):
         TaskScheduleInline,
     )
 
-    actions = ['sync_selected', ]
+    actions = ['start_selected', 'pause_selected', 'sync_selected', 'delete_clocks', ]
 
     def get_readonly_fields(self, request, obj=None):
         if not obj or obj.management != MANUAL:
-            return ['status', 'gcp_name', 'gcp_service_account', ]
-        return tuple()
+            return ['status', 'gcp_name', 'gcp_service_account', 'sync_pending', 'tick_load_preview', ]
+        return ['sync_pending', 'tick_load_preview', ]
+
+    @staticmethod
+    def tick_load_preview(obj):
+        load = obj.tick_load() if obj.pk else {}
+        if not load:
+            return 'No schedules.'
+        peak_second, peak = max(load.items(), key=lambda item: item[1])
+        summary = format_html('{runs} runs per tick, peak of {peak} runs/s at +{second}s',
+                              runs=sum(load.values()), peak=peak, second=peak_second)
+        rows = format_html_join('', '<tr><td>+{}s</td><td>{}</td></tr>', load.items())
+        return format_html('{}<table><tr><th>Delay</th><th>Runs</th></tr>{}</table>', summary, rows)
+
+    tick_load_preview.short_description = 'Tick load'
+
+    @staticmethod
+    def _bulk_action(request, queryset, action):
+        for result in Clock.bulk_action(queryset, action):
+            messages.success(request, result['message']) if result['success'] \
+                else messages.error(request, result['message'])
+
+    def start_selected(self, request, queryset):
+        self._bulk_action(request, queryset, START)
+
+    def pause_selected(self, request, queryset):
+        self._bulk_action(request, queryset, PAUSE)
 
     def sync_selected(self, request, queryset):
-        for clock in queryset:
-            success, message = clock.sync_clock()
-            messages.success(request, message) if success else messages.error(request, message)
+        self._bulk_action(request, queryset, SYNC)
+
+    def delete_clocks(self, request, queryset):
+        self._bulk_action(request, queryset, DELETE)
+
+    start_selected.short_description = 'Start selected clocks'
+    pause_selected.short_description = 'Pause selected clocks'
+    delete_clocks.short_description = 'Delete selected clocks and their Cloud Scheduler jobs'
+    start_selected.allowed_permissions = pause_selected.allowed_permissions = ('change', )
+    sync_selected.allowed_permissions = ('change', )
+    delete_clocks.allowed_permissions = ('delete', )
 
     def get_actions(self, request):
         actions = super().get_actions(request)
@@ -121,19 +164,86 @@ class ClockAdmin(admin.ModelAdmin):
     _actions.short_description = 'Actions'
 
 
+@register(Queue)
+class QueueAdmin(admin.ModelAdmin):
+    list_display = ('name', 'status', 'max_dispatches_per_second', 'max_concurrent_dispatches', 'max_attempts', )
+    readonly_fields = ('status', 'max_burst_size', 'live_backlog', )
+    fieldsets = (
+        (None, {
+            'fields': ('name', 'status', 'live_backlog', )
+        }),
+        ('Rate limits', {
+            'fields': ('max_dispatches_per_second', 'max_burst_size', 'max_concurrent_dispatches', )
+        }),
+        ('Retries', {
+            'fields': ('max_attempts', 'max_retry_duration', 'min_backoff', 'max_backoff', 'max_doublings', )
+        }),
+    )
+
+    actions = ['sync_selected', 'start_selected', 'pause_selected', 'purge_selected', ]
+
+    @staticmethod
+    def live_backlog(obj):
+        if not obj.pk:
+            return '-'
+        try:
+            backlog = obj.backlog()
+        except (Exception, BaseException) as e:
+            return f'Could not retrieve the backlog: {e}'
+        return format_html('{tasks} tasks, oldest scheduled at {oldest}',
+                           tasks=backlog['tasks'], oldest=backlog['oldest_schedule_time'] or '-')
+
+    live_backlog.short_description = 'Backlog'
+
+    @staticmethod
+    def _apply(request, queryset, method_name):
+        for queue in queryset:
+            success, message = getattr(queue, method_name)()
+            messages.success(request, message) if success else messages.error(request, message)
+
+    def sync_selected(self, request, queryset):
+        self._apply(request, queryset, 'sync_queue')
+
+    def start_selected(self, request, queryset):
+        self._apply(request, queryset, 'start_queue')
+
+    def pause_selected(self, request, queryset):
+        self._apply(request, queryset, 'pause_queue')
+
+    def purge_selected(self, request, queryset):
+        self._apply(request, queryset, 'purge_queue')
+
+    start_selected.short_description = 'Resume selected queues'
+    pause_selected.short_description = 'Pause selected queues'
+    purge_selected.short_description = 'Delete all tasks of selected queues'
+    start_selected.allowed_permissions = pause_selected.allowed_permissions = ('change', )
+    sync_selected.allowed_permissions = ('change', )
+    purge_selected.allowed_permissions = ('delete', )
+
+
 @register(TaskExecution)
 class TaskExecutionAdmin(admin.ModelAdmin):
-    list_display = ('task', 'status', 'queued_time', 'start_time', 'finish_time', )
+    list_display = ('task', 'status', 'queue', 'failed_step', 'failed_status', 'queued_time', 'duration', )
+    list_filter = ('status', 'task', )
+    list_select_related = ('task', 'failed_step', )
+    date_hierarchy = 'queued_time'
+    ordering = ('-queued_time', )
+    paginator = ApproximateCountPaginator
+    show_full_result_count = False
     exclude = ('results', )
-    readonly_fields = ('task', 'status', 'execution_result', 'queued_time', 'start_time', 'finish_time')
+    readonly_fields = ('task', 'status', 'queue', 'failed_step', 'failed_status', 'steps_completed', 'duration',
+                       'execution_result', 'queued_time', 'start_time', 'finish_time')
 
     @staticmethod
     def execution_result(obj):
-        _results = json.dumps(obj.results, indent=2)
+        _results = fastjson.dumps(StepSnapshot.expand(obj.results), indent=True)
         # limit the size of the output to 3000 lines
         _results = '\n'.join(_results.split('\n')[:3000])
         html_formatter = HtmlFormatter(style='friendly')
         _results = highlight(_results, JsonLexer(), html_formatter)
-        return mark_safe(f'<style>{html_formatter.get_style_defs()}</style></br>{_results}')
+        note = ''
+        if isinstance(obj.results, dict) and obj.results.get('steps_retained') is False:
+            note = 'The results of the steps were not kept because of the results policy of the task.</br>'
+        return mark_safe(f'<style>{html_formatter.get_style_defs()}</style></br>{note}{_results}')
 
     execution_result.short_description = 'Task Execution Results'
@@ -0,0 +1,76 @@
+"""
+Admission control for task executions requested through the API. Each process admits at most
+`TASKS_MAX_IN_FLIGHT_EXECUTIONS` executions at once and turns away the rest with a 503 and a
+Retry-After header, so that Cloud Tasks backs off instead of piling more work onto a saturated instance.
+"""
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Optional
+
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from cloud_tasks.conf import MAX_IN_FLIGHT_EXECUTIONS, SATURATED_RETRY_AFTER
+
+logger = logging.getLogger(__name__)
+
+
+class ExecutionsSaturated(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Too many task executions in progress; retry later.'
+    default_code = 'executions_saturated'
+
+    def __init__(self, wait: int, detail=None, code=None):
+        super().__init__(detail, code)
+        # picked up by the DRF exception handler as the Retry-After header
+        self.wait = wait
+
+
+class AdmissionController:
+
+    def __init__(self, limit: Optional[int], retry_after: int):
+        self.limit = limit
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.admitted = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def admit(self):
+        """
+        Hold one of the execution slots of this process for the duration of the block.
+
+        :raises ExecutionsSaturated: if all of the slots are taken
+        """
+        with self._lock:
+            saturated = self.limit is not None and self.in_flight >= self.limit
+            if saturated:
+                self.rejected += 1
+            else:
+                self.in_flight += 1
+                self.admitted += 1
+                self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        if saturated:
+            logger.warning(f'Rejected task execution; {self.in_flight} of {self.limit} executions in flight.')
+            raise ExecutionsSaturated(wait=self.retry_after)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'limit': self.limit,
+                'in_flight': self.in_flight,
+                'peak_in_flight': self.peak_in_flight,
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+            }
+
+
+execution_admission = AdmissionController(MAX_IN_FLIGHT_EXECUTIONS, SATURATED_RETRY_AFTER)
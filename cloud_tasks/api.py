@@ -1,18 +1,25 @@
+from django.core.exceptions import ValidationError as DjangoValidationError
 from rest_framework import serializers, viewsets, status
 from rest_framework.reverse import reverse
 from rest_framework.settings import api_settings
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from rest_framework.exceptions import APIException
-
-from cloud_tasks import auth
-from cloud_tasks.models import Clock, Step, Task, TaskExecution, TaskSchedule
+from rest_framework.exceptions import APIException, PermissionDenied, ValidationError
+
+from cloud_tasks import auth, fastjson, gtasks, parsers, renderers, responses
+from cloud_tasks.paginators import ApproximateCountPagination
+from cloud_tasks.admission import execution_admission
+from cloud_tasks.conf import QUEUE
+from cloud_tasks.constants import RUNNING, START, PAUSE, FIX, SYNC, DELETE
+from cloud_tasks.models import Clock, Queue, Step, StepSnapshot, Task, TaskExecution, TaskSchedule
 from cloud_tasks.permissions import DjangoModelPermissionsWithRead, IsTimekeeper, StepExecutor, TaskExecutor
 
 
 class TestGoogleOpenIDAuth(APIView):
     authentication_classes = [*api_settings.DEFAULT_AUTHENTICATION_CLASSES, auth.GoogleOpenIDAuthentication, ]
+    renderer_classes = [renderers.FastJSONRenderer, *api_settings.DEFAULT_RENDERER_CLASSES, ]
+    parser_classes = [parsers.FastJSONParser, *api_settings.DEFAULT_PARSER_CLASSES, ]
 
     @staticmethod
     def get(request, format=None):
@@ -47,6 +54,8 @@ class ClockViewSet(viewsets.ModelViewSet):
     Provides CRUD capabilities to the `Clock` model.
     """
     authentication_classes = [*api_settings.DEFAULT_AUTHENTICATION_CLASSES, auth.GoogleOpenIDAuthentication, ]
+    renderer_classes = [renderers.FastJSONRenderer, *api_settings.DEFAULT_RENDERER_CLASSES, ]
+    parser_classes = [parsers.FastJSONParser, *api_settings.DEFAULT_PARSER_CLASSES, ]
     permission_classes = [DjangoModelPermissionsWithRead]
     queryset = Clock.objects.all()
     serializer_class = ClockSerializer
@@ -54,14 +63,51 @@ class ClockViewSet(viewsets.ModelViewSet):
     @action(detail=True, methods=['post', 'get'], permission_classes=[IsTimekeeper])
     def tick(self, request, pk=None):
         """
-        Execute Tasks associated with the clock on a tick.
+        Execute Tasks associated with the clock on a tick. Shard ticks pass the range of ids of their schedules
+        as `min_id` and `max_id`.
 
         :param request:
         :param pk:
         :return:
         """
         clock = self.get_object()
-        return Response(clock.tick())
+        shard = {bound: int(request.query_params[bound]) for bound in ('min_id', 'max_id')
+                 if request.query_params.get(bound) is not None}
+        return Response(clock.tick(**shard))
+
+    @action(detail=False, methods=['post'], permission_classes=[IsTimekeeper])
+    def bulk(self, request):
+        """
+        Apply `action` (start, pause, fix, sync or delete) to the clocks with the given `ids`, or to all clocks
+        with `all` set to true. Deleting clocks also requires the permission to delete them.
+
+        :param request:
+        :return:
+        """
+        clock_action = request.data.get('action')
+        if clock_action not in (START, PAUSE, FIX, SYNC, DELETE):
+            raise ValidationError({'action': f"Must be one of {(START, PAUSE, FIX, SYNC, DELETE)}."})
+        if clock_action == DELETE and not request.user.has_perm('cloud_tasks.delete_clock'):
+            raise PermissionDenied("Deleting clocks requires the permission to delete them.")
+        ids = request.data.get('ids')
+        every_clock = serializers.BooleanField().to_internal_value(request.data.get('all', False))
+        if ids is None and not every_clock:
+            raise ValidationError({'ids': "Give the ids of the clocks, or set `all` to true for every clock."})
+        clocks = Clock.objects.all() if every_clock else Clock.objects.filter(pk__in=ids)
+        return Response(Clock.bulk_action(clocks, clock_action))
+
+    @action(detail=False, methods=['post', 'get'], url_path=r'multiplex/(?P<group>[\w-]+)/tick',
+            url_name='multiplex-tick', permission_classes=[IsTimekeeper])
+    def multiplex_tick(self, request, group=None):
+        """
+        Tick every running clock multiplexed onto the Cloud Scheduler job `group`.
+
+        :param request:
+        :param group:
+        :return:
+        """
+        clocks = Clock.objects.filter(gcp_name=group, multiplexed=True, status=RUNNING)
+        return Response({clock.name: clock.tick() for clock in clocks})
 
     # allowing GET for use from browser
     @action(detail=True, methods=['post', 'get'], permission_classes=[IsTimekeeper])
@@ -108,6 +154,72 @@ class ClockViewSet(viewsets.ModelViewSet):
         return Response({"message": message})
 
 
+class QueueSerializer(serializers.ModelSerializer):
+
+    url = serializers.HyperlinkedIdentityField(view_name='tasks:queue-detail')
+    status = serializers.ReadOnlyField()
+
+    class Meta:
+        model = Queue
+        fields = '__all__'
+
+
+class QueueError(APIException):
+    pass
+
+
+class QueueViewSet(viewsets.ModelViewSet):
+    """
+    Provides CRUD capabilities to the `Queue` model.
+    """
+    authentication_classes = [*api_settings.DEFAULT_AUTHENTICATION_CLASSES, auth.GoogleOpenIDAuthentication, ]
+    renderer_classes = [renderers.FastJSONRenderer, *api_settings.DEFAULT_RENDERER_CLASSES, ]
+    parser_classes = [parsers.FastJSONParser, *api_settings.DEFAULT_PARSER_CLASSES, ]
+    permission_classes = [DjangoModelPermissionsWithRead]
+    queryset = Queue.objects.all()
+    serializer_class = QueueSerializer
+
+    def _queue_action(self, method_name):
+        success, message = getattr(self.get_object(), method_name)()
+        if not success:
+            raise QueueError(message)
+        return Response({"message": message})
+
+    # allowing GET for use from browser
+    @action(detail=True, methods=['post', 'get'], permission_classes=[IsTimekeeper])
+    def sync(self, request, pk=None):
+        return self._queue_action('sync_queue')
+
+    # allowing GET for use from browser
+    @action(detail=True, methods=['post', 'get'], permission_classes=[IsTimekeeper])
+    def start(self, request, pk=None):
+        return self._queue_action('start_queue')
+
+    # allowing GET for use from browser
+    @action(detail=True, methods=['post', 'get'], permission_classes=[IsTimekeeper])
+    def pause(self, request, pk=None):
+        return self._queue_action('pause_queue')
+
+    @action(detail=True, methods=['post'], permission_classes=[IsTimekeeper])
+    def purge(self, request, pk=None):
+        return self._queue_action('purge_queue')
+
+    @action(detail=True, methods=['get'])
+    def backlog(self, request, pk=None):
+        return Response(self.get_object().backlog())
+
+    @action(detail=False, methods=['get'], url_path='backlog')
+    def queue_backlog(self, request):
+        """
+        Backlog of the Cloud Tasks queue given as `queue`, which defaults to TASKS_QUEUE. The queue does not need
+        to be managed as a `Queue`.
+
+        :param request:
+        :return:
+        """
+        return Response(gtasks.get_backlog(request.query_params.get('queue') or QUEUE))
+
+
 class StepSerializer(serializers.ModelSerializer):
 
     url = serializers.HyperlinkedIdentityField(view_name='tasks:step-detail')
@@ -116,12 +228,23 @@ class StepSerializer(serializers.ModelSerializer):
         model = Step
         fields = '__all__'
 
+    @staticmethod
+    def validate_success_condition(value):
+        if value is not None:
+            try:
+                responses.validate_conditions(value)
+            except ValueError as e:
+                raise ValidationError(str(e))
+        return value
+
 
 class StepViewSet(viewsets.ModelViewSet):
     """
     Provides CRUD capabilities to the `Step` model.
     """
     authentication_classes = [*api_settings.DEFAULT_AUTHENTICATION_CLASSES, auth.GoogleOpenIDAuthentication, ]
+    renderer_classes = [renderers.FastJSONRenderer, *api_settings.DEFAULT_RENDERER_CLASSES, ]
+    parser_classes = [parsers.FastJSONParser, *api_settings.DEFAULT_PARSER_CLASSES, ]
     permission_classes = [DjangoModelPermissionsWithRead]
     queryset = Step.objects.all()
     serializer_class = StepSerializer
@@ -150,6 +273,8 @@ class TaskViewSet(viewsets.ModelViewSet):
     Provides CRUD capabilities to the `Task` model.
     """
     authentication_classes = [*api_settings.DEFAULT_AUTHENTICATION_CLASSES, auth.GoogleOpenIDAuthentication, ]
+    renderer_classes = [renderers.FastJSONRenderer, *api_settings.DEFAULT_RENDERER_CLASSES, ]
+    parser_classes = [parsers.FastJSONParser, *api_settings.DEFAULT_PARSER_CLASSES, ]
     permission_classes = [DjangoModelPermissionsWithRead]
     queryset = Task.objects.all()
     serializer_class = TaskSerializer
@@ -158,10 +283,25 @@ class TaskViewSet(viewsets.ModelViewSet):
     @action(detail=True, methods=['post', 'get'], permission_classes=[TaskExecutor])
     def execute(self, request, pk=None):
         task = self.get_object()
-        task_execution_id = request.query_params.get('task_execution_id', None)
-        task_execution = task.execute(task_execution_id)
+        params = {}
+        for param in ('task_execution_id', 'step'):
+            value = request.query_params.get(param)
+            try:
+                params[param] = int(value) if value is not None else None
+            except ValueError:
+                raise ValidationError({param: f"Must be an integer, got {value!r}."})
+        # responds 503 with Retry-After when this process is saturated
+        with execution_admission.admit():
+            task_execution = task.execute(params['task_execution_id'], step=params['step'])
         return Response(task_execution.results)
 
+    @action(detail=False, methods=['get'])
+    def admission(self, request):
+        """
+        Admission control counters of the process serving the request.
+        """
+        return Response(execution_admission.stats())
+
 
 class TaskExecutionSerializer(serializers.ModelSerializer):
 
@@ -172,15 +312,63 @@ class TaskExecutionSerializer(serializers.ModelSerializer):
         model = TaskExecution
         fields = '__all__'
 
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        if self.context.get('expand_steps'):
+            data['results'] = StepSnapshot.expand(data['results'])
+        return data
+
 
 class TaskExecutionViewSet(viewsets.ModelViewSet):
     """
     Provides CRUD capabilities to the `TaskExecution` model.
     """
     authentication_classes = [*api_settings.DEFAULT_AUTHENTICATION_CLASSES, auth.GoogleOpenIDAuthentication, ]
+    renderer_classes = [renderers.FastJSONRenderer, *api_settings.DEFAULT_RENDERER_CLASSES, ]
+    parser_classes = [parsers.FastJSONParser, *api_settings.DEFAULT_PARSER_CLASSES, ]
     permission_classes = [DjangoModelPermissionsWithRead]
     queryset = TaskExecution.objects.all().order_by('id')
     serializer_class = TaskExecutionSerializer
+    pagination_class = ApproximateCountPagination
+
+    # query parameters that filter the list of executions, and the lookups they filter on
+    filters = {
+        'task': 'task_id',
+        'status': 'status',
+        'failed_step': 'failed_step_id',
+        'failed_status': 'failed_status',
+        'failed_status_min': 'failed_status__gte',
+        'failed_status_max': 'failed_status__lte',
+        'queued_after': 'queued_time__gte',
+        'queued_before': 'queued_time__lt',
+    }
+
+    def get_queryset(self):
+        """
+        Filter executions with the query parameters of `filters`, e.g. ?failed_step=3&failed_status_min=500, and
+        `results_contains` for JSON that the results must contain.
+        """
+        queryset = super().get_queryset()
+        if self.action != 'list':
+            return queryset
+        params = self.request.query_params
+        lookups = {lookup: params[param] for param, lookup in self.filters.items() if params.get(param)}
+        if params.get('results_contains'):
+            try:
+                lookups['results__contains'] = fastjson.loads(params['results_contains'])
+            except fastjson.JSONDecodeError:
+                raise ValidationError({'results_contains': "Must be JSON."})
+        try:
+            return queryset.filter(**lookups)
+        except (ValueError, DjangoValidationError) as e:
+            raise ValidationError(str(e))
+
+    def get_serializer_context(self):
+        # the definitions of the steps are included in single executions, and in lists with ?expand=steps
+        return {
+            **super().get_serializer_context(),
+            'expand_steps': self.action == 'retrieve' or self.request.query_params.get('expand') == 'steps',
+        }
 
 
 class TaskScheduleSerializer(serializers.ModelSerializer):
@@ -197,6 +385,8 @@ class TaskScheduleViewSet(viewsets.ModelViewSet):
     Provides CRUD capabilities to the `TaskSchedule` model.
     """
     authentication_classes = [*api_settings.DEFAULT_AUTHENTICATION_CLASSES, auth.GoogleOpenIDAuthentication, ]
+    renderer_classes = [renderers.FastJSONRenderer, *api_settings.DEFAULT_RENDERER_CLASSES, ]
+    parser_classes = [parsers.FastJSONParser, *api_settings.DEFAULT_PARSER_CLASSES, ]
     permission_classes = [DjangoModelPermissionsWithRead]
     queryset = TaskSchedule.objects.all()
     serializer_class = TaskScheduleSerializer
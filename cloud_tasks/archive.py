@@ -0,0 +1,127 @@
+"""
+Streaming export of execution history to time-partitioned files, for archival and analytics:
+
+    cloud-tasks tasks executions export /archive --before 2020-06-01 --delete
+
+Executions are read in keyset ranges of ids with a server-side cursor, so memory use does not grow with the
+number of executions. Each range is written to gzipped NDJSON or, with pyarrow installed
+(`pip install django-cloud-tasks[parquet]`), Parquet files partitioned by the time the executions were queued,
+e.g. /archive/queued=2020-05-31/task_executions-1-10000.ndjson.gz. Step summaries include the definitions of
+the steps from their snapshots, so the files do not depend on the database. With `delete`, only finished
+executions are exported, and the executions written to the files of a range are deleted once the files are
+complete.
+"""
+import datetime
+import gzip
+import os
+from typing import List, Optional, Union
+
+from django.db.models import Q
+
+from cloud_tasks import fastjson
+from cloud_tasks.constants import NDJSON, PARQUET, SUCCESS, FAILURE
+from cloud_tasks.models import StepSnapshot, TaskExecution
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+PARTITION_FORMATS = {
+    'month': '%Y-%m',
+    'day': '%Y-%m-%d',
+    'hour': '%Y-%m-%dT%H',
+}
+
+EXPORTED_FIELDS = (
+    'id', 'task_id', 'task__name', 'status', 'queue', 'queued_time', 'start_time', 'finish_time', 'duration',
+    'failed_step_id', 'failed_status', 'steps_completed', 'results',
+)
+
+
+def _row(execution: dict) -> dict:
+    duration = execution['duration']
+    return {**execution, 'duration': duration.total_seconds() if duration is not None else None}
+
+
+def _write_ndjson(path: str, rows: List[dict]):
+    with gzip.open(path, 'wb') as file:
+        for row in rows:
+            file.write(fastjson.dumpb(row))
+            file.write(b'\n')
+
+
+def _write_parquet(path: str, rows: List[dict]):
+    columns = {field: [row[field] for row in rows] for field in rows[0]}
+    # results are free-form, so they are kept as JSON text
+    columns['results'] = [fastjson.dumps(results) if results is not None else None for results in columns['results']]
+    pyarrow.parquet.write_table(pyarrow.Table.from_pydict(columns), path, compression='zstd')
+
+
+def export_executions(directory: str, before: Optional[Union[datetime.datetime, str]] = None,
+                      since: Optional[Union[datetime.datetime, str]] = None, task: Optional[str] = None,
+                      file_format: str = NDJSON, partition: str = 'day', batch_size: int = 10000,
+                      chunk_size: int = 2000, delete: bool = False) -> List[dict]:
+    """
+    Export task executions to files under `directory`.
+
+    :param directory: directory the partitions are written to
+    :param before: only executions queued before this datetime or ISO 8601 string
+    :param since: only executions queued at or after this datetime or ISO 8601 string
+    :param task: only executions of the task with this name
+    :param file_format: NDJSON or PARQUET
+    :param partition: 'month', 'day' or 'hour'; how executions are split into directories by the time they were queued
+    :param batch_size: number of executions per keyset range, and at most per file
+    :param chunk_size: number of executions fetched at a time from the server-side cursor
+    :param delete: whether to delete the executions that have been exported. Only finished executions are exported
+        then, since Cloud Tasks may still call back for the others.
+    :return: the files written, with the number of executions in each
+    """
+    if file_format not in (NDJSON, PARQUET):
+        raise ValueError(f"Format must be one of {(NDJSON, PARQUET)}, got {file_format}")
+    if file_format == PARQUET and pyarrow is None:
+        raise ImportError("Exporting to Parquet requires pyarrow; pip install django-cloud-tasks[parquet]")
+    partition_format = PARTITION_FORMATS[partition]
+    q = Q()
+    if before:
+        q &= Q(queued_time__lt=before)
+    if since:
+        q &= Q(queued_time__gte=since)
+    if task:
+        q &= Q(task__name__iexact=task)
+    if delete:
+        q &= Q(status__in=(SUCCESS, FAILURE))
+    executions = TaskExecution.objects.filter(q)
+    extension = 'ndjson.gz' if file_format == NDJSON else 'parquet'
+    write = _write_ndjson if file_format == NDJSON else _write_parquet
+
+    files, last_id = [], 0
+    while True:
+        # keyset range of the next `batch_size` ids, which stays fast however deep the export is
+        ids = list(executions.filter(pk__gt=last_id).order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            break
+        first_id, last_id = ids[0], ids[-1]
+        batch = executions.filter(pk__gte=first_id, pk__lte=last_id)
+        rows = [_row(execution) for execution in
+                batch.order_by('pk').values(*EXPORTED_FIELDS).iterator(chunk_size=chunk_size)]
+        # the definitions of the steps are copied from their snapshots, so that the archive stands on its own
+        for row, results in zip(rows, StepSnapshot.expand_many([row['results'] for row in rows])):
+            row['results'] = results
+        partitions, exported_ids = {}, []
+        for row in rows:
+            key = row['queued_time'].strftime(partition_format)
+            partitions.setdefault(key, []).append(row)
+            exported_ids.append(row['id'])
+        for key, rows in sorted(partitions.items()):
+            partition_directory = os.path.join(directory, f'queued={key}')
+            os.makedirs(partition_directory, exist_ok=True)
+            path = os.path.join(partition_directory, f'task_executions-{first_id}-{last_id}.{extension}')
+            write(path, rows)
+            files.append({'path': path, 'executions': len(rows)})
+        if delete:
+            # the files of the range are complete, so the executions written to them can go. Executions that were
+            # committed into the range after it was read, or started again since, are left for the next export.
+            executions.filter(pk__in=exported_ids).delete()
+    return files
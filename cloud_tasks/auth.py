@@ -13,6 +13,8 @@ from rest_framework import exceptions
 from rest_framework.authentication import BaseAuthentication
 from google.oauth2 import id_token
 
+from cloud_tasks.openid import get_audience
+
 User = get_user_model()
 logger = logging.getLogger(__name__)
 
@@ -33,7 +35,7 @@ class GoogleOpenIDAuthentication(BaseAuthentication):
     """
     This authentication class requires a bearer token with the standard claims
     (https://developers.google.com/identity/protocols/oauth2/openid-connect#obtainuserinfo)
-    and an audience of the current URL.
+    and an audience of the current URL (or of the part of it selected by `TASKS_AUDIENCE_POLICY`).
 
     It checks that the token was signed with a valid certificate, that the token
     has not expired, that the audience matches the current URL, and that a Django User account for
@@ -73,10 +75,13 @@ class GoogleOpenIDAuthentication(BaseAuthentication):
             raise exceptions.AuthenticationFailed(msg)
         token = SimpleNamespace(**token)
         logging.debug(f'Access attempted with token: {token}')
-        # the audience indicated in the token should be the visited URL
+        # the audience indicated in the token should be the audience of the visited URL according
+        # to TASKS_AUDIENCE_POLICY, or the visited URL itself
+        visited_uri = request.build_absolute_uri()
         __, token_audience, __ = uri_breakdown(token.aud)
-        __, required_audience, __ = uri_breakdown(request.build_absolute_uri())
-        if token_audience != required_audience:
+        __, required_audience, __ = uri_breakdown(get_audience(visited_uri))
+        __, visited_audience, __ = uri_breakdown(visited_uri)
+        if token_audience not in (required_audience, visited_audience):
             msg = _(f'Authentication failed. Audience {token.aud} did not match auth endpoint {required_audience}.')
             logging.info(msg)
             raise exceptions.AuthenticationFailed(msg)
@@ -0,0 +1,101 @@
+"""
+Process-local cache for responses of idempotent (GET) step requests. Entries live in a bounded LRU
+and are fresh for the TTL of the step. Stale entries with an ETag or Last-Modified header are
+revalidated with a conditional request, and concurrent requests for the same key share a single
+in-flight request.
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Hashable, Optional, Tuple
+
+from cloud_tasks.conf import RESPONSE_CACHE_SIZE
+from cloud_tasks.constants import CACHE_HIT, CACHE_MISS, CACHE_REVALIDATED, CACHE_SHARED
+
+
+class _Entry:
+    def __init__(self, response, ttl: int):
+        self.response = response
+        self.expires = time.monotonic() + ttl
+
+    @property
+    def validators(self) -> dict:
+        headers = {}
+        if 'ETag' in self.response.headers:
+            headers['If-None-Match'] = self.response.headers['ETag']
+        if 'Last-Modified' in self.response.headers:
+            headers['If-Modified-Since'] = self.response.headers['Last-Modified']
+        return headers
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+
+class ResponseCache:
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def fetch(self, key: Hashable, ttl: int, request: Callable[[dict], object]) -> Tuple[object, str]:
+        """
+        Get the response for `key` from the cache, or by calling `request`.
+
+        :param key: identifies the request, e.g. its url and payload
+        :param ttl: number of seconds a response stays fresh
+        :param request: makes the request with the given extra (conditional) headers and returns the response
+        :return: response, and how it was obtained (one of 'hit', 'miss', 'revalidated' or 'shared')
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires > time.monotonic():
+                self._entries.move_to_end(key)
+                return entry.response, CACHE_HIT
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.response, CACHE_SHARED
+
+        try:
+            response, status = request(entry.validators if entry is not None else {}), CACHE_MISS
+            if response.status_code == 304 and entry is not None:
+                response, status = entry.response, CACHE_REVALIDATED
+            if response.status_code == 200:
+                self._store(key, _Entry(response, ttl))
+            flight.response = response
+            return response, status
+        except (Exception, BaseException) as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def _store(self, key: Hashable, entry: _Entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self, key: Optional[Hashable] = None):
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE)
@@ -16,6 +16,7 @@ if __name__ == '__main__':
             f"current working directory as indicated by DJANGO_SETTINGS_MODULE is accurate.")
 
 
+import itertools
 import subprocess
 
 from django.db.models import Q
@@ -23,6 +24,8 @@ from django.contrib.auth import get_user_model
 
 import cloud_tasks.models as models
 from cloud_tasks import gtasks, conf
+from cloud_tasks.archive import export_executions
+from cloud_tasks.constants import NDJSON
 from cloud_tasks.utils import hardcode_reverse
 from cloud_tasks.openid import create_token, decode_token
 
@@ -60,18 +63,52 @@ class CloudTasks:
 
         class executions:
             @staticmethod
-            def list(offset=0, limit=100, task=None):
+            def list(offset=0, limit=100, task=None, status=None, failed_step=None, failed_status=None, since=None):
+                """
+                :param failed_status: HTTP status of the failed step, or a range of them like 500-599
+                :param since: only executions queued since this ISO 8601 datetime
+                """
                 q = Q() if not task else Q(task__name__iexact=task)
+                if status:
+                    q &= Q(status=status)
+                if failed_step:
+                    q &= Q(failed_step__name__iexact=failed_step) if isinstance(failed_step, str) \
+                        else Q(failed_step_id=failed_step)
+                if failed_status:
+                    low, _, high = str(failed_status).partition('-')
+                    q &= Q(failed_status__gte=low, failed_status__lte=high or low)
+                if since:
+                    q &= Q(queued_time__gte=since)
                 return list(
-                    models.TaskExecution.objects.filter(q).values(
+                    models.TaskExecution.objects.filter(q).order_by('-queued_time').values(
                         "id",
                         "results",
                         "status",
                         "task__name",
                         "task_id",
+                        "failed_step__name",
+                        "failed_status",
+                        "steps_completed",
+                        "duration",
                     )[offset:limit]
                 )
 
+            @staticmethod
+            def export(directory, before=None, since=None, task=None, file_format=NDJSON, partition='day',
+                       batch_size=10000, delete=False):
+                """
+                Export executions to gzipped NDJSON or Parquet files partitioned by the time they were queued.
+
+                :param before: only executions queued before this ISO 8601 datetime
+                :param since: only executions queued since this ISO 8601 datetime
+                :param file_format: ndjson or parquet, which requires pyarrow
+                :param partition: month, day or hour
+                :param delete: delete the executions once they have been exported; only finished executions are
+                    exported then
+                """
+                return export_executions(directory, before=before, since=since, task=task, file_format=file_format,
+                                         partition=partition, batch_size=batch_size, delete=delete)
+
         class schedules:
             @staticmethod
             def list(offset=0, limit=100, clock=None, task=None):
@@ -132,6 +169,24 @@ class CloudTasks:
             _, message = models.Clock.objects.get(name=name).sync_clock()
             return message
 
+        @staticmethod
+        def bulk(action: str, *names, all_clocks=False, workers=conf.BULK_CLOCK_WORKERS):
+            """
+            Start, pause, fix, sync or delete the clocks with the given names, or all clocks with --all_clocks.
+            """
+            if not names and not all_clocks:
+                raise ValueError("Give the names of the clocks, or pass --all_clocks for every clock.")
+            clocks = models.Clock.objects.all() if all_clocks else models.Clock.objects.filter(name__in=names)
+            return models.Clock.bulk_action(clocks, action, workers=workers)
+
+        @staticmethod
+        def sync_pending(workers=conf.BULK_CLOCK_WORKERS):
+            """
+            Sync the clocks whose changes are not in Cloud Scheduler yet. Run it periodically, or after a deploy, to
+            catch syncs that failed or were lost when a process stopped.
+            """
+            return models.Clock.sync_pending_clocks(workers=workers)
+
         class schedules:
             @staticmethod
             def list(offset=0, limit=100, clock=None, task=None):
@@ -153,6 +208,48 @@ class CloudTasks:
                     )[offset:limit]
                 )
 
+    class queues:
+        @staticmethod
+        def list(offset=0, limit=100):
+            return list(models.Queue.objects.values(
+                'name',
+                'status',
+                'max_dispatches_per_second',
+                'max_concurrent_dispatches',
+                'max_attempts',
+            )[offset:limit])
+
+        @staticmethod
+        def load():
+            """
+            Create or update the queues of TASKS_QUEUE_DEFINITIONS, and sync them with Cloud Tasks.
+            """
+            return [str(queue) for queue in models.Queue.load_definitions()]
+
+        @staticmethod
+        def sync(name: str):
+            _, message = models.Queue.objects.get(name=name).sync_queue()
+            return message
+
+        @staticmethod
+        def start(name: str):
+            _, message = models.Queue.objects.get(name=name).start_queue()
+            return message
+
+        @staticmethod
+        def pause(name: str):
+            _, message = models.Queue.objects.get(name=name).pause_queue()
+            return message
+
+        @staticmethod
+        def purge(name: str):
+            _, message = models.Queue.objects.get(name=name).purge_queue()
+            return message
+
+        @staticmethod
+        def backlog(name: str):
+            return models.Queue.objects.get(name=name).backlog()
+
     class auth:
         class open_id:
             class tokens:
@@ -205,9 +302,13 @@ class CloudTasks:
                     sys.stderr.flush()
 
         class tasks:
-            list = staticmethod(gtasks.list_tasks)
+            @staticmethod
+            def list(queue=conf.QUEUE, offset=0, limit=100):
+                return list(itertools.islice(gtasks.list_tasks(queue, page_size=min(limit, 1000)), offset, limit))
+
             create = staticmethod(gtasks.create_task)
             delete = staticmethod(gtasks.delete_task)
+            backlog = staticmethod(gtasks.get_backlog)
 
 
 def main():
@@ -1,13 +1,53 @@
 from django.conf import settings
 
+from cloud_tasks.constants import EXACT
+
 REGION = settings.TASKS_REGION
 PROJECT_ID = settings.TASKS_PROJECT_ID
 QUEUE = getattr(settings, 'TASKS_QUEUE', None)
+# lanes that tasks and schedules can be routed to, e.g. {'urgent': 'tasks-urgent', 'bulk': ['tasks-bulk-0', ...]}.
+# a lane with several queues is hash-sharded across them.
+QUEUES = getattr(settings, 'TASKS_QUEUES', {})
+# settings of Cloud Tasks queues by name, e.g. {'tasks-bulk': {'max_dispatches_per_second': 5, 'max_attempts': 3}},
+# loaded into `cloud_tasks.models.Queue`
+QUEUE_DEFINITIONS = getattr(settings, 'TASKS_QUEUE_DEFINITIONS', {})
 # default to True if QUEUE is provided
 USE_CLOUD_TASKS = getattr(settings, 'TASKS_USE_CLOUD_TASKS', bool(QUEUE))
 ROOT_URL = getattr(settings, 'TASKS_ROOT_URL', None)
 SERVICE_ACCOUNT = getattr(settings, 'TASKS_SERVICE_ACCOUNT', None)
 TIME_ZONE = getattr(settings, 'TASKS_TIME_ZONE', getattr(settings, 'TIME_ZONE', 'UTC'))
+# dispatch requests for routes of this project in-process instead of over HTTP
+LOOPBACK = getattr(settings, 'TASKS_LOOPBACK', False)
+# which part of a URL is used as the audience of OpenID tokens; one of 'exact', 'prefix' or 'origin'
+AUDIENCE_POLICY = getattr(settings, 'TASKS_AUDIENCE_POLICY', EXACT)
+# path prefixes (e.g. '/cloud-tasks/api/') that share an audience under the 'prefix' policy
+AUDIENCE_PREFIXES = getattr(settings, 'TASKS_AUDIENCE_PREFIXES', ())
+# maximum number of responses kept for steps with a cache_ttl
+RESPONSE_CACHE_SIZE = getattr(settings, 'TASKS_RESPONSE_CACHE_SIZE', 256)
+# per-origin request budgets for steps; see cloud_tasks.throttle
+RATE_LIMITS = getattr(settings, 'TASKS_RATE_LIMITS', {})
+RATE_LIMIT_CACHE = getattr(settings, 'TASKS_RATE_LIMIT_CACHE', 'default')
+# seconds a step waits for its budget before it is deferred
+RATE_LIMIT_MAX_WAIT = getattr(settings, 'TASKS_RATE_LIMIT_MAX_WAIT', 5)
+# background threads that sync saved clocks and queues with Google Cloud; 0 syncs them in the request once it commits
+CLOCK_SYNC_WORKERS = getattr(settings, 'TASKS_CLOCK_SYNC_WORKERS', 4)
+# requests per second a process makes to the Cloud Scheduler admin API (None for no limit), and the number of
+# clocks that bulk clock operations work on at once
+SCHEDULER_RATE_LIMIT = getattr(settings, 'TASKS_SCHEDULER_RATE_LIMIT', 10)
+BULK_CLOCK_WORKERS = getattr(settings, 'TASKS_BULK_CLOCK_WORKERS', 8)
+# database alias of a read replica for the reads of cloud_tasks models (see cloud_tasks.routers), the replica lag in
+# seconds above which reads go back to the primary, and the seconds between checks of the lag
+READ_REPLICA = getattr(settings, 'TASKS_READ_REPLICA', None)
+REPLICA_MAX_LAG = getattr(settings, 'TASKS_REPLICA_MAX_LAG', 10)
+REPLICA_LAG_CHECK_INTERVAL = getattr(settings, 'TASKS_REPLICA_LAG_CHECK_INTERVAL', 5)
+# lists with more rows than this, according to the estimates of Postgres, show approximate counts
+APPROXIMATE_COUNT_THRESHOLD = getattr(settings, 'TASKS_APPROXIMATE_COUNT_THRESHOLD', 100000)
+# task executions per page of the API
+PAGE_SIZE = getattr(settings, 'TASKS_PAGE_SIZE', 100)
+# task executions a process accepts at once through the API (None for no limit) and the
+# Retry-After (in seconds) of the executions it turns away
+MAX_IN_FLIGHT_EXECUTIONS = getattr(settings, 'TASKS_MAX_IN_FLIGHT_EXECUTIONS', None)
+SATURATED_RETRY_AFTER = getattr(settings, 'TASKS_SATURATED_RETRY_AFTER', 10)
 
 if ROOT_URL is None:
     if settings.TASKS_SERVICE == 'default':
@@ -1,12 +1,26 @@
 # model invariants
 MAX_NAME_LENGTH = 100
+# number of failed items kept in the results of a map step
+MAX_MAP_FAILURES_REPORTED = 20
 # status constants
 RUNNING, PAUSED, UNKNOWN, BROKEN, PENDING, STARTED, SUCCESS, FAILURE = \
     'running', 'paused', 'unknown', 'broken', 'pending', 'started', 'success', 'failure'
 # action constants
-START, PAUSE, FIX, SYNC = 'start', 'pause', 'fix', 'sync'
+START, PAUSE, FIX, SYNC, DELETE = 'start', 'pause', 'fix', 'sync', 'delete'
 # management constants
 GCP, MANUAL = 'gcp', 'manual'
+# task dispatch constants
+INLINE, STEPWISE = 'inline', 'stepwise'
+# OpenID audience policy constants
+EXACT, PATH_PREFIX, ORIGIN = 'exact', 'prefix', 'origin'
+# response cache constants
+CACHE_HIT, CACHE_MISS, CACHE_REVALIDATED, CACHE_SHARED = 'hit', 'miss', 'revalidated', 'shared'
+# results policies of tasks
+RESULTS_ALL, RESULTS_FAILURES, RESULTS_SAMPLED, RESULTS_SUMMARY = 'all', 'failures', 'sampled', 'summary'
+# archive formats of task executions
+NDJSON, PARQUET = 'ndjson', 'parquet'
+# prefix of the names of Cloud Scheduler jobs shared by multiplexed clocks
+MULTIPLEX_PREFIX = 'multiplex-'
 
 # from pytz.all_timezones
 TIME_ZONES = (
@@ -0,0 +1,62 @@
+"""
+JSON encoding and decoding backed by orjson when it is installed (`pip install django-cloud-tasks[fast]`),
+falling back to the standard library otherwise. Types produced by Django, like datetimes, decimals,
+UUIDs and lazy translation strings, are encoded in both cases.
+"""
+import json
+from typing import Any, Callable, Optional, Union
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSONDecodeError = json.JSONDecodeError
+
+_django_default = DjangoJSONEncoder().default
+
+
+def dumpb(obj: Any, indent: bool = False, default: Optional[Callable] = None, sort_keys: bool = False) -> bytes:
+    """
+    Encode `obj` as UTF-8 JSON, without whitespace unless it is indented.
+
+    :param obj: object to encode
+    :param indent: whether to pretty print with an indent of two spaces
+    :param default: called for objects that cannot otherwise be serialized; defaults to Django's encoder
+    :param sort_keys: whether to sort the keys of dictionaries, e.g. to hash the result
+    :return:
+    """
+    default = default or _django_default
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0) | \
+            (orjson.OPT_SORT_KEYS if sort_keys else 0)
+        try:
+            return orjson.dumps(obj, default=default, option=option)
+        except orjson.JSONEncodeError:
+            # e.g. integers wider than 64 bits, which the standard library can handle
+            pass
+    return json.dumps(obj, default=default, indent=2 if indent else None, separators=None if indent else (',', ':'),
+                      sort_keys=sort_keys, ensure_ascii=False).encode('utf-8')
+
+
+def dumps(obj: Any, indent: bool = False, default: Optional[Callable] = None, sort_keys: bool = False) -> str:
+    """
+    Encode `obj` as a JSON string. See `dumpb`.
+    """
+    return dumpb(obj, indent=indent, default=default, sort_keys=sort_keys).decode('utf-8')
+
+
+def loads(data: Union[str, bytes, bytearray, memoryview]) -> Any:
+    """
+    Decode JSON from a string or UTF-8 bytes.
+
+    :raises JSONDecodeError: if `data` is not valid JSON
+    :raises TypeError: if `data` is not a string or bytes
+    """
+    if orjson is not None:
+        if data is None:
+            raise TypeError('the JSON object must be str, bytes or bytearray, not NoneType')
+        return orjson.loads(data)
+    return json.loads(data)
@@ -8,10 +8,19 @@ from typing import Union, Any, Optional, List
 from pydantic import BaseModel
 
 from google.cloud.scheduler_v1 import CloudSchedulerClient
-from cloud_tasks.conf import REGION, PROJECT_ID
+from cloud_tasks.conf import REGION, PROJECT_ID, SCHEDULER_RATE_LIMIT
+from cloud_tasks.openid import get_audience
+from cloud_tasks.throttle import TokenBucket
 
 client = CloudSchedulerClient()
 parent = client.location_path(PROJECT_ID, REGION)
+# keeps the requests of this process within the Cloud Scheduler admin API quota
+admin_quota = TokenBucket(SCHEDULER_RATE_LIMIT, SCHEDULER_RATE_LIMIT) if SCHEDULER_RATE_LIMIT else None
+
+
+def wait_for_quota():
+    if admin_quota is not None:
+        admin_quota.acquire()
 
 
 class JobRetrieveError(BaseException):
@@ -53,7 +62,8 @@ class Job(BaseModel):
         return {
             'uri': self.target_url,
             'oidc_token': {
-                'service_account_email': self.service_account
+                'service_account_email': self.service_account,
+                'audience': get_audience(self.target_url),
             }
         }
 
@@ -94,19 +104,24 @@ def get_update_mask(old, new, explicit: Optional[List] = None):
     for attr in paths:
         if getattr(old, attr, False) != getattr(new, attr, False):
             _dict['paths'].append(attr)
-    # update http_target if http_target.uri or http_target.oidc_token.service_account_email needs to be changed
-    if (old.http_target.uri != new.http_target['uri'] and update_uri) or 'service_account' in explicit:
+    # update http_target if http_target.uri, http_target.oidc_token.audience or
+    # http_target.oidc_token.service_account_email needs to be changed
+    uri_changed = old.http_target.uri != new.http_target['uri'] or \
+        old.http_target.oidc_token.audience != new.http_target['oidc_token']['audience']
+    if (uri_changed and update_uri) or 'service_account' in explicit:
         _dict['paths'].append('http_target')
     return _dict
 
 
 def list_jobs():
+    wait_for_quota()
     return tuple(client.list_jobs(parent))
 
 
 def get_job(name: str):
     full_name = get_full_name(name)
     try:
+        wait_for_quota()
         return client.get_job(full_name)
     except (BaseException, Exception) as e:
         error_message = get_error(e)
@@ -122,6 +137,7 @@ def create_job(job: Job):
     """
 
     try:
+        wait_for_quota()
         return client.create_job(parent, job.to_dict())
     except (BaseException, Exception) as e:
         error_message = get_error(e)
@@ -131,6 +147,7 @@ def create_job(job: Job):
 def pause_job(name: str):
     full_name = get_full_name(name)
     try:
+        wait_for_quota()
         return client.pause_job(full_name)
     except (BaseException, Exception) as e:
         error_message = get_error(e)
@@ -140,6 +157,7 @@ def pause_job(name: str):
 def resume_job(name: str):
     full_name = get_full_name(name)
     try:
+        wait_for_quota()
         return client.resume_job(full_name)
     except (BaseException, Exception) as e:
         error_message = get_error(e)
@@ -160,12 +178,34 @@ def update_job(name_or_job: Union[str, Any], new_job: Job, explicit_mask: Option
     # update mask is used to specify which fields are being updated.
     update_mask = get_update_mask(job, new_job, explicit_mask)
     try:
+        wait_for_quota()
         return client.update_job(new_job.to_dict(), update_mask)
     except (BaseException, Exception) as e:
         error_message = get_error(e)
         raise JobUpdateError(error_message)
 
 
+def ensure_job(name: str, job: Job, running: bool = True):
+    """
+    Creates the job named `name` in Cloud Scheduler, or updates it with the data provided by `job` if it
+    already exists, and then resumes or pauses it.
+
+    :param name: Name of job to be created or updated
+    :param job: Job instance containing the data of the job
+    :param running: Whether the job should be running or paused
+    :return:
+    """
+    try:
+        existing_job = get_job(name)
+    except JobRetrieveError as e:
+        if "Job not found" not in get_error(e):
+            raise
+        create_job(job)
+    else:
+        update_job(existing_job, job, [*MUTABLE_JOB_ATTRIBUTES, 'http_target'])
+    return resume_job(name) if running else pause_job(name)
+
+
 def delete_job(name: str):
     """
     Deletes the Cloud Scheduler job with the given name.
@@ -175,6 +215,7 @@ def delete_job(name: str):
     """
     full_name = get_full_name(name)
     try:
+        wait_for_quota()
         client.delete_job(full_name)
     except (BaseException, Exception) as e:
         error_message = get_error(e)
@@ -3,17 +3,21 @@ Some wrapper methods around Google Cloud Tasks
 ref: https://googleapis.dev/python/cloudtasks/latest/gapic/v2/api.html
 """
 import functools
+import hashlib
 import re
-import json
 import datetime
-from typing import Optional, Union, List
+from collections import Counter
+from typing import Iterator, Optional, Union
 
+from google.api_core.exceptions import NotFound
 from google.cloud import tasks_v2
+from google.cloud.tasks_v2 import enums
 from google.cloud.tasks_v2.proto.task_pb2 import Task
 from google.protobuf import timestamp_pb2
 
-from cloud_tasks import utils
-from cloud_tasks.conf import PROJECT_ID, REGION, SERVICE_ACCOUNT, QUEUE
+from cloud_tasks import fastjson, utils
+from cloud_tasks.conf import PROJECT_ID, REGION, SERVICE_ACCOUNT, QUEUE, QUEUES
+from cloud_tasks.openid import get_audience
 
 
 def validate_args(func):
@@ -30,14 +34,44 @@ def validate_args(func):
     return inner
 
 
+def get_queue(lane: Optional[str] = None, key=None) -> Optional[str]:
+    """
+    Route to a Cloud Tasks queue. `lane` is either a lane of TASKS_QUEUES or the name of a queue, and defaults to
+    TASKS_QUEUE. Lanes with several queues are sharded by a hash of `key`.
+
+    :param lane: Lane or queue to route to
+    :param key: Value that picks the shard of the lane, e.g. the id of a task execution
+    :return: Name of the queue
+    """
+    if not lane:
+        return QUEUE
+    queues = QUEUES.get(lane, lane)
+    if isinstance(queues, str):
+        return queues
+    digest = hashlib.sha1(str(key).encode()).digest()
+    return queues[int.from_bytes(digest[:4], 'big') % len(queues)]
+
+
 @validate_args
-def list_tasks(queue: Optional[str] = QUEUE) -> List[Task]:
+def list_tasks(queue: Optional[str] = QUEUE, page_size: int = 1000) -> Iterator[dict]:
+    """
+    Lazily lists the tasks of the queue, fetching them a page at a time in the BASIC view, which leaves out the
+    bodies of the requests.
+
+    :param queue: Name of the queue
+    :param page_size: Number of tasks fetched per request to Cloud Tasks
+    :return:
+    """
     client = tasks_v2.CloudTasksClient()
     full_queue_name = client.queue_path(PROJECT_ID, REGION, queue)
     attributes = ['url', 'http_method', 'headers', 'oidc_token']
 
-    return [{'name': task.name, **{attr: getattr(task.http_request, attr) for attr in attributes}}
-            for task in client.list_tasks(full_queue_name)]
+    for task in client.list_tasks(full_queue_name, response_view=enums.Task.View.BASIC, page_size=page_size):
+        yield {
+            'name': task.name,
+            'schedule_time': task.schedule_time.ToDatetime().replace(tzinfo=datetime.timezone.utc),
+            **{attr: getattr(task.http_request, attr) for attr in attributes},
+        }
 
 
 @validate_args
@@ -47,7 +81,8 @@ def create_task(
         payload: Optional[Union[str, dict, list, tuple]] = None,
         queue: Optional[str] = QUEUE,
         service_account: str = SERVICE_ACCOUNT,
-        delay: int = 0
+        delay: int = 0,
+        deduplicate: bool = False
 ) -> Task:
     client = tasks_v2.CloudTasksClient()
     full_queue_name = client.queue_path(PROJECT_ID, REGION, queue)
@@ -57,6 +92,7 @@ def create_task(
             'url': url,  # The full url path that the task will be sent to.
             'oidc_token': {
                 'service_account_email': service_account,
+                'audience': get_audience(url),
             }
 
         }
@@ -64,7 +100,7 @@ def create_task(
     if isinstance(payload, str):
         task['http_request']['body'] = payload
     elif isinstance(payload, (dict, list, tuple)):
-        task['http_request']['body'] = json.dumps(payload)
+        task['http_request']['body'] = fastjson.dumpb(payload)
 
     scheduled_time = datetime.datetime.utcnow() + datetime.timedelta(seconds=delay)
     pb2_timestamp = timestamp_pb2.Timestamp()
@@ -72,7 +108,9 @@ def create_task(
 
     task['schedule_time'] = pb2_timestamp
     if name:
-        stamped_name = f'{name}__{scheduled_time.timestamp()}'
+        # names are unique per task unless deduplicated, in which case Cloud Tasks rejects a task with the name of
+        # one created in the past hour or so with AlreadyExists
+        stamped_name = name if deduplicate else f'{name}__{scheduled_time.timestamp()}'
         cleaned_name = re.sub(r'[^\w\d-]', '-', stamped_name)
         task['name'] = client.task_path(PROJECT_ID, REGION, queue, cleaned_name)
     return client.create_task(full_queue_name, task)
@@ -86,3 +124,74 @@ def delete_task(name: str, queue: Optional[str] = QUEUE):
         name = name.split(f'{full_queue_name}/tasks/')[-1]
     full_task_name = client.task_path(PROJECT_ID, REGION, queue, name)
     return client.delete_task(full_task_name)
+
+
+def to_duration(seconds: float) -> dict:
+    return {'seconds': int(seconds), 'nanos': int(round(seconds % 1 * 1e9))}
+
+
+def ensure_queue(queue: str, rate_limits: dict, retry_config: dict, running: bool = True):
+    """
+    Creates the queue in Cloud Tasks or updates it with the given settings, and then resumes or pauses it. Only the
+    given settings are updated; the others keep their current values, or the Cloud Tasks defaults for new queues.
+
+    :param queue: Name of the queue
+    :param rate_limits: RateLimits of the queue, e.g. {'max_dispatches_per_second': 10}
+    :param retry_config: RetryConfig of the queue, e.g. {'max_attempts': 5, 'min_backoff': to_duration(1)}
+    :param running: Whether the queue should be running or paused
+    :return: the queue, including the settings Cloud Tasks picked itself, like rate_limits.max_burst_size
+    """
+    client = tasks_v2.CloudTasksClient()
+    full_queue_name = client.queue_path(PROJECT_ID, REGION, queue)
+    config = {'name': full_queue_name, 'rate_limits': rate_limits, 'retry_config': retry_config}
+    try:
+        client.get_queue(full_queue_name)
+    except NotFound:
+        client.create_queue(client.location_path(PROJECT_ID, REGION), config)
+    else:
+        paths = [f'{group}.{field}' for group in ('rate_limits', 'retry_config') for field in config[group]]
+        if paths:
+            client.update_queue(config, {'paths': paths})
+    return client.resume_queue(full_queue_name) if running else client.pause_queue(full_queue_name)
+
+
+@validate_args
+def pause_queue(queue: Optional[str] = QUEUE):
+    client = tasks_v2.CloudTasksClient()
+    return client.pause_queue(client.queue_path(PROJECT_ID, REGION, queue))
+
+
+@validate_args
+def resume_queue(queue: Optional[str] = QUEUE):
+    client = tasks_v2.CloudTasksClient()
+    return client.resume_queue(client.queue_path(PROJECT_ID, REGION, queue))
+
+
+@validate_args
+def purge_queue(queue: Optional[str] = QUEUE):
+    """
+    Deletes all of the tasks in the queue.
+    """
+    client = tasks_v2.CloudTasksClient()
+    return client.purge_queue(client.queue_path(PROJECT_ID, REGION, queue))
+
+
+@validate_args
+def get_backlog(queue: Optional[str] = QUEUE, page_size: int = 1000) -> dict:
+    """
+    Summarizes the tasks waiting in the queue in a single pass: their number, the schedule time and age in seconds
+    of the oldest one, and the number of tasks per URL (without query string).
+    """
+    count, oldest, urls = 0, None, Counter()
+    for task in list_tasks(queue, page_size=page_size):
+        count += 1
+        oldest = task['schedule_time'] if oldest is None else min(oldest, task['schedule_time'])
+        urls[task['url'].split('?', 1)[0]] += 1
+    age = (datetime.datetime.now(datetime.timezone.utc) - oldest).total_seconds() if oldest else None
+    return {
+        'queue': queue,
+        'tasks': count,
+        'oldest_schedule_time': oldest,
+        'oldest_age': max(age, 0) if age is not None else None,
+        'urls': dict(urls.most_common()),
+    }
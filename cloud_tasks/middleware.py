@@ -0,0 +1,15 @@
+from cloud_tasks.routers import pinning_scope
+
+
+class ReplicaPinningMiddleware:
+    """
+    Reads of a request go to the primary once the request has written to cloud_tasks models. See
+    `cloud_tasks.routers`.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with pinning_scope():
+            return self.get_response(request)
@@ -0,0 +1,19 @@
+# Generated by Django 3.0.14 on 2026-10-19 09:34
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cloud_tasks', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='taskexecution',
+            name='context',
+            field=django.contrib.postgres.fields.jsonb.JSONField(blank=True, help_text='Template context accumulated by the steps that have completed so far. Used to resume retried executions.', null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.14 on 2026-10-19 09:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cloud_tasks', '0002_taskexecution_context'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='dispatch',
+            field=models.CharField(choices=[('inline', 'All steps in one request'), ('stepwise', 'Each step in its own Cloud Task')], default='inline', help_text='Whether Cloud Tasks executes all of the steps in a single request, or enqueues each step only after the previous one has succeeded.', max_length=8),
+        ),
+    ]
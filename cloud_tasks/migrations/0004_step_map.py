@@ -0,0 +1,34 @@
+# Generated by Django 3.0.14 on 2026-10-19 09:35
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cloud_tasks', '0003_task_dispatch'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='step',
+            name='map_concurrency',
+            field=models.PositiveSmallIntegerField(default=1, help_text='Number of items requested at once.'),
+        ),
+        migrations.AddField(
+            model_name='step',
+            name='map_failure_threshold',
+            field=models.PositiveIntegerField(default=0, help_text='Number of failed items tolerated before the step fails.'),
+        ),
+        migrations.AddField(
+            model_name='step',
+            name='map_pointer',
+            field=models.CharField(blank=True, default='', help_text="JSON pointer to the array in the source step's response, e.g. /data/tenant_ids. Empty means the whole response.", max_length=255),
+        ),
+        migrations.AddField(
+            model_name='step',
+            name='map_source',
+            field=models.ForeignKey(blank=True, help_text='Earlier step of the same task whose JSON response holds the items to map over. When set, the action and payload are rendered and requested once per item, with the item available as {{item}} (or ${item} for strings) and its position as {{index}}.', null=True, on_delete=django.db.models.deletion.PROTECT, related_name='mapped_by', to='cloud_tasks.Step'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 3.0.14 on 2026-10-19 09:39
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cloud_tasks', '0004_step_map'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='step',
+            name='success_condition',
+            field=django.contrib.postgres.fields.jsonb.JSONField(blank=True, help_text='Condition (or list of conditions) that a JSON response must satisfy, e.g. {"pointer": "/status", "equals": "done", "capture": "status"}. Operators are equals, not_equals, in, contains, matches, gt, gte, lt, lte and exists. Captured values are added to the context. Takes the place of success_pattern for JSON responses.', null=True),
+        ),
+    ]
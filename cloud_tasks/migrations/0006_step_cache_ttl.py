@@ -0,0 +1,18 @@
+# Generated by Django 3.0.14 on 2026-10-19 09:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cloud_tasks', '0005_step_success_condition'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='step',
+            name='cache_ttl',
+            field=models.PositiveIntegerField(blank=True, help_text='Seconds that responses of GET requests may be reused by any step requesting the same URL and payload. Stale responses are revalidated with their ETag or Last-Modified header. Leave empty to always make the request.', null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.14 on 2026-10-19 09:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cloud_tasks', '0006_step_cache_ttl'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='clock',
+            name='interval_seconds',
+            field=models.PositiveSmallIntegerField(blank=True, help_text='Also run the schedules every this many seconds until the next minute, e.g. 10 with a cron of "* * * * *" runs them every 10 seconds. Must be less than 60. Requires Cloud Tasks.', null=True),
+        ),
+    ]
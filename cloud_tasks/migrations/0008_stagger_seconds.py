@@ -0,0 +1,23 @@
+# Generated by Django 3.0.14 on 2026-10-19 09:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cloud_tasks', '0007_clock_interval_seconds'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='clock',
+            name='stagger_seconds',
+            field=models.PositiveSmallIntegerField(blank=True, help_text='Spread the runs of the schedules over this many seconds after each tick instead of running them all at once. Every schedule gets a fixed offset, which stays before the next run of the clock. Requires Cloud Tasks.', null=True),
+        ),
+        migrations.AddField(
+            model_name='taskschedule',
+            name='stagger_seconds',
+            field=models.PositiveSmallIntegerField(blank=True, help_text='Overrides the stagger window of the clock for this schedule. 0 disables staggering.', null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.14 on 2026-10-19 09:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cloud_tasks', '0008_stagger_seconds'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='clock',
+            name='multiplexed',
+            field=models.BooleanField(default=False, help_text='Share one Cloud Scheduler job with the other multiplexed clocks that have the same cron, time zone and service account.'),
+        ),
+    ]
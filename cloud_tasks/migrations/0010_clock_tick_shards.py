@@ -0,0 +1,18 @@
+# Generated by Django 3.0.14 on 2026-10-19 09:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cloud_tasks', '0009_clock_multiplexed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='clock',
+            name='tick_shards',
+            field=models.PositiveSmallIntegerField(blank=True, help_text='Split the schedules into this many ranges of ids, each ticked by its own Cloud Task, for clocks with more schedules than one tick request can run. Requires Cloud Tasks.', null=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.0.14 on 2026-10-19 09:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cloud_tasks', '0010_clock_tick_shards'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='queue',
+            field=models.CharField(blank=True, default='', help_text='Lane of TASKS_QUEUES or name of the Cloud Tasks queue that executes the task. Defaults to TASKS_QUEUE.', max_length=100),
+        ),
+        migrations.AddField(
+            model_name='taskexecution',
+            name='queue',
+            field=models.CharField(blank=True, default='', help_text='Cloud Tasks queue the execution was routed to. Retries and later steps of the execution stay on it.', max_length=100),
+        ),
+        migrations.AddField(
+            model_name='taskschedule',
+            name='queue',
+            field=models.CharField(blank=True, default='', help_text='Lane of TASKS_QUEUES or name of the Cloud Tasks queue that overrides the queue of the task for this schedule.', max_length=100),
+        ),
+    ]
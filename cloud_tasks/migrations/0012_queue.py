@@ -0,0 +1,29 @@
+# Generated by Django 3.0.14 on 2026-10-19 09:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cloud_tasks', '0011_queue_routing'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Queue',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(help_text='Name of the queue in Cloud Tasks.', max_length=100, unique=True)),
+                ('status', models.CharField(choices=[('running', 'Running'), ('paused', 'Paused'), ('broken', 'Broken')], default='running', help_text='Status of the queue.', max_length=8)),
+                ('max_dispatches_per_second', models.FloatField(blank=True, help_text='Maximum rate at which tasks are dispatched.', null=True)),
+                ('max_burst_size', models.PositiveIntegerField(blank=True, help_text='Maximum number of tasks dispatched at once after an idle period. Cannot be changed after the queue is created.', null=True)),
+                ('max_concurrent_dispatches', models.PositiveIntegerField(blank=True, help_text='Maximum number of tasks that can be running at the same time.', null=True)),
+                ('max_attempts', models.IntegerField(blank=True, help_text='Number of attempts per task, -1 for unlimited attempts.', null=True)),
+                ('max_retry_duration', models.PositiveIntegerField(blank=True, help_text='Seconds after the first attempt after which a task is no longer retried.', null=True)),
+                ('min_backoff', models.FloatField(blank=True, help_text='Minimum seconds between attempts.', null=True)),
+                ('max_backoff', models.FloatField(blank=True, help_text='Maximum seconds between attempts.', null=True)),
+                ('max_doublings', models.PositiveIntegerField(blank=True, help_text='Number of times the backoff doubles before it grows linearly.', null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.14 on 2026-10-19 09:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cloud_tasks', '0012_queue'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='clock',
+            name='sync_pending',
+            field=models.BooleanField(default=False, editable=False, help_text='Whether the clock has changes that are not in Cloud Scheduler yet.'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.0.14 on 2026-10-19 09:51
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # the indexes are built without blocking writes to the executions table, which cannot be done in a transaction
+    atomic = False
+
+    dependencies = [
+        ('cloud_tasks', '0013_clock_sync_pending'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='taskexecution',
+            index=models.Index(fields=['queued_time', 'id'], name='taskexecution_queued_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='taskexecution',
+            index=models.Index(fields=['status', 'queued_time'], name='taskexecution_status_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='taskexecution',
+            index=models.Index(fields=['task', 'queued_time'], name='taskexecution_task_idx'),
+        ),
+    ]
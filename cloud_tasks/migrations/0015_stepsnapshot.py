@@ -0,0 +1,27 @@
+# Generated by Django 3.0.14 on 2026-10-19 09:52
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cloud_tasks', '0014_taskexecution_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StepSnapshot',
+            fields=[
+                ('hash', models.CharField(help_text='SHA-256 hash of the definition.', max_length=64, primary_key=True, serialize=False)),
+                ('definition', django.contrib.postgres.fields.jsonb.JSONField(help_text='Fields of the step when the snapshot was taken.')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('step', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='snapshots', to='cloud_tasks.Step')),
+            ],
+            options={
+                'ordering': ('step', 'created'),
+            },
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 3.0.14 on 2026-10-19 09:53
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cloud_tasks', '0015_stepsnapshot'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='taskexecution',
+            name='duration',
+            field=models.DurationField(blank=True, help_text='Time from the start to the end of the execution.', null=True),
+        ),
+        migrations.AddField(
+            model_name='taskexecution',
+            name='failed_status',
+            field=models.IntegerField(blank=True, help_text='HTTP status of the failed step.', null=True),
+        ),
+        migrations.AddField(
+            model_name='taskexecution',
+            name='failed_step',
+            field=models.ForeignKey(blank=True, db_index=False, help_text='Step the execution failed at.', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='failed_executions', to='cloud_tasks.Step'),
+        ),
+        migrations.AddField(
+            model_name='taskexecution',
+            name='steps_completed',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
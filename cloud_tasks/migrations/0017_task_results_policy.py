@@ -0,0 +1,23 @@
+# Generated by Django 3.0.14 on 2026-10-19 09:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cloud_tasks', '0016_taskexecution_outcome'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='results_policy',
+            field=models.CharField(choices=[('all', 'Keep the results of every execution'), ('failures', 'Keep the results of failed executions'), ('sampled', 'Keep the results of failed and a sample of successful executions'), ('summary', 'Keep step counts only')], default='all', help_text='Which executions keep the results of their steps. The others only keep the step counts.', max_length=8),
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='results_sample_rate',
+            field=models.PositiveIntegerField(default=100, help_text='Keep the results of 1 in this many successful executions with the sampled policy.'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.14 on 2026-10-19 10:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cloud_tasks', '0017_task_results_policy'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='queue',
+            name='max_burst_size',
+            field=models.PositiveIntegerField(blank=True, editable=False, help_text='Maximum number of tasks dispatched at once after an idle period. Picked by Cloud Tasks based on the maximum rate, and filled in when the queue is synced.', null=True),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 3.0.14 on 2026-10-19 10:20
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # the indexes are built without blocking writes to the executions table, which cannot be done in a transaction
+    atomic = False
+
+    dependencies = [
+        ('cloud_tasks', '0018_queue_max_burst_size_output_only'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='taskexecution',
+            index=models.Index(fields=['failed_status', 'queued_time'], name='taskexecution_failed_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='taskexecution',
+            index=models.Index(fields=['failed_step', 'queued_time'], name='taskexecution_failed_step_idx'),
+        ),
+    ]
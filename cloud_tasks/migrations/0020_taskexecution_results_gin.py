@@ -0,0 +1,21 @@
+# Generated by Django 3.0.14 on 2026-10-19 10:20
+
+import django.contrib.postgres.indexes
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    # the GIN index over all results takes the longest to build, so it has a migration of its own
+    atomic = False
+
+    dependencies = [
+        ('cloud_tasks', '0019_taskexecution_outcome_indexes'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='taskexecution',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['results'], name='taskexecution_results_gin', opclasses=['jsonb_path_ops']),
+        ),
+    ]
@@ -1,18 +1,28 @@
+import datetime
 import functools
-import json
+import hashlib
 import re
 import logging
-from typing import Tuple, Optional, List
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import Counter
+from typing import Any, Callable, Collection, Dict, Tuple, Optional, List
+from urllib.parse import quote
 
 from django.contrib.postgres.fields import JSONField
-from django.db import models
+from django.contrib.postgres.indexes import GinIndex
+from django.core.exceptions import ValidationError
+from django.db import connection, connections, models, transaction
 from django.forms import model_to_dict
 from django.utils.timezone import now
 from django.template import engines
+from google.api_core.exceptions import AlreadyExists
 
-from cloud_tasks import gscheduler, gtasks, utils
-from cloud_tasks.auth import uri_breakdown
-from cloud_tasks.conf import ROOT_URL, USE_CLOUD_TASKS, SERVICE_ACCOUNT, TIME_ZONE
+from cloud_tasks import fastjson, gscheduler, gtasks, responses, routers, throttle, utils
+from cloud_tasks.cache import response_cache
+from cloud_tasks.conf import ROOT_URL, USE_CLOUD_TASKS, SERVICE_ACCOUNT, TIME_ZONE, QUEUE_DEFINITIONS, \
+    CLOCK_SYNC_WORKERS, BULK_CLOCK_WORKERS
 from cloud_tasks.constants import *
 from cloud_tasks import session as requests
 
@@ -31,6 +41,97 @@ def ignore_unmanaged_clock(method):
     return inner
 
 
+class BackgroundSync:
+    """
+    Syncs saved objects with Google Cloud on a pool of threads once the current transaction commits, so that saving
+    them does not wait for the RPCs. Saves of the same object made before its sync starts are synced together, and
+    saves made while it runs are synced again once it finishes.
+    """
+
+    def __init__(self, name: str, sync: Callable[[int, Any], None], pool: Optional[ThreadPoolExecutor]):
+        """
+        :param name: name of the kind of objects, for logging
+        :param sync: syncs the object with the given id, given the state passed to `schedule` for it
+        :param pool: threads the syncs run on; None runs them in the thread that commits
+        """
+        self.name = name
+        self.sync = sync
+        self.pool = pool
+        # objects claimed for a sync until it finishes, by id, with their state
+        self.pending: Dict[int, Any] = {}
+        # ids of the pending objects whose sync is running
+        self.running = set()
+        # state of the running objects that were saved again since their sync started
+        self.dirty: Dict[int, Any] = {}
+        self.lock = threading.Lock()
+
+    def schedule(self, pk: int, state: Any = None):
+        def submit():
+            with self.lock:
+                if pk in self.running:
+                    self.dirty.setdefault(pk, state)
+                    return
+                if pk in self.pending:
+                    return
+                self.pending[pk] = state
+            if self.pool is None:
+                self.run(pk)
+            else:
+                self.pool.submit(self.run, pk)
+
+        transaction.on_commit(submit)
+
+    def is_dirty(self, pk: int) -> bool:
+        with self.lock:
+            return pk in self.dirty
+
+    def run(self, pk: int):
+        try:
+            while True:
+                with self.lock:
+                    state = self.pending[pk]
+                    self.running.add(pk)
+                try:
+                    self.sync(pk, state)
+                except Exception:
+                    logger.exception(f"Could not sync {self.name} {pk}.")
+                with self.lock:
+                    self.running.discard(pk)
+                    if pk not in self.dirty:
+                        del self.pending[pk]
+                        return
+                    # saved while it was syncing, so sync it again
+                    self.pending[pk] = self.dirty.pop(pk)
+        finally:
+            if self.pool is not None:
+                connection.close()
+
+
+def _sync_clock(pk: int, state: Tuple[bool, Optional[str]]):
+    is_new, previous_gcp_name = state
+    clock = Clock.objects.filter(pk=pk).first()
+    if clock is None:
+        return
+    success, message = clock.sync_job(is_new, previous_gcp_name)
+    logger.info(message)
+    # clocks that failed to sync stay pending until `cloud_tasks clocks sync_pending` syncs them again, and clocks
+    # saved again while syncing stay pending for their next sync
+    if success and not _clock_syncs.is_dirty(pk):
+        Clock.objects.filter(pk=pk).update(sync_pending=False)
+
+
+def _sync_queue(pk: int, state: None):
+    queue = Queue.objects.filter(pk=pk).first()
+    if queue is not None:
+        logger.info(queue.sync_queue()[1])
+
+
+_sync_pool = ThreadPoolExecutor(max_workers=CLOCK_SYNC_WORKERS) if CLOCK_SYNC_WORKERS else None
+# the state of a clock sync is whether the clock is new and the name of its job before it was saved
+_clock_syncs = BackgroundSync('clock', _sync_clock, _sync_pool)
+_queue_syncs = BackgroundSync('queue', _sync_queue, _sync_pool)
+
+
 # prevent hardcoding current value as database default
 def default_service_account(): return SERVICE_ACCOUNT
 
@@ -82,13 +183,50 @@ class Clock(models.Model):
                                   help_text='Whether to automatically or manually control Clock in Cloud Scheduler')
     status = models.CharField(max_length=8, default=RUNNING, choices=STATUS_CHOICES,
                               help_text="Status of the clock. ")
+    interval_seconds = models.PositiveSmallIntegerField(null=True, blank=True,
+                                                        help_text="Also run the schedules every this many seconds "
+                                                                  "until the next minute, e.g. 10 with a cron of "
+                                                                  "\"* * * * *\" runs them every 10 seconds. Must be "
+                                                                  "less than 60. Requires Cloud Tasks.")
+    multiplexed = models.BooleanField(default=False,
+                                      help_text="Share one Cloud Scheduler job with the other multiplexed clocks "
+                                                "that have the same cron, time zone and service account.")
+    stagger_seconds = models.PositiveSmallIntegerField(null=True, blank=True,
+                                                       help_text="Spread the runs of the schedules over this many "
+                                                                 "seconds after each tick instead of running them "
+                                                                 "all at once. Every schedule gets a fixed offset, "
+                                                                 "which stays before the next run of the clock. "
+                                                                 "Requires Cloud Tasks.")
+    sync_pending = models.BooleanField(default=False, editable=False,
+                                       help_text="Whether the clock has changes that are not in Cloud Scheduler yet.")
+    tick_shards = models.PositiveSmallIntegerField(null=True, blank=True,
+                                                   help_text="Split the schedules into this many ranges of ids, "
+                                                             "each ticked by its own Cloud Task, for clocks with "
+                                                             "more schedules than one tick request can run. "
+                                                             "Requires Cloud Tasks.")
 
     @property
     def status_info(self):
         return self._status_info[self.status]
 
+    @property
+    def multiplex_name(self) -> str:
+        """
+        Name of the Cloud Scheduler job shared by the multiplexed clocks with the same schedule as this clock.
+        """
+        key = f'{self.cron}|{self.timezone}|{self.gcp_service_account}'
+        return f'{MULTIPLEX_PREFIX}{hashlib.sha1(key.encode()).hexdigest()[:16]}'
+
     def new_job(self):
         assert self.pk is not None, "Cannot create job without a primary key."
+        if self.multiplexed:
+            return gscheduler.Job(name=self.gcp_name,
+                                  description=f'Ticks the clocks scheduled at "{self.cron}" in {self.timezone}.',
+                                  schedule=self.cron,
+                                  time_zone=self.timezone,
+                                  target_url=utils.hardcode_reverse('cloud_tasks:clock-multiplex-tick', (),
+                                                                    dict(group=self.gcp_name)),
+                                  service_account=self.gcp_service_account)
         return gscheduler.Job(name=self.gcp_name,
                               description=self.description,
                               schedule=self.cron,
@@ -97,26 +235,123 @@ class Clock(models.Model):
                               service_account=self.gcp_service_account)
 
     def clean(self):
+        if self.interval_seconds is not None and not 0 < self.interval_seconds < 60:
+            raise ValidationError({'interval_seconds': "The interval must be between 1 and 59 seconds."})
         if self.management == MANUAL:
             self.status = UNKNOWN
-        if not self.gcp_name:
+        if self.multiplexed:
+            # multiplexed clocks follow the job of their schedule, which changes along with the schedule.
+            self.gcp_name = self.multiplex_name
+        elif not self.gcp_name or self.gcp_name.startswith(MULTIPLEX_PREFIX):
             # make the name friendly for GCP. The value of this field will never change for a given clock.
             self.gcp_name = re.sub(r'[^\w-]', '-', self.name)
         return self
 
-    def tick(self):
+    @classmethod
+    def reconcile_job(cls, gcp_name: str, exclude: Optional[int] = None) -> Tuple[bool, str]:
+        """
+        Make a Cloud Scheduler job shared by multiplexed clocks match its members. The job runs while any of the
+        clocks is running, is paused while none is, and is deleted once no clock uses it anymore.
+
+        :param gcp_name: Name of the job
+        :param exclude: Primary key of a clock leaving the job, e.g. because it is being deleted
+        :return:
+        """
+        members = cls.objects.filter(gcp_name=gcp_name, multiplexed=True, management=GCP).exclude(pk=exclude)
+        member = members.first()
+        try:
+            if member is None:
+                try:
+                    gscheduler.delete_job(gcp_name)
+                except gscheduler.JobDeleteError as e:
+                    if "Job not found" not in gscheduler.get_error(e):
+                        raise
+                return True, f"Clock job {gcp_name} deleted; no clock uses it anymore."
+            running = members.filter(status=RUNNING).exists()
+            gscheduler.ensure_job(gcp_name, member.new_job(), running)
+        except (Exception, BaseException) as e:
+            return False, f"Could not reconcile clock job {gcp_name}: {gscheduler.get_error(e)}"
+        state = 'running' if running else 'paused'
+        return True, f"Clock job {gcp_name} ticks {members.count()} clock(s) and is {state}."
+
+    def _set_multiplexed_status(self, status: str) -> Tuple[bool, str]:
+        self.status = status
+        self.save(skip_cloud_update=True)
+        success, message = self.reconcile_job(self.gcp_name)
+        if not success:
+            self.status = BROKEN
+            self.save(skip_cloud_update=True)
+        return success, message
+
+    @property
+    def run_offsets(self) -> List[int]:
+        """
+        Seconds after a tick at which the schedules of the clock run. Runs after the tick are enqueued
+        with a delay, and all of them happen before the next minute so that they cannot overlap with
+        the runs of the next tick.
+        """
+        if not self.interval_seconds or not USE_CLOUD_TASKS:
+            return [0]
+        return list(range(0, 60, self.interval_seconds))
+
+    def tick_load(self) -> Dict[int, int]:
+        """
+        Number of task runs dispatched at each second after a tick, to preview how the load is spread.
+        """
+        load = Counter()
+        for schedule in self.schedules.all():
+            stagger_offset = schedule.stagger_offset
+            for delay in self.run_offsets:
+                load[delay + stagger_offset] += 1
+        return dict(sorted(load.items()))
+
+    def enqueue_shards(self):
+        """
+        Hand one tick per shard of the schedules to Cloud Tasks, so that the shards run on different instances.
+
+        :return:
+        """
+        ids = self.schedules.order_by('pk').values_list('pk', flat=True)
+        execution_summary = {}
+        for min_id, max_id in utils.split_id_ranges(list(ids), self.tick_shards):
+            tick_url = f'{utils.hardcode_reverse("cloud_tasks:clock-tick", (), dict(pk=self.pk))}' \
+                       f'?min_id={min_id}&max_id={max_id}'
+            gtasks.create_task(tick_url, f'{self.gcp_name}-{min_id}', service_account=self.gcp_service_account)
+            execution_summary[f'Schedules {min_id}-{max_id}'] = "Shard Tick Pending."
+        return execution_summary
+
+    def tick(self, min_id: Optional[int] = None, max_id: Optional[int] = None):
+        """
+        Run the schedules of the clock, or of the shard of the clock between `min_id` and `max_id` inclusive.
+
+        :param min_id: smallest id of the schedules of the shard
+        :param max_id: largest id of the schedules of the shard
+        :return:
+        """
+        is_shard = min_id is not None or max_id is not None
+        if not is_shard and (self.tick_shards or 1) > 1 and USE_CLOUD_TASKS:
+            return self.enqueue_shards()
         schedules = self.schedules.all()
+        if min_id is not None:
+            schedules = schedules.filter(pk__gte=min_id)
+        if max_id is not None:
+            schedules = schedules.filter(pk__lte=max_id)
         execution_summary = {}
         for schedule in schedules:
-            task_execution = schedule.run()
-            if task_execution.results:
-                execution_summary[schedule.name] = task_execution.results
-            else:
-                execution_summary[schedule.name] = f"{task_execution} Results Pending."
+            stagger_offset = schedule.stagger_offset
+            for delay in self.run_offsets:
+                task_execution = schedule.run(delay=delay + stagger_offset)
+                run_name = f'{schedule.name} (+{delay}s)' if delay else schedule.name
+                if task_execution.results:
+                    execution_summary[run_name] = task_execution.results
+                else:
+                    execution_summary[run_name] = f"{task_execution} Results Pending."
         return execution_summary
 
     @ignore_unmanaged_clock
     def start_clock(self) -> Tuple[bool, str]:
+        if self.multiplexed:
+            return self._set_multiplexed_status(RUNNING)
         try:
             job = gscheduler.get_job(self.gcp_name)
             job = gscheduler.resume_job(self.gcp_name)
@@ -153,6 +388,8 @@ class Clock(models.Model):
 
     @ignore_unmanaged_clock
     def pause_clock(self) -> Tuple[bool, str]:
+        if self.multiplexed:
+            return self._set_multiplexed_status(PAUSED)
         try:
             job = gscheduler.get_job(self.gcp_name)
         except (Exception, BaseException) as e:
@@ -176,6 +413,8 @@ class Clock(models.Model):
 
     @ignore_unmanaged_clock
     def update_clock(self, force_update: Optional[List] = None) -> Tuple[bool, str]:
+        if self.multiplexed:
+            return self._set_multiplexed_status(self.status)
         old_job, return_message = None, f"Could not retrieve clock {self.new_job().name} " \
                                         f"for editing. (Missing logic branch)."
         new_job = self.new_job()
@@ -205,6 +444,8 @@ class Clock(models.Model):
 
     @ignore_unmanaged_clock
     def delete_clock(self) -> Tuple[bool, str]:
+        if self.multiplexed:
+            return self.reconcile_job(self.gcp_name, exclude=self.pk)
         job, return_message = None, f"Could not retrieve clock {self.name} for deletion. (Missing logic branch)."
         try:
             job = gscheduler.get_job(self.gcp_name)
@@ -247,28 +488,59 @@ class Clock(models.Model):
         success, message = self.update_clock(force_update=['http_target'])
         if not success:
             message = f'Could not sync clock: {message}'
+        else:
+            self.sync_pending = False
+            Clock.objects.filter(pk=self.pk).update(sync_pending=False)
         return success, message
 
+    def sync_job(self, is_new: bool = False, previous_gcp_name: Optional[str] = None) -> Tuple[bool, str]:
+        """
+        Create or update the Cloud Scheduler job of the clock after it has been saved.
+
+        :param is_new: whether the clock has just been created
+        :param previous_gcp_name: name of the job of the clock before it was saved
+        :return:
+        """
+        if is_new:
+            return self.start_clock()
+        if previous_gcp_name and previous_gcp_name != self.gcp_name:
+            # the clock joined, left or changed its multiplexed job
+            _, message = self.reconcile_job(previous_gcp_name)
+            logger.info(message)
+            if not self.multiplexed:
+                return self.start_clock()
+        return self.update_clock()
+
+    def schedule_sync(self, is_new: bool = False, previous_gcp_name: Optional[str] = None):
+        """
+        Sync the clock with Cloud Scheduler in the background once the current transaction commits. Saves of the
+        same clock made before the sync starts are synced together, and saves made while it runs are synced again
+        once it finishes.
+
+        :param is_new: whether the clock has just been created
+        :param previous_gcp_name: name of the job of the clock before it was saved
+        :return:
+        """
+        _clock_syncs.schedule(self.pk, (is_new, previous_gcp_name))
+
     def save(self, force_insert=False, force_update=False, using=None,
              update_fields=None, skip_cloud_update=None):
         self.clean()
         is_new = self.pk is None
-        # create/update new Cloud Scheduler job corresponding to Clock
-        # if this model instance is just now being created.
+        # do not manage the clock via save in manual mode.
+        # skip_cloud_update is passed by the *_clock methods when they call Clock.save().
+        # this flag prevents infinite recursion from continually calling Clock.update_clock,
+        # and some undesired updates
+        sync = self.management != MANUAL and (is_new or not skip_cloud_update)
+        previous_gcp_name = None
+        if sync:
+            if not is_new:
+                previous_gcp_name = Clock.objects.filter(pk=self.pk).values_list('gcp_name', flat=True).first()
+            self.sync_pending = True
         super().save(force_insert, force_update, using, update_fields)
-        # do not manage the clock via save in manual mode
-        if self.management == MANUAL:
-            return self
-        if is_new:
-            self.start_clock()
-        else:
-            # skip_cloud_update is passed by the *_clock methods when they call Clock.save().
-            # this flag prevents infinite recursion from continually calling Clock.update_clock,
-            # and some undesired updates
-            if skip_cloud_update:
-                return self
-            _, message = self.update_clock()
-            logger.info(message)
+        if sync:
+            # create/update the Cloud Scheduler job corresponding to Clock once the clock is committed
+            self.schedule_sync(is_new, previous_gcp_name)
         return self
 
     def delete(self, using=None, keep_parents=False):
@@ -278,6 +550,101 @@ class Clock(models.Model):
             raise gscheduler.JobDeleteError(message)
         return super(Clock, self).delete(using=using, keep_parents=keep_parents)
 
+    def apply_action(self, action: str) -> Tuple[bool, str]:
+        """
+        Start, pause, fix, sync or delete the clock.
+
+        :param action: one of START, PAUSE, FIX, SYNC and DELETE
+        :return:
+        """
+        if action in (START, FIX):
+            return self.start_clock()
+        elif action == PAUSE:
+            return self.pause_clock()
+        elif action == SYNC:
+            return self.sync_clock()
+        elif action == DELETE:
+            self.delete()
+            return True, f"Clock {self.name} deleted successfully."
+        raise ValueError(f"Action must be one of {(START, PAUSE, FIX, SYNC, DELETE)}, got {action}")
+
+    @classmethod
+    def _apply_shared_action(cls, gcp_name: str, clocks: List['Clock'], action: str) -> Tuple[bool, str]:
+        """
+        Apply `action` to multiplexed clocks that share the Cloud Scheduler job `gcp_name`, then reconcile the job
+        once for all of them.
+        """
+        for clock in clocks:
+            if action == DELETE:
+                # the job is reconciled below, once the clocks are gone
+                super(Clock, clock).delete()
+            else:
+                clock.status = PAUSED if action == PAUSE else RUNNING
+                clock.save(skip_cloud_update=True)
+        success, message = cls.reconcile_job(gcp_name)
+        pks = [clock.pk for clock in clocks if clock.pk is not None]
+        if not success:
+            cls.objects.filter(pk__in=pks).update(status=BROKEN)
+        elif action == SYNC:
+            cls.objects.filter(pk__in=pks).update(sync_pending=False)
+        return success, message
+
+    @classmethod
+    def bulk_action(cls, clocks, action: str, workers: int = BULK_CLOCK_WORKERS) -> List[dict]:
+        """
+        Apply `action` to many clocks at once on a pool of `workers` threads. The requests to Cloud Scheduler
+        stay within TASKS_SCHEDULER_RATE_LIMIT. Multiplexed clocks that share a job are handled together by one
+        thread, which reconciles their job once.
+
+        :param clocks: clocks to apply the action to
+        :param action: one of START, PAUSE, FIX, SYNC and DELETE
+        :param workers: number of clocks or shared jobs to work on at once
+        :return: the result of the action for each clock, in the order of `clocks`
+        """
+        if action not in (START, PAUSE, FIX, SYNC, DELETE):
+            raise ValueError(f"Action must be one of {(START, PAUSE, FIX, SYNC, DELETE)}, got {action}")
+
+        def apply(group):
+            gcp_name, group_clocks = group
+            try:
+                if gcp_name is None:
+                    return group_clocks[0].apply_action(action)
+                return cls._apply_shared_action(gcp_name, group_clocks, action)
+            except (Exception, BaseException) as e:
+                names = ', '.join(clock.name for clock in group_clocks)
+                return False, f"Could not {action} clock {names}: {gscheduler.get_error(e)}"
+            finally:
+                connection.close()
+
+        clocks = list(clocks)
+        groups, shared = [], {}
+        for clock in clocks:
+            if clock.multiplexed and clock.management == GCP:
+                if clock.gcp_name not in shared:
+                    shared[clock.gcp_name] = []
+                    groups.append((clock.gcp_name, shared[clock.gcp_name]))
+                shared[clock.gcp_name].append(clock)
+            else:
+                groups.append((None, [clock]))
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            group_outcomes = list(executor.map(apply, groups))
+        outcomes = {id(clock): outcome for (_, group_clocks), outcome in zip(groups, group_outcomes)
+                    for clock in group_clocks}
+        return [{'id': clock.pk, 'name': clock.name, 'success': success, 'message': message}
+                for clock, (success, message) in zip(clocks, [outcomes[id(clock)] for clock in clocks])]
+
+    @classmethod
+    def sync_pending_clocks(cls, workers: int = BULK_CLOCK_WORKERS) -> List[dict]:
+        """
+        Sync the clocks whose changes are not in Cloud Scheduler yet, e.g. because their background sync failed or
+        the process stopped before it ran.
+
+        :param workers: number of clocks to work on at once
+        :return: the result of the sync for each clock
+        """
+        clocks = cls.objects.filter(sync_pending=True).exclude(management=MANUAL)
+        return cls.bulk_action(clocks, SYNC, workers=workers)
+
     class Meta:
         permissions = (
             ('timekeeper', 'Can (re)start, pause, sync, and force the tick of a clock'),
@@ -298,6 +665,28 @@ class TaskSchedule(models.Model):
     clock = models.ForeignKey(Clock, null=True, on_delete=models.SET_NULL, related_name='schedules')
 
     enabled = models.BooleanField(default=True, help_text="Whether or not task schedule is enabled.")
+    stagger_seconds = models.PositiveSmallIntegerField(null=True, blank=True,
+                                                       help_text="Overrides the stagger window of the clock for "
+                                                                 "this schedule. 0 disables staggering.")
+    queue = models.CharField(max_length=100, blank=True, default='',
+                             help_text="Lane of TASKS_QUEUES or name of the Cloud Tasks queue that overrides the "
+                                       "queue of the task for this schedule.")
+
+    @property
+    def stagger_offset(self) -> int:
+        """
+        Delay in seconds of the runs of this schedule after each tick. The offset is derived from a hash of the
+        schedule id, so it does not change between ticks, and it is capped to stay before the next run of the clock.
+        """
+        window = self.stagger_seconds
+        if window is None and self.clock is not None:
+            window = self.clock.stagger_seconds
+        if not window or self.pk is None or not USE_CLOUD_TASKS:
+            return 0
+        if self.clock is not None:
+            window = min(window, (self.clock.interval_seconds or 60) - 1)
+        digest = hashlib.sha1(str(self.pk).encode()).digest()
+        return int.from_bytes(digest[:4], 'big') % (window + 1)
 
     @property
     def status(self):
@@ -316,13 +705,17 @@ class TaskSchedule(models.Model):
         else:
             return f"Clock {self.clock.name} is in corrupted state {self.clock.status}; this should not have happened."
 
-    def run(self):
+    def run(self, delay: int = 0):
+        """
+        Execute the task, through Cloud Tasks if it is enabled.
+
+        :param delay: number of seconds Cloud Tasks waits before executing the task
+        :return:
+        """
         if not USE_CLOUD_TASKS:
             return self.task.execute()
         task_execution = TaskExecution.objects.create(task=self.task)
-        create_url = f'{utils.hardcode_reverse("cloud_tasks:task-execute", (), dict(pk=self.task.pk))}' \
-                     f'?task_execution_id={task_execution.pk}'
-        gtasks.create_task(create_url, self.task.name)
+        self.task.enqueue(task_execution, delay=delay, queue=self.queue)
         return task_execution
 
     class Meta:
@@ -334,6 +727,133 @@ class TaskSchedule(models.Model):
         return f'{self.name}: {self.task}'
 
 
+class Queue(models.Model):
+    """
+    Throughput and retry settings of a Cloud Tasks queue. Saving a queue creates or updates it in Cloud Tasks in
+    the background.
+    Deleting a queue only stops managing it, since Cloud Tasks does not allow reusing the name of a deleted queue
+    for several days.
+    """
+    _status_choices = {
+        RUNNING: 'Running',
+        PAUSED: 'Paused',
+        BROKEN: 'Broken',
+    }
+    STATUS_CHOICES = (
+        (key, value) for key, value in _status_choices.items()
+    )
+    RATE_LIMIT_FIELDS = ('max_dispatches_per_second', 'max_concurrent_dispatches', )
+    RETRY_CONFIG_FIELDS = ('max_attempts', 'max_retry_duration', 'min_backoff', 'max_backoff', 'max_doublings', )
+    DURATION_FIELDS = ('max_retry_duration', 'min_backoff', 'max_backoff', )
+
+    name = models.CharField(max_length=100, unique=True, help_text="Name of the queue in Cloud Tasks.")
+    status = models.CharField(max_length=8, default=RUNNING, choices=STATUS_CHOICES,
+                              help_text="Status of the queue.")
+    max_dispatches_per_second = models.FloatField(null=True, blank=True,
+                                                  help_text="Maximum rate at which tasks are dispatched.")
+    max_burst_size = models.PositiveIntegerField(null=True, blank=True, editable=False,
+                                                 help_text="Maximum number of tasks dispatched at once after an "
+                                                           "idle period. Picked by Cloud Tasks based on the "
+                                                           "maximum rate, and filled in when the queue is synced.")
+    max_concurrent_dispatches = models.PositiveIntegerField(null=True, blank=True,
+                                                            help_text="Maximum number of tasks that can be "
+                                                                      "running at the same time.")
+    max_attempts = models.IntegerField(null=True, blank=True,
+                                       help_text="Number of attempts per task, -1 for unlimited attempts.")
+    max_retry_duration = models.PositiveIntegerField(null=True, blank=True,
+                                                     help_text="Seconds after the first attempt after which a task "
+                                                               "is no longer retried.")
+    min_backoff = models.FloatField(null=True, blank=True, help_text="Minimum seconds between attempts.")
+    max_backoff = models.FloatField(null=True, blank=True, help_text="Maximum seconds between attempts.")
+    max_doublings = models.PositiveIntegerField(null=True, blank=True,
+                                                help_text="Number of times the backoff doubles before it grows "
+                                                          "linearly.")
+
+    @classmethod
+    def load_definitions(cls, definitions: Optional[Dict[str, dict]] = None) -> List['Queue']:
+        """
+        Create or update queues from their definitions, which default to the TASKS_QUEUE_DEFINITIONS setting.
+
+        :param definitions: settings of the queues by name
+        :return:
+        """
+        definitions = QUEUE_DEFINITIONS if definitions is None else definitions
+        queues = []
+        for name, definition in definitions.items():
+            queue, _ = cls.objects.update_or_create(name=name, defaults=definition)
+            queues.append(queue)
+        return queues
+
+    def _config(self, fields) -> dict:
+        config = {}
+        for field in fields:
+            value = getattr(self, field)
+            if value is not None:
+                config[field] = gtasks.to_duration(value) if field in self.DURATION_FIELDS else value
+        return config
+
+    def sync_queue(self) -> Tuple[bool, str]:
+        """
+        Make the queue in Cloud Tasks match its settings and status.
+
+        :return:
+        """
+        try:
+            queue = gtasks.ensure_queue(self.name, self._config(self.RATE_LIMIT_FIELDS),
+                                        self._config(self.RETRY_CONFIG_FIELDS), running=self.status != PAUSED)
+        except (Exception, BaseException) as e:
+            self.status = BROKEN
+            self.save(skip_cloud_update=True)
+            return False, f"Could not sync queue {self.name}: {gscheduler.get_error(e)}"
+        # the burst size is output only in Cloud Tasks
+        max_burst_size = queue.rate_limits.max_burst_size or None
+        if self.status == BROKEN or self.max_burst_size != max_burst_size:
+            self.status = RUNNING if self.status == BROKEN else self.status
+            self.max_burst_size = max_burst_size
+            self.save(skip_cloud_update=True)
+        return True, f"Queue {self.name} synced."
+
+    def start_queue(self) -> Tuple[bool, str]:
+        try:
+            gtasks.resume_queue(self.name)
+        except (Exception, BaseException) as e:
+            return False, f"Could not resume queue {self.name}: {gscheduler.get_error(e)}"
+        self.status = RUNNING
+        self.save(skip_cloud_update=True)
+        return True, f"Queue {self.name} is running."
+
+    def pause_queue(self) -> Tuple[bool, str]:
+        try:
+            gtasks.pause_queue(self.name)
+        except (Exception, BaseException) as e:
+            return False, f"Could not pause queue {self.name}: {gscheduler.get_error(e)}"
+        self.status = PAUSED
+        self.save(skip_cloud_update=True)
+        return True, f"Queue {self.name} paused."
+
+    def purge_queue(self) -> Tuple[bool, str]:
+        try:
+            gtasks.purge_queue(self.name)
+        except (Exception, BaseException) as e:
+            return False, f"Could not purge queue {self.name}: {gscheduler.get_error(e)}"
+        return True, f"Queue {self.name} purged."
+
+    def backlog(self) -> dict:
+        return gtasks.get_backlog(self.name)
+
+    def save(self, force_insert=False, force_update=False, using=None,
+             update_fields=None, skip_cloud_update=None):
+        super().save(force_insert, force_update, using, update_fields)
+        # skip_cloud_update is passed by the *_queue methods, which already updated Cloud Tasks
+        if not skip_cloud_update:
+            # create/update the queue in Cloud Tasks once the queue is committed
+            _queue_syncs.schedule(self.pk)
+        return self
+
+    def __str__(self):
+        return self.name
+
+
 class TaskExecution(models.Model):
     """
     Tasks that have been executed
@@ -354,7 +874,71 @@ class TaskExecution(models.Model):
     start_time = models.DateTimeField(null=True, blank=True)
     finish_time = models.DateTimeField(null=True, blank=True)
 
+    queue = models.CharField(max_length=100, blank=True, default='',
+                             help_text="Cloud Tasks queue the execution was routed to. Retries and later steps of "
+                                       "the execution stay on it.")
+    # indexed by taskexecution_failed_step_idx, which is built concurrently
+    failed_step = models.ForeignKey('cloud_tasks.Step', null=True, blank=True, on_delete=models.SET_NULL,
+                                    related_name='failed_executions', db_index=False,
+                                    help_text="Step the execution failed at.")
+    failed_status = models.IntegerField(null=True, blank=True, help_text="HTTP status of the failed step.")
+    steps_completed = models.PositiveIntegerField(null=True, blank=True)
+    duration = models.DurationField(null=True, blank=True, help_text="Time from the start to the end of the "
+                                                                     "execution.")
+
     results = JSONField(null=True, blank=True)
+    context = JSONField(null=True, blank=True, help_text="Template context accumulated by the steps that have "
+                                                         "completed so far. Used to resume retried executions.")
+
+    def get_context(self) -> dict:
+        """
+        Template context for the steps of this execution. Time values are pinned to the first attempt
+        so that a retried execution renders the same payloads as the original one.
+        """
+        context = dict(self.context or {})
+        timestamp = context.get('timestamp')
+        if timestamp is None:
+            _now = now()
+        else:
+            _now = datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc)
+        context.update({
+            'datetime': _now,
+            'now': _now,
+            'timestamp': _now.timestamp(),
+            'isodate': _now.isoformat()
+        })
+        return context
+
+    def set_context(self, context: dict):
+        # datetime values are rebuilt from the timestamp by get_context
+        self.context = {key: value for key, value in context.items()
+                        if isinstance(value, (str, int, float, bool, list, dict, type(None)))}
+
+    def resume_index(self, steps) -> int:
+        """
+        Index of the first of `steps` that did not succeed during a previous attempt of this execution.
+        """
+        previous = (self.results or {}).get('steps', [])
+        for i, (step, step_result) in enumerate(zip(steps, previous)):
+            summary, response = step_result.get('summary'), step_result.get('response', {})
+            if not isinstance(summary, dict) or summary.get('id') != step.pk or response.get('success') is not True:
+                return i
+        # steps that succeeded after the results were last written are only counted, see save_progress
+        return min(len(steps), max(len(previous), self.steps_completed or 0))
+
+    def save_progress(self, steps_completed: int, context: dict, results: Optional[dict] = None):
+        """
+        Record that the first `steps_completed` steps succeeded, with the context they produced, so that a retry
+        resumes after them. The results of the steps are only written when they are given, since rewriting them
+        after every step is costly.
+        """
+        self.steps_completed = steps_completed
+        self.set_context(context)
+        update_fields = ['steps_completed', 'context']
+        if results is not None:
+            self.results = results
+            update_fields.append('results')
+        self.save(update_fields=update_fields)
 
     def save(self, force_insert=False, force_update=False, using=None,
              update_fields=None):
@@ -365,9 +949,22 @@ class TaskExecution(models.Model):
             self.start_time = _now
         elif self.status in (SUCCESS, FAILURE,) and not self.finish_time:
             self.finish_time = _now
+        self.duration = self.finish_time - self.start_time if self.finish_time and self.start_time else None
         return super().save(force_insert=force_insert, force_update=force_update,
                             using=using, update_fields=update_fields)
 
+    class Meta:
+        indexes = (
+            # lists ordered by -queued_time get -pk appended as a tiebreaker, which this index also covers
+            models.Index(fields=['queued_time', 'id'], name='taskexecution_queued_idx'),
+            models.Index(fields=['status', 'queued_time'], name='taskexecution_status_idx'),
+            models.Index(fields=['task', 'queued_time'], name='taskexecution_task_idx'),
+            models.Index(fields=['failed_status', 'queued_time'], name='taskexecution_failed_idx'),
+            models.Index(fields=['failed_step', 'queued_time'], name='taskexecution_failed_step_idx'),
+            # for containment queries on the results, e.g. results__contains={'steps': [{'summary': {'id': 1}}]}
+            GinIndex(fields=['results'], name='taskexecution_results_gin', opclasses=['jsonb_path_ops']),
+        )
+
     def __str__(self):
         return f'{self.task} ({self._status_choices[self.status]})'
 
@@ -376,38 +973,201 @@ class Task(models.Model):
     """
     A series of `Steps` to be executed at a set time.
     """
+    _dispatch_choices = {
+        INLINE: 'All steps in one request',
+        STEPWISE: 'Each step in its own Cloud Task',
+    }
+    DISPATCH_CHOICES = (
+        (key, value) for key, value in _dispatch_choices.items()
+    )
+    _results_policy_choices = {
+        RESULTS_ALL: 'Keep the results of every execution',
+        RESULTS_FAILURES: 'Keep the results of failed executions',
+        RESULTS_SAMPLED: 'Keep the results of failed and a sample of successful executions',
+        RESULTS_SUMMARY: 'Keep step counts only',
+    }
+    RESULTS_POLICY_CHOICES = (
+        (key, value) for key, value in _results_policy_choices.items()
+    )
+
     name = models.CharField(max_length=MAX_NAME_LENGTH, unique=True, help_text="Name of Task")
+    dispatch = models.CharField(max_length=8, default=INLINE, choices=DISPATCH_CHOICES,
+                                help_text="Whether Cloud Tasks executes all of the steps in a single request, or "
+                                          "enqueues each step only after the previous one has succeeded.")
+    queue = models.CharField(max_length=100, blank=True, default='',
+                             help_text="Lane of TASKS_QUEUES or name of the Cloud Tasks queue that executes the "
+                                       "task. Defaults to TASKS_QUEUE.")
+    results_policy = models.CharField(max_length=8, default=RESULTS_ALL, choices=RESULTS_POLICY_CHOICES,
+                                      help_text="Which executions keep the results of their steps. The others only "
+                                                "keep the step counts.")
+    results_sample_rate = models.PositiveIntegerField(default=100,
+                                                      help_text="Keep the results of 1 in this many successful "
+                                                                "executions with the sampled policy.")
+
+    @staticmethod
+    def _trimmed_steps(step_results: List[dict], map_sources: Collection[int]) -> List[dict]:
+        trimmed = []
+        for step_result in step_results:
+            summary = step_result.get('summary')
+            if not isinstance(summary, dict) or summary.get('id') not in map_sources:
+                step_result = {**step_result, 'response': {**(step_result.get('response') or {}),
+                                                           'content': None, 'is_json': None}}
+            trimmed.append(step_result)
+        return trimmed
+
+    def progress_results(self, results: dict, map_sources: Collection[int] = ()) -> dict:
+        """
+        Results of an unfinished execution that are written for a retry or the next step to resume from. Under the
+        summary policy the steps are only kept with the content of the steps that map steps read.
+
+        :param results: full results of the execution so far
+        :param map_sources: ids of the steps whose results map steps read
+        :return:
+        """
+        if self.results_policy != RESULTS_SUMMARY:
+            return results
+        return {**results, 'steps': self._trimmed_steps(results.get('steps') or [], map_sources)}
+
+    def retained_results(self, task_execution, results: dict, succeeded: bool,
+                         map_sources: Collection[int] = ()) -> dict:
+        """
+        Results of a finished execution that are kept according to the results policy of the task.
+
+        :param task_execution: the finished TaskExecution
+        :param results: full results of the execution
+        :param succeeded: whether all of the steps succeeded
+        :param map_sources: ids of the steps whose results map steps read. A retry of a failed execution needs
+            their content, which is kept even under the summary policy.
+        :return:
+        """
+        if self.results_policy == RESULTS_ALL or (not succeeded and self.results_policy != RESULTS_SUMMARY):
+            return results
+        if self.results_policy == RESULTS_SAMPLED and task_execution.pk % max(self.results_sample_rate, 1) == 0:
+            return results
+        if not succeeded and map_sources:
+            return {**self.progress_results(results, map_sources), 'steps_retained': False}
+        return {**{key: value for key, value in results.items() if key != 'steps'}, 'steps_retained': False}
+
+    def enqueue(self, task_execution, step: Optional[int] = None, delay: int = 0, queue: Optional[str] = None,
+                deferred: bool = False):
+        """
+        Hand `task_execution` to Cloud Tasks, which will call back to `Task.execute`.
+
+        Each step of a stepwise task is handed off at most once: its Cloud Task is named after the execution and
+        the step, so that Cloud Tasks rejects the hand-offs of duplicate deliveries.
+
+        :param task_execution: TaskExecution to be executed
+        :param step: index of the single step to execute, for stepwise dispatch. Defaults to the first step.
+        :param delay: number of seconds to wait before dispatching
+        :param queue: lane or queue that overrides the queue of the task, e.g. the one of a schedule
+        :param deferred: whether the step is handed off again by its own callback, e.g. because it is rate limited,
+            which cannot reuse the name of the Cloud Task of the callback
+        :return: the Cloud Task, or None if the step had already been handed off
+        """
+        if not task_execution.queue:
+            task_execution.queue = gtasks.get_queue(queue or self.queue, key=task_execution.pk) or ''
+            task_execution.save(update_fields=['queue'])
+        create_url = f'{utils.hardcode_reverse("cloud_tasks:task-execute", (), dict(pk=self.pk))}' \
+                     f'?task_execution_id={task_execution.pk}'
+        if self.dispatch == STEPWISE and step is None:
+            step = 0
+        if step is None:
+            return gtasks.create_task(create_url, self.name, queue=task_execution.queue or None, delay=delay)
+        create_url += f'&step={step}'
+        try:
+            return gtasks.create_task(create_url, f'{self.name}__{task_execution.pk}__step-{step}',
+                                      queue=task_execution.queue or None, delay=delay, deduplicate=not deferred)
+        except AlreadyExists:
+            logger.info(f'Step {step} of {task_execution} has already been handed off.')
+            return None
 
-    def execute(self, task_execution_id: int = None):
+    def execute(self, task_execution_id: int = None, step: Optional[int] = None):
         if task_execution_id is None:
             task_execution = TaskExecution.objects.create(task=self, status=STARTED)
         else:
-            task_execution = TaskExecution.objects.get(pk=task_execution_id)
+            # the state of the execution is read from the primary, which a lagging replica could be behind
+            task_execution = TaskExecution.objects.using(routers.primary_alias(TaskExecution)).get(pk=task_execution_id)
+            if task_execution.status == SUCCESS:
+                # e.g. a retry of a callback whose response was lost; the results may not have kept the steps
+                return task_execution
+        steps = list(self.steps.all().order_by('pk'))
+        # retries of the same execution pick up at the first step that has not succeeded yet
+        resume_at = task_execution.resume_index(steps)
+        # whether this execution was dispatched by Cloud Tasks, which can retry it later
+        dispatched = USE_CLOUD_TASKS and task_execution_id is not None
+        # stepwise tasks only execute one step per Cloud Tasks callback
+        stepwise = self.dispatch == STEPWISE and dispatched
+        if stepwise and (step or 0) != resume_at:
+            if step == resume_at - 1 and resume_at < len(steps) and task_execution.status == STARTED:
+                # the step already succeeded, but handing off the next one may not have; if it did, Cloud Tasks
+                # rejects the duplicate hand-off
+                self.enqueue(task_execution, step=resume_at)
+            return task_execution
+        context = task_execution.get_context()
+        task_execution.set_context(context)
         task_execution.status = STARTED
+        task_execution.finish_time = None
+        task_execution.failed_step, task_execution.failed_status = None, None
+        task_execution.steps_completed = resume_at
         task_execution.save()
 
-        task_results = {'steps': []}
-        steps = self.steps.all().order_by('pk')
+        task_results = {'steps': ((task_execution.results or {}).get('steps') or [])[:resume_at]}
+        if (task_execution.results or {}).get('map_progress'):
+            # the items of a deferred map step that have been requested
+            task_results['map_progress'] = task_execution.results['map_progress']
+        for completed_step in steps[len(task_results['steps']):resume_at]:
+            # the results of steps that succeeded were not written; they are not executed again
+            task_results['steps'].append({
+                'summary': completed_step.summary(),
+                'response': {'success': True, 'status': None, 'content': None, 'is_json': None},
+            })
+        # steps whose results later map steps read
+        map_sources = {mapped.map_source_id for mapped in steps if mapped.map_source_id is not None}
         completed = len(steps)
-        _now = now()
-        context = {
-            'datetime': _now,
-            'now': _now,
-            'timestamp': _now.timestamp(),
-            'isodate': _now.isoformat()
-        }
-        for i, step in enumerate(steps):
-            # see the format_response_tuple wrapper to understand format of step.execute() output
-            success, status_code, response_dict = step.execute(context=context)
+        last = min(resume_at + 1, len(steps)) if stepwise else len(steps)
+        for i in range(resume_at, last):
+            while True:
+                try:
+                    # see the format_response_tuple wrapper to understand format of step.execute() output
+                    success, status_code, response_dict = steps[i].execute(context=context, results=task_results)
+                    break
+                except throttle.RateLimited as e:
+                    if getattr(e, 'map_progress', None) is not None:
+                        # the items of a map step that were requested are not requested again
+                        task_results.setdefault('map_progress', {})[str(steps[i].pk)] = e.map_progress
+                    # the host of the step is over its budget; wait for it rather than failing
+                    if not dispatched:
+                        time.sleep(e.wait)
+                        continue
+                    logger.info(f'Deferring {task_execution} by {e.wait}s; {steps[i]} is rate limited.')
+                    task_execution.status = PENDING
+                    task_execution.results = self.progress_results(task_results, map_sources)
+                    task_execution.set_context(context)
+                    task_execution.save()
+                    self.enqueue(task_execution, step=i if stepwise else None, delay=e.wait, deferred=True)
+                    return task_execution
             task_results['steps'].append(response_dict)
+            if str(steps[i].pk) in task_results.get('map_progress', {}):
+                del task_results['map_progress'][str(steps[i].pk)]
             if not success:
                 completed = i
                 break
+            # progress is only needed to resume executions that Cloud Tasks can retry, and the last step is followed
+            # by the results anyway. The results themselves are only written when a later map step reads them, or
+            # when the callback of the next step has to keep them and the policy does not trim them.
+            if dispatched and i + 1 < len(steps):
+                needs_results = steps[i].pk in map_sources or (stepwise and self.results_policy != RESULTS_SUMMARY)
+                progress = self.progress_results(task_results, map_sources) if needs_results else None
+                task_execution.save_progress(i + 1, context, progress)
+        if completed == len(steps) and last < len(steps):
+            # the context for the next step was carried forward by save_progress
+            self.enqueue(task_execution, step=last)
+            return task_execution
         # iterate over incompleted to indicate neither failure nor success.
         # loop is empty if completed + 1 == len(steps)
         for i in range(completed + 1, len(steps)):
             task_results['steps'].append({
-                'summary': model_to_dict(steps[i]),
+                'summary': steps[i].summary(),
                 'response': {
                     'success': None,
                     'status': -1,
@@ -424,7 +1184,13 @@ class Task(models.Model):
             'steps_failed': len(steps) - completed,
         })
         task_execution.status = SUCCESS if all_completed else FAILURE
-        task_execution.results = task_results
+        # facts about the outcome are kept in columns, so that executions can be searched without their results
+        task_execution.steps_completed = completed
+        if not all_completed:
+            task_execution.failed_step = steps[completed]
+            task_execution.failed_status = task_results['steps'][completed]['response']['status']
+        task_execution.results = self.retained_results(task_execution, task_results, all_completed, map_sources)
+        task_execution.set_context(context)
         task_execution.save()
         return task_execution
 
@@ -437,9 +1203,42 @@ class Task(models.Model):
         return self.name
 
 
+def render_template(text: str, context: dict, autoescape: bool = True) -> str:
+    """
+    Render `text` with the given context, replacing ${key} with the corresponding (string) value
+    from the context before applying Django template logic and filters.
+
+    :param autoescape: whether values are HTML escaped, which is not wanted for e.g. URLs
+    """
+    for key, value in context.items():
+        # replace ${key} in the text with the corresponding value
+        # from the context
+        if isinstance(value, str):
+            text = re.sub(fr'\${{{key}}}', value, text)
+    if not autoescape:
+        text = f'{{% autoescape off %}}{text}{{% endautoescape %}}'
+    # allow django template logic and filters
+    template = template_engine.from_string(text)
+    return template.render(context, None)
+
+
+def url_quoted(value):
+    """
+    `value` with its strings, including those nested in lists and dicts, quoted for use in a URL.
+    """
+    if isinstance(value, str):
+        return quote(value, safe='')
+    if isinstance(value, dict):
+        return {key: url_quoted(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [url_quoted(item) for item in value]
+    return value
+
+
 def format_response_tuple(method):
     """
-    Convenience wrapper for formatting a tuple(success, status_code, response_text, failure_reason) response
+    Convenience wrapper for formatting a tuple(success, status_code, response_text, failure_reason) response.
+    `response_text` may also be a ParsedResponse or already structured content.
     :param method: method to be wrapped
     :return:
     """
@@ -448,6 +1247,9 @@ def format_response_tuple(method):
     def inner(*args, **kwargs) -> Tuple[bool, int, dict]:
         try:
             step_summary, success, status_code, response_text, failure_reason = method(*args, **kwargs)
+        except throttle.RateLimited:
+            # the step could not be attempted; it is up to the caller to wait or retry
+            raise
         except (Exception, BaseException) as e:
             step_summary, success, status_code, response_text, failure_reason = \
                 'unknown', False, 500, None, f'{e.__class__.__name__}("{e}")'
@@ -458,12 +1260,23 @@ def format_response_tuple(method):
                 'status': status_code,
             }
         }
-        try:
-            response_dict['response']['content'] = json.loads(response_text)
-            response_dict['response']['is_json'] = True
-        except (json.JSONDecodeError, TypeError):
+        if isinstance(response_text, responses.ParsedResponse):
+            # the body has already been decoded while checking for success
+            response_dict['response']['content'] = response_text.content
+            response_dict['response']['is_json'] = response_text.is_json
+            if response_text.cache is not None:
+                response_dict['response']['cache'] = response_text.cache
+        elif isinstance(response_text, (dict, list)):
+            # already structured, e.g. the aggregated results of a map step
             response_dict['response']['content'] = response_text
-            response_dict['response']['is_json'] = False
+            response_dict['response']['is_json'] = True
+        else:
+            try:
+                response_dict['response']['content'] = fastjson.loads(response_text)
+                response_dict['response']['is_json'] = True
+            except (fastjson.JSONDecodeError, TypeError):
+                response_dict['response']['content'] = response_text
+                response_dict['response']['is_json'] = False
         if failure_reason:
             response_dict['response']['error'] = failure_reason
 
@@ -494,39 +1307,68 @@ class Step(models.Model):
     payload = JSONField(null=True, blank=True, help_text="JSON Payload of request")
     success_pattern = models.CharField(null=True, blank=True, max_length=255,
                                        help_text="Regex corresponding to successful execution")
+    success_condition = JSONField(null=True, blank=True,
+                                  help_text="Condition (or list of conditions) that a JSON response must satisfy, "
+                                            "e.g. {\"pointer\": \"/status\", \"equals\": \"done\", "
+                                            "\"capture\": \"status\"}. Operators are equals, not_equals, in, "
+                                            "contains, matches, gt, gte, lt, lte and exists. Captured values are "
+                                            "added to the context. Takes the place of success_pattern for JSON "
+                                            "responses.")
+    cache_ttl = models.PositiveIntegerField(null=True, blank=True,
+                                            help_text="Seconds that responses of GET requests may be reused by any "
+                                                      "step requesting the same URL and payload. Stale responses "
+                                                      "are revalidated with their ETag or Last-Modified header. "
+                                                      "Leave empty to always make the request.")
+    map_source = models.ForeignKey('self', null=True, blank=True, on_delete=models.PROTECT, related_name='mapped_by',
+                                   help_text="Earlier step of the same task whose JSON response holds the items "
+                                             "to map over. When set, the action and payload are rendered and "
+                                             "requested once per item, with the item available as {{item}} "
+                                             "(or ${item} for strings) and its position as {{index}}.")
+    map_pointer = models.CharField(blank=True, default='', max_length=255,
+                                   help_text="JSON pointer to the array in the source step's response, "
+                                             "e.g. /data/tenant_ids. Empty means the whole response.")
+    map_concurrency = models.PositiveSmallIntegerField(default=1, help_text="Number of items requested at once.")
+    map_failure_threshold = models.PositiveIntegerField(default=0, help_text="Number of failed items tolerated "
+                                                                             "before the step fails.")
 
-    @format_response_tuple
-    def execute(self, session=None, context=None) -> Tuple[dict, bool, int, str, str]:
+    def clean(self):
+        if self.success_condition is not None:
+            try:
+                responses.validate_conditions(self.success_condition)
+            except ValueError as e:
+                raise ValidationError({'success_condition': str(e)})
+        if self.map_source_id is None:
+            return self
+        if self.map_source.task_id != self.task_id or (self.pk is not None and self.map_source_id >= self.pk):
+            raise ValidationError({'map_source': "The map source must be an earlier step of the same task."})
+        return self
+
+    def render_payload(self, context: Optional[dict]):
         """
-        Make a POST request, check the response
-        :param session: http session to use for step
-        :return: success: bool, response.status_code: int, response.text: str
+        Render the payload of the step with the given context.
+        :param context: template context
+        :return: rendered payload, or the unaltered payload if there is nothing to render
+        """
+        if not self.payload or not context:
+            return self.payload
+        # payload needs to be a string for regex replacement
+        return fastjson.loads(render_template(fastjson.dumps(self.payload), context))
+
+    def check_response(self, response: responses.ParsedResponse,
+                       context: Optional[dict] = None) -> Tuple[bool, Optional[str]]:
+        """
+        Check whether `response` indicates a successful execution, updating `context` with the values
+        captured by `success_condition` or the named groups of `success_pattern`.
+        :return: success: bool, failure_reason: str
         """
-        step_summary = model_to_dict(self)
-        # remove url params as they cannot be part of the audience
-        protocol, url, _ = uri_breakdown(self.action)
-        session = requests.create_openid_session(audience=f'{protocol}://{url}') if not session else session
-        payload = self.payload
-        if payload and context:
-            # payload needs to be a string for regex replacement
-            payload = json.dumps(payload)
-            for key, value in context.items():
-                # replace ${key} in the payload with the corresponding value
-                # from the context
-                if isinstance(value, str):
-                    payload = re.sub(fr'\${{{key}}}', value, payload)
-            # allow django template logic and filters
-            template = template_engine.from_string(payload)
-            payload = template.render(context, None)
-            payload = json.loads(payload)
-            step_summary['payload'] = payload
-        with session as s:
-            http_method = getattr(s, self.method.lower())
-            response = http_method(self.action, json=payload)
         # if redirect or some error code
         if response.status_code > 299:
-            return step_summary, False, response.status_code, response.text, "HTTP Error"
+            return False, "HTTP Error"
+        if self.success_condition is not None and response.is_json:
+            return responses.evaluate_conditions(self.success_condition, response.content, context)
         success, failure_reason = True, None
+        if self.success_condition is not None and self.success_pattern is None:
+            success, failure_reason = False, "response content is not JSON; success_condition cannot be evaluated"
         if self.success_pattern is not None:
             success_regex = re.compile(self.success_pattern)
             # success if our patten matches any part of the response text
@@ -535,7 +1377,140 @@ class Step(models.Model):
             if context and match:
                 context.update(match.groupdict())
             failure_reason = None if success else f"response content did not match success_regex={self.success_pattern}"
-        return step_summary, success, response.status_code, response.text, failure_reason
+        return success, failure_reason
+
+    @format_response_tuple
+    def execute(self, session=None, context=None, results=None) -> Tuple[dict, bool, int, str, str]:
+        """
+        Make a POST request, check the response
+        :param session: http session to use for step
+        :param context: template context, updated with the named groups of `success_pattern`
+        :param results: results of the task execution so far; required for map steps
+        :return: success: bool, response.status_code: int, response.text: str
+        """
+        step_summary = self.summary()
+        if self.map_source_id is not None:
+            return self.execute_map(step_summary, context, results)
+        session = requests.create_session(self.action) if not session else session
+        payload = self.render_payload(context)
+        if payload is not self.payload:
+            step_summary['payload'] = payload
+        with session as s:
+            http_method = getattr(s, self.method.lower())
+
+            def send(headers=None):
+                with throttle.host_budget(self.action):
+                    return http_method(self.action, json=payload, headers=headers)
+
+            if self.cache_ttl and self.method == 'GET':
+                cache_key = (self.action, fastjson.dumps(payload) if payload is not None else None)
+                response = responses.ParsedResponse(*response_cache.fetch(cache_key, self.cache_ttl, send))
+            else:
+                response = responses.ParsedResponse(send())
+        success, failure_reason = self.check_response(response, context)
+        return step_summary, success, response.status_code, response, failure_reason
+
+    def map_items(self, results: Optional[dict]) -> list:
+        """
+        Find the array to map over in the results of `map_source`.
+        :param results: results of the task execution so far
+        :return:
+        """
+        source_result = None
+        for step_result in (results or {}).get('steps', []):
+            summary = step_result['summary']
+            if isinstance(summary, dict) and summary.get('id') == self.map_source_id:
+                source_result = step_result['response']
+        if source_result is None:
+            raise ValueError(f"Map source {self.map_source} has not been executed; map steps can only be "
+                             f"executed as part of their task.")
+        if not source_result['is_json']:
+            raise ValueError(f"Response of map source {self.map_source} is not JSON.")
+        items = utils.resolve_json_pointer(source_result['content'], self.map_pointer)
+        if not isinstance(items, list):
+            raise ValueError(f"{self.map_pointer or 'Response'} of map source {self.map_source} is not an array.")
+        return items
+
+    def execute_map(self, step_summary: dict, context: Optional[dict], results: Optional[dict]):
+        """
+        Request the rendered action once for each item of the map source, `map_concurrency` items at a time.
+        Gives up on the remaining items once more than `map_failure_threshold` items have failed.
+
+        If the host of an item is rate limited, the items in flight are finished and the others are deferred:
+        `RateLimited` is raised with the outcomes so far as its `map_progress`, which the caller passes back in
+        the `map_progress` of `results` so that only the deferred items are requested again.
+        :return: step_summary: dict, success: bool, status_code: int, content: dict, failure_reason: str
+        """
+        items = self.map_items(results)
+        context = context or {}
+        progress = ((results or {}).get('map_progress') or {}).get(str(self.pk)) or {}
+
+        def request_item(index, item):
+            item_context = {**context, 'item': item, 'index': index}
+            # the item is part of the URL, so it is URL quoted rather than HTML escaped
+            item_url = render_template(self.action, {**item_context, 'item': url_quoted(item)}, autoescape=False)
+            try:
+                with requests.create_session(item_url) as s, throttle.host_budget(item_url):
+                    http_method = getattr(s, self.method.lower())
+                    response = responses.ParsedResponse(http_method(item_url, json=self.render_payload(item_context)))
+            finally:
+                # loopback requests use database connections of this worker thread
+                connections.close_all()
+            return response.status_code, self.check_response(response)
+
+        # items requested by earlier attempts of the step are not requested again
+        succeeded, failures = set(progress.get('succeeded', [])), list(progress.get('failures', []))
+        attempted = succeeded | {failure['index'] for failure in failures}
+        rate_limited = None
+        with ThreadPoolExecutor(max_workers=max(self.map_concurrency, 1)) as pool:
+            futures = {pool.submit(request_item, index, item): (index, item)
+                       for index, item in enumerate(items) if index not in attempted}
+            for future in as_completed(futures):
+                if future.cancelled():
+                    continue
+                index, item = futures[future]
+                try:
+                    status_code, (success, failure_reason) = future.result()
+                except throttle.RateLimited as e:
+                    # defer the items that have not been requested rather than counting them as failures; the
+                    # items in flight are still recorded
+                    rate_limited = rate_limited or e
+                    for pending in futures:
+                        pending.cancel()
+                    continue
+                except (Exception, BaseException) as e:
+                    status_code, success, failure_reason = 500, False, f'{e.__class__.__name__}("{e}")'
+                if success:
+                    succeeded.add(index)
+                    continue
+                failures.append({'index': index, 'item': item, 'status': status_code, 'error': failure_reason})
+                if len(failures) > self.map_failure_threshold:
+                    # items that have not started yet are skipped
+                    for pending in futures:
+                        pending.cancel()
+        if rate_limited is not None and len(failures) <= self.map_failure_threshold:
+            rate_limited.map_progress = {'succeeded': sorted(succeeded), 'failures': failures}
+            raise rate_limited
+        succeeded = len(succeeded)
+        failures.sort(key=lambda failure: failure['index'])
+        content = {
+            'items': len(items),
+            'succeeded': succeeded,
+            'failed': len(failures),
+            'skipped': len(items) - succeeded - len(failures),
+            'failures': failures[:MAX_MAP_FAILURES_REPORTED],
+        }
+        if len(failures) > self.map_failure_threshold:
+            return step_summary, False, failures[0]['status'], content, \
+                   f"{len(failures)} of {len(items)} items failed (threshold {self.map_failure_threshold})"
+        return step_summary, True, 200, content, None
+
+    def summary(self) -> dict:
+        """
+        Summary of the step for the results of an execution, which refers to a snapshot of the definition of
+        the step instead of copying it. See `StepSnapshot.expand`.
+        """
+        return {'id': self.pk, 'name': self.name, 'snapshot': StepSnapshot.intern(self)}
 
     class Meta:
         unique_together = ("name", "task",)
@@ -545,3 +1520,81 @@ class Step(models.Model):
 
     def __str__(self):
         return f'{self.name} (of {self.task})'
+
+
+class StepSnapshot(models.Model):
+    """
+    A version of the definition of a `Step`, stored once and addressed by the SHA-256 hash of its content.
+    The results of task executions refer to these snapshots rather than each holding a copy of the definition.
+    """
+    # hashes of the snapshots known to exist, which this process does not need to store again
+    _known = set()
+    MAX_KNOWN = 10000
+
+    hash = models.CharField(max_length=64, primary_key=True, help_text="SHA-256 hash of the definition.")
+    step = models.ForeignKey(Step, null=True, on_delete=models.SET_NULL, related_name='snapshots')
+    definition = JSONField(help_text="Fields of the step when the snapshot was taken.")
+    created = models.DateTimeField(auto_now_add=True)
+
+    @classmethod
+    def intern(cls, step: Step) -> str:
+        """
+        Store the current definition of `step`, unless an identical one is already stored.
+
+        :return: the hash of the definition
+        """
+        canonical = fastjson.dumpb(model_to_dict(step), sort_keys=True)
+        snapshot_hash = hashlib.sha256(canonical).hexdigest()
+        if snapshot_hash not in cls._known:
+            definition = fastjson.loads(canonical)
+            cls.objects.get_or_create(hash=snapshot_hash, defaults={'step': step, 'definition': definition})
+            # the snapshot is only known to exist once the transaction that stored it has committed
+            transaction.on_commit(functools.partial(cls._remember, snapshot_hash), using=routers.primary_alias(cls))
+        return snapshot_hash
+
+    @classmethod
+    def _remember(cls, snapshot_hash: str):
+        if len(cls._known) >= cls.MAX_KNOWN:
+            cls._known.clear()
+        cls._known.add(snapshot_hash)
+
+    @classmethod
+    def expand(cls, results: Optional[dict]) -> Optional[dict]:
+        """
+        Copy of the results of an execution where step summaries that refer to a snapshot include the definition
+        of the step, as in results recorded before snapshots.
+        """
+        return cls.expand_many([results])[0]
+
+    @classmethod
+    def expand_many(cls, results_list: List[Optional[dict]]) -> List[Optional[dict]]:
+        """
+        `expand` for the results of many executions, which reads the snapshots of all of them in one query.
+        """
+        def summaries(results):
+            if not results or not isinstance(results.get('steps'), list):
+                return None
+            return [step_result.get('summary') for step_result in results['steps']]
+
+        summaries_list = [summaries(results) for results in results_list]
+        hashes = {summary['snapshot'] for _summaries in summaries_list for summary in _summaries or []
+                  if isinstance(summary, dict) and 'snapshot' in summary}
+        definitions = dict(cls.objects.filter(hash__in=hashes).values_list('hash', 'definition')) if hashes else {}
+        expanded = []
+        for results, _summaries in zip(results_list, summaries_list):
+            if _summaries is None:
+                expanded.append(results)
+                continue
+            steps = []
+            for step_result, summary in zip(results['steps'], _summaries):
+                if isinstance(summary, dict) and summary.get('snapshot') in definitions:
+                    step_result = {**step_result, 'summary': {**definitions[summary['snapshot']], **summary}}
+                steps.append(step_result)
+            expanded.append({**results, 'steps': steps})
+        return expanded
+
+    class Meta:
+        ordering = ('step', 'created', )
+
+    def __str__(self):
+        return f'{self.step} ({self.hash[:12]})'
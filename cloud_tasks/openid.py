@@ -1,19 +1,62 @@
+import threading
+import time
+from urllib.parse import urlsplit
+
 import google.auth.transport.requests
+from google.auth import jwt
 from google.oauth2 import id_token
 
+from cloud_tasks.conf import AUDIENCE_POLICY, AUDIENCE_PREFIXES
+from cloud_tasks.constants import ORIGIN, PATH_PREFIX
+
 CERTS_URL = 'https://www.googleapis.com/oauth2/v1/certs'
+# cached tokens are replaced this many seconds before they expire
+TOKEN_EXPIRY_MARGIN = 300
+
+_token_cache = {}
+_token_cache_lock = threading.Lock()
+
+
+def get_audience(url: str) -> str:
+    """
+    Audience of the token for requesting `url` according to `TASKS_AUDIENCE_POLICY`:
+    'exact' uses the url without query parameters, 'origin' uses only the protocol and host, and
+    'prefix' uses the longest of `TASKS_AUDIENCE_PREFIXES` that the path starts with (or the exact
+    url if there is none).
+
+    :param url: url to be requested
+    :return:
+    """
+    parts = urlsplit(url)
+    origin = f'{parts.scheme}://{parts.netloc}'
+    if AUDIENCE_POLICY == ORIGIN:
+        return origin
+    if AUDIENCE_POLICY == PATH_PREFIX:
+        prefixes = [prefix for prefix in AUDIENCE_PREFIXES if parts.path.startswith(prefix)]
+        if prefixes:
+            return f'{origin}{max(prefixes, key=len)}'
+    return f'{origin}{parts.path}'
 
 
 def create_token(audience) -> str:
     """
-    Create Google OpenID token with the given audience
+    Create Google OpenID token with the given audience. Tokens are cached per audience until shortly
+    before they expire.
 
     :param audience: url endpoints for which this token can be successfully authenticated
     :return:
     """
+    with _token_cache_lock:
+        token, expiry = _token_cache.get(audience, (None, 0))
+    if time.time() < expiry - TOKEN_EXPIRY_MARGIN:
+        return token
     request = google.auth.transport.requests.Request()
     # https://github.com/googleapis/google-auth-library-python/blob/ca8d98ab2e5277e53ab8df78beb1e75cdf5321e3/google/oauth2/id_token.py#L168-L252
-    return id_token.fetch_id_token(request, audience)
+    token = id_token.fetch_id_token(request, audience)
+    expiry = jwt.decode(token, verify=False)['exp']
+    with _token_cache_lock:
+        _token_cache[audience] = (token, expiry)
+    return token
 
 
 def decode_token(token, audience=None) -> dict:
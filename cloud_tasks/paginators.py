@@ -0,0 +1,56 @@
+"""
+Pagination that does not count every row of large tables. Postgres estimates the number of rows from its planner
+statistics: `reltuples` for a whole table, and the row estimate of EXPLAIN for a filtered queryset. Counts below
+`TASKS_APPROXIMATE_COUNT_THRESHOLD` are exact.
+"""
+from typing import Optional
+
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import QuerySet
+from django.utils.functional import cached_property
+from rest_framework.pagination import PageNumberPagination
+
+from cloud_tasks import fastjson
+from cloud_tasks.conf import APPROXIMATE_COUNT_THRESHOLD, PAGE_SIZE
+
+
+def estimate_count(queryset: QuerySet) -> Optional[int]:
+    """
+    Number of rows of `queryset` estimated by Postgres, or None if there is no estimate.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+    with connection.cursor() as cursor:
+        if not queryset.query.where:
+            cursor.execute('SELECT reltuples FROM pg_class WHERE oid = %s::regclass',
+                           [queryset.model._meta.db_table])
+            row = cursor.fetchone()
+            # tables that have never been analyzed have no estimate
+            return int(row[0]) if row and row[0] >= 0 else None
+        sql, params = queryset.query.sql_with_params()
+        cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = fastjson.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+class ApproximateCountPaginator(Paginator):
+    threshold = APPROXIMATE_COUNT_THRESHOLD
+
+    @cached_property
+    def count(self):
+        if isinstance(self.object_list, QuerySet):
+            estimate = estimate_count(self.object_list)
+            if estimate is not None and estimate >= self.threshold:
+                return estimate
+        return super().count
+
+
+class ApproximateCountPagination(PageNumberPagination):
+    django_paginator_class = ApproximateCountPaginator
+    page_size = PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
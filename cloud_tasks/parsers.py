@@ -0,0 +1,18 @@
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+
+from cloud_tasks import fastjson
+from cloud_tasks.renderers import FastJSONRenderer
+
+
+class FastJSONParser(JSONParser):
+    """
+    Parses JSON request bodies with `cloud_tasks.fastjson`, which uses orjson when it is installed.
+    """
+    renderer_class = FastJSONRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return fastjson.loads(stream.read())
+        except ValueError as exc:
+            raise ParseError(f'JSON parse error - {exc}')
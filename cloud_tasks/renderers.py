@@ -0,0 +1,15 @@
+from rest_framework.renderers import JSONRenderer
+
+from cloud_tasks import fastjson
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    Renders JSON with `cloud_tasks.fastjson`, which uses orjson when it is installed.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        indent = self.get_indent(accepted_media_type, renderer_context or {})
+        return fastjson.dumpb(data, indent=bool(indent), default=self.encoder_class().default)
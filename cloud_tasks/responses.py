@@ -0,0 +1,117 @@
+"""
+Processing of step responses. The body of a response is decoded once, according to its content type,
+and structured success conditions are evaluated against the decoded JSON document.
+"""
+import re
+from typing import Optional, Tuple, Union
+
+from cloud_tasks import fastjson, utils
+
+# operators of a success condition, applied as operator(value at pointer, operand)
+CONDITION_OPERATORS = {
+    'equals': lambda value, operand: value == operand,
+    'not_equals': lambda value, operand: value != operand,
+    'in': lambda value, operand: value in operand,
+    'contains': lambda value, operand: operand in value,
+    'matches': lambda value, operand: isinstance(value, str) and re.search(operand, value) is not None,
+    'gt': lambda value, operand: value > operand,
+    'gte': lambda value, operand: value >= operand,
+    'lt': lambda value, operand: value < operand,
+    'lte': lambda value, operand: value <= operand,
+}
+CONDITION_KEYS = {'pointer', 'exists', 'capture', *CONDITION_OPERATORS}
+
+
+def is_json_content_type(content_type: Optional[str]) -> bool:
+    media_type = (content_type or '').split(';')[0].strip().lower()
+    return media_type == 'application/json' or media_type.endswith('+json')
+
+
+class ParsedResponse:
+    """
+    Body of a response decoded a single time. JSON content types are decoded straight from the raw
+    bytes; other bodies are decoded to text, and kept as JSON if the text happens to be JSON.
+    """
+
+    def __init__(self, response, cache: Optional[str] = None):
+        self.response = response
+        self.status_code = response.status_code
+        # how the response was obtained from the response cache, if it was used
+        self.cache = cache
+        self.is_json = False
+        if is_json_content_type(response.headers.get('Content-Type')):
+            try:
+                self.content = fastjson.loads(response.content)
+                self.is_json = True
+                return
+            except (fastjson.JSONDecodeError, TypeError):
+                pass
+        self.content = response.text
+        try:
+            self.content = fastjson.loads(self.content)
+            self.is_json = True
+        except (fastjson.JSONDecodeError, TypeError):
+            pass
+
+    @property
+    def text(self) -> str:
+        return self.response.text
+
+
+def validate_conditions(conditions: Union[dict, list]):
+    """
+    :raises ValueError: if `conditions` is not a condition or a list of conditions
+    """
+    for condition in conditions if isinstance(conditions, list) else [conditions]:
+        if not isinstance(condition, dict):
+            raise ValueError(f'Success conditions must be objects, got {condition!r}.')
+        unknown = set(condition) - CONDITION_KEYS
+        if unknown:
+            raise ValueError(f'Unknown success condition keys {sorted(unknown)}; '
+                             f'expected some of {sorted(CONDITION_KEYS)}.')
+
+
+def evaluate_conditions(conditions: Union[dict, list], document,
+                        context: Optional[dict] = None) -> Tuple[bool, Optional[str]]:
+    """
+    Evaluate success conditions against a decoded JSON document. A condition looks like
+    {"pointer": "/data/status", "equals": "done", "capture": "status"}: the value at the JSON pointer
+    must satisfy every operator of the condition, and is added to `context` under the `capture` name
+    if all conditions hold. {"pointer": ..., "exists": false} requires that there is no value.
+
+    :param conditions: a condition or a list of conditions that must all hold
+    :param document: decoded JSON document
+    :param context: template context to update with captured values
+    :return: success: bool, failure_reason: str
+    """
+    try:
+        # e.g. a misspelled operator, which would otherwise be ignored and let any response pass
+        validate_conditions(conditions)
+    except ValueError as e:
+        return False, f"invalid success_condition: {e}"
+    captured = {}
+    for condition in conditions if isinstance(conditions, list) else [conditions]:
+        pointer = condition.get('pointer', '')
+        try:
+            value, found = utils.resolve_json_pointer(document, pointer), True
+        except LookupError:
+            value, found = None, False
+        if found != condition.get('exists', True):
+            return False, f"success_condition failed: {'a' if found else 'no'} value at {pointer or '/'}"
+        if not found:
+            continue
+        for name, operator in CONDITION_OPERATORS.items():
+            if name not in condition:
+                continue
+            try:
+                satisfied = operator(value, condition[name])
+            except TypeError:
+                satisfied = False
+            if not satisfied:
+                return False, f"success_condition failed: value at {pointer or '/'} ({value!r}) " \
+                              f"did not satisfy {name} {condition[name]!r}"
+        if 'capture' in condition:
+            captured[condition['capture']] = value
+    if context is not None:
+        context.update(captured)
+    return True, None
@@ -0,0 +1,136 @@
+"""
+Database router that offloads the reads of cloud_tasks models, such as execution history and lists, to a read
+replica while writes stay on the primary:
+
+    TASKS_READ_REPLICA = 'replica'
+    DATABASE_ROUTERS = ['cloud_tasks.routers.ReplicaRouter']
+    MIDDLEWARE = [..., 'cloud_tasks.middleware.ReplicaPinningMiddleware']
+
+Reads go back to the primary while the replica lags more than `TASKS_REPLICA_MAX_LAG` seconds, and for the rest
+of a request (or, outside of requests, of the thread) once it has written to cloud_tasks models, so that it reads
+its own writes.
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.db import connections, router
+
+from cloud_tasks.conf import READ_REPLICA, REPLICA_MAX_LAG, REPLICA_LAG_CHECK_INTERVAL
+
+APP_LABEL = 'cloud_tasks'
+
+logger = logging.getLogger(__name__)
+
+# whether reads are pinned to the primary after a write
+_pinned = ContextVar('cloud_tasks_pinned_to_primary', default=False)
+_lag = {'checked': None, 'fresh': False}
+_lag_lock = threading.Lock()
+
+REPLICA_LAG_QUERY = """
+    SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END
+"""
+
+
+def pin_to_primary():
+    _pinned.set(True)
+
+
+def is_pinned() -> bool:
+    return _pinned.get()
+
+
+def primary_alias(model) -> str:
+    """
+    Alias of the database that writes of `model` go to. Unlike `router.db_for_write`, looking it up does not pin
+    the reads that follow to the primary, so it can pick where to read state that must not lag.
+    """
+    token = _pinned.set(is_pinned())
+    try:
+        return router.db_for_write(model)
+    finally:
+        _pinned.reset(token)
+
+
+@contextmanager
+def pinning_scope():
+    """
+    Scope of read-your-writes pinning, e.g. a request. Writes in the scope pin the reads that follow them in the
+    scope to the primary.
+    """
+    token = _pinned.set(False)
+    try:
+        yield
+    finally:
+        _pinned.reset(token)
+
+
+def replica_lag() -> float:
+    """
+    Seconds by which the replica lags behind the primary.
+    """
+    with connections[READ_REPLICA].cursor() as cursor:
+        cursor.execute(REPLICA_LAG_QUERY)
+        lag = cursor.fetchone()[0]
+    # no replay yet means the replica is not replicating
+    return float('inf') if lag is None else float(lag)
+
+
+def replica_is_fresh() -> bool:
+    """
+    Whether the lag of the replica is within `TASKS_REPLICA_MAX_LAG`. The lag is checked at most once every
+    `TASKS_REPLICA_LAG_CHECK_INTERVAL` seconds.
+    """
+    with _lag_lock:
+        _now = time.monotonic()
+        if _lag['checked'] is not None and _now - _lag['checked'] < REPLICA_LAG_CHECK_INTERVAL:
+            return _lag['fresh']
+        _lag['checked'] = _now
+    try:
+        fresh = replica_lag() <= REPLICA_MAX_LAG
+    except Exception:
+        logger.exception(f"Could not check the lag of the read replica {READ_REPLICA}; reading from the primary.")
+        fresh = False
+    _lag['fresh'] = fresh
+    return fresh
+
+
+class ReplicaRouter:
+    """
+    Sends the reads of cloud_tasks models to `TASKS_READ_REPLICA` and leaves every other decision to the next
+    router, or to the default database.
+    """
+
+    @staticmethod
+    def db_for_read(model, **hints):
+        if READ_REPLICA is None or model._meta.app_label != APP_LABEL:
+            return None
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db:
+            # related objects are read from the database of the instance they are related to
+            return instance._state.db
+        if is_pinned() or not replica_is_fresh():
+            return None
+        return READ_REPLICA
+
+    @staticmethod
+    def db_for_write(model, **hints):
+        if model._meta.app_label == APP_LABEL:
+            pin_to_primary()
+        return None
+
+    @staticmethod
+    def allow_relation(obj1, obj2, **hints):
+        if READ_REPLICA is not None and obj1._meta.app_label == APP_LABEL and obj2._meta.app_label == APP_LABEL:
+            # the replica holds the same rows as the primary
+            return True
+        return None
+
+    @staticmethod
+    def allow_migrate(db, app_label, model_name=None, **hints):
+        if db == READ_REPLICA:
+            return False
+        return None
@@ -2,11 +2,21 @@
 Some wrappers around the requests library. If we import these methods from this file,
 we either get the defaults or the custom.
 """
+import functools
 from typing import Optional
 
 from requests import *
+from requests.structures import CaseInsensitiveDict
 
-from cloud_tasks.openid import create_token
+from django.contrib.auth import get_user_model
+from django.core.handlers.exception import response_for_exception
+from django.test.client import RequestFactory
+from django.urls import resolve, Resolver404
+from rest_framework.test import force_authenticate
+
+from cloud_tasks import fastjson
+from cloud_tasks.conf import LOOPBACK, ROOT_URL, SERVICE_ACCOUNT
+from cloud_tasks.openid import create_token, get_audience
 
 
 class Session(Session):
@@ -24,6 +34,58 @@ class Session(Session):
         self.headers.update(headers)
 
 
+class LoopbackSession:
+    """
+    Stand-in for `Session` that dispatches requests for routes of this Django project in-process
+    through the URL resolver, authenticated as `user`, instead of going over the network. Middleware
+    is not applied, so views relying on it should not be requested through a `LoopbackSession`.
+    """
+    request_factory = RequestFactory()
+
+    def __init__(self, user):
+        self.user = user
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def request(self, method: str, url: str, json: Optional[dict] = None, headers: Optional[dict] = None) -> Response:
+        path = url[len(ROOT_URL):]
+        protocol, host = ROOT_URL.split('://', 1)
+        data = fastjson.dumpb(json) if json is not None else b''
+        extra = {f'HTTP_{key.upper().replace("-", "_")}': value for key, value in (headers or {}).items()}
+        request = self.request_factory.generic(method.upper(), path, data=data, content_type='application/json',
+                                               secure=protocol == 'https', HTTP_HOST=host, **extra)
+        request.user = self.user
+        force_authenticate(request, user=self.user)
+        try:
+            match = resolve(request.path_info)
+            response = match.func(request, *match.args, **match.kwargs)
+            if callable(getattr(response, 'render', None)):
+                response = response.render()
+        except Exception as e:
+            response = response_for_exception(request, e)
+
+        result = Response()
+        result.url = url
+        result.status_code = response.status_code
+        result.reason = response.reason_phrase
+        result.headers = CaseInsensitiveDict(response.items())
+        result.encoding = response.charset
+        result._content = b''.join(response.streaming_content) if response.streaming else response.content
+        return result
+
+    get = functools.partialmethod(request, 'GET')
+    post = functools.partialmethod(request, 'POST')
+    put = functools.partialmethod(request, 'PUT')
+    patch = functools.partialmethod(request, 'PATCH')
+    delete = functools.partialmethod(request, 'DELETE')
+    head = functools.partialmethod(request, 'HEAD')
+    options = functools.partialmethod(request, 'OPTIONS')
+
+
 def create_openid_session(audience: Optional[str] = None) -> Session:
     """
     Create a Session with a Google OpenID using the given audience. Defaults to
@@ -33,3 +95,31 @@ def create_openid_session(audience: Optional[str] = None) -> Session:
     """
     token = create_token(audience)
     return Session(auth_token=token)
+
+
+def create_loopback_session(url: str) -> Optional[LoopbackSession]:
+    """
+    Create a LoopbackSession if `url` is a route of this Django project and the service account has a User.
+    :param url: url that will be requested with the session
+    :return: tasks.requests.LoopbackSession instance, or None if `url` cannot be requested in-process
+    """
+    if not url.startswith(f'{ROOT_URL}/'):
+        return None
+    try:
+        resolve(url[len(ROOT_URL):].split('?')[0])
+    except Resolver404:
+        return None
+    user = get_user_model().objects.filter(email__iexact=SERVICE_ACCOUNT).first()
+    return LoopbackSession(user) if user is not None else None
+
+
+def create_session(url: str):
+    """
+    Create a session for requesting `url`. If `TASKS_LOOPBACK` is enabled and `url` is a route of this
+    Django project the session dispatches in-process, otherwise it is a Google OpenID session with
+    the audience of `url` under `TASKS_AUDIENCE_POLICY`.
+    :param url: url that will be requested with the session
+    :return: tasks.requests.Session or tasks.requests.LoopbackSession instance
+    """
+    session = create_loopback_session(url) if LOOPBACK else None
+    return session if session is not None else create_openid_session(get_audience(url))
@@ -1,11 +1,34 @@
+import contextlib
+import datetime
+import gzip
 import http
+import io
+import os
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+from unittest import mock
 
 from django.contrib.auth import get_user_model
-from django.test import Client, LiveServerTestCase
+from django.core.cache import caches
+from django.core.exceptions import ValidationError
+from django.test import Client, LiveServerTestCase, SimpleTestCase
 from django.urls import reverse
+from django.utils.translation import gettext_lazy
+from google.api_core.exceptions import AlreadyExists
+from rest_framework.exceptions import ParseError, ValidationError as APIValidationError
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory, force_authenticate
 
-from cloud_tasks import models, openid
-from cloud_tasks.constants import SUCCESS, FAILURE
+from cloud_tasks import admission, archive, cache, conf, fastjson, gtasks, models, openid, paginators, responses, \
+    routers, session, throttle, utils
+from cloud_tasks.api import ClockViewSet, StepSerializer, TaskExecutionViewSet, TaskViewSet
+from cloud_tasks.parsers import FastJSONParser
+from cloud_tasks.renderers import FastJSONRenderer
+from cloud_tasks.constants import SUCCESS, FAILURE, STARTED, STEPWISE, EXACT, PATH_PREFIX, ORIGIN, \
+    CACHE_HIT, CACHE_MISS, CACHE_REVALIDATED, CACHE_SHARED, MULTIPLEX_PREFIX, PAUSE, DELETE, START, \
+    RESULTS_FAILURES, RESULTS_SAMPLED, RESULTS_SUMMARY, PAUSED, RUNNING
 
 User = get_user_model()
 
@@ -19,7 +42,7 @@ class TestTaskExecution(LiveServerTestCase):
         email = openid.decode_token(token, audience=audience)['email']
         self.service_account = User.objects.create(username=email, email=email)
 
-    def _create_step(self, url, payload, success_pattern, task=None):
+    def _create_step(self, url, payload, success_pattern, task=None, success_condition=None):
         if not task:
             task = models.Task.objects.create(name="Test Task")
         return models.Step.objects.create(
@@ -28,7 +51,8 @@ class TestTaskExecution(LiveServerTestCase):
             action=f'{self.live_server_url}{url}',
             method="GET",
             payload=payload,
-            success_pattern=success_pattern
+            success_pattern=success_pattern,
+            success_condition=success_condition,
         )
 
     def test_step_passes_without_success_pattern(self):
@@ -46,6 +70,15 @@ class TestTaskExecution(LiveServerTestCase):
         success, status, response_dict = step.execute()
         self.assertFalse(success, response_dict)
 
+    def test_step_success_condition(self):
+        step = self._create_step(reverse("tasks:test_openid_auth"), None, None,
+                                 success_condition={'pointer': '/ok', 'equals': 'You did good.'})
+        success, status, response_dict = step.execute()
+        self.assertTrue(success, response_dict)
+        step.success_condition = {'pointer': '/ok', 'equals': 'You did bad!'}
+        success, status, response_dict = step.execute()
+        self.assertFalse(success, response_dict)
+
     def test_step_fails_http_error(self):
         step = self._create_step('/blarg/', None, r'"ok":\s*"You did bad!"')
         success, status, response_dict = step.execute()
@@ -65,3 +98,739 @@ class TestTaskExecution(LiveServerTestCase):
         step2 = self._create_step('/blarg/', None, r'"ok":\s*"You did bad!"', task)
         task_execution = task.execute()
         self.assertEqual(task_execution.status, FAILURE, "One of the steps should have failed, triggering a failure.")
+
+    def test_task_resumes_from_failed_step(self):
+        task = models.Task.objects.create(name="Test Task")
+        step1 = self._create_step(reverse("tasks:test_openid_auth"), None, None, task)
+        step2 = self._create_step('/blarg/', None, None, task)
+        task_execution = task.execute()
+        self.assertEqual(task_execution.status, FAILURE, "Second step should have failed.")
+        # step 1 would fail if it were executed again
+        step1.action = f'{self.live_server_url}/blarg/'
+        step1.save()
+        step2.action = f'{self.live_server_url}{reverse("tasks:test_openid_auth")}'
+        step2.save()
+        task_execution = task.execute(task_execution.pk)
+        self.assertEqual(task_execution.status, SUCCESS, "Retry should have resumed at the second step.")
+
+    def test_loopback_session(self):
+        loopback = session.LoopbackSession(self.service_account)
+        response = loopback.get(f'{conf.ROOT_URL}{reverse("tasks:test_openid_auth")}')
+        self.assertEqual(response.status_code, http.HTTPStatus.OK)
+        self.assertEqual(response.json(), {'ok': 'You did good.'})
+        response = loopback.get(f'{conf.ROOT_URL}/blarg/')
+        self.assertEqual(response.status_code, http.HTTPStatus.NOT_FOUND)
+
+
+class TestUtils(SimpleTestCase):
+
+    def test_resolve_json_pointer(self):
+        document = {'data': {'tenant_ids': [1, 2, 3], 'a/b': 'escaped'}}
+        self.assertEqual(utils.resolve_json_pointer(document, ''), document)
+        self.assertEqual(utils.resolve_json_pointer(document, '/data/tenant_ids'), [1, 2, 3])
+        self.assertEqual(utils.resolve_json_pointer(document, '/data/tenant_ids/1'), 2)
+        self.assertEqual(utils.resolve_json_pointer(document, '/data/a~1b'), 'escaped')
+        with self.assertRaises(LookupError):
+            utils.resolve_json_pointer(document, '/data/tenant_ids/3')
+        with self.assertRaises(LookupError):
+            utils.resolve_json_pointer(document, '/missing')
+
+    def test_get_audience(self):
+        url = 'https://example.com/cloud-tasks/api/tasks/1/execute/?task_execution_id=2'
+        with mock.patch('cloud_tasks.openid.AUDIENCE_POLICY', EXACT):
+            self.assertEqual(openid.get_audience(url), 'https://example.com/cloud-tasks/api/tasks/1/execute/')
+        with mock.patch('cloud_tasks.openid.AUDIENCE_POLICY', ORIGIN):
+            self.assertEqual(openid.get_audience(url), 'https://example.com')
+        with mock.patch('cloud_tasks.openid.AUDIENCE_POLICY', PATH_PREFIX), \
+                mock.patch('cloud_tasks.openid.AUDIENCE_PREFIXES', ['/cloud-tasks/', '/cloud-tasks/api/']):
+            self.assertEqual(openid.get_audience(url), 'https://example.com/cloud-tasks/api/')
+            self.assertEqual(openid.get_audience('https://example.com/other/'), 'https://example.com/other/')
+
+    def test_evaluate_conditions(self):
+        document = {'status': 'done', 'data': {'count': 3, 'ids': [1, 2, 3]}}
+        context = {}
+        success, _ = responses.evaluate_conditions([
+            {'pointer': '/status', 'equals': 'done', 'capture': 'status'},
+            {'pointer': '/data/count', 'gte': 3},
+            {'pointer': '/data/ids', 'contains': 2},
+            {'pointer': '/error', 'exists': False},
+        ], document, context)
+        self.assertTrue(success)
+        self.assertEqual(context, {'status': 'done'})
+        success, reason = responses.evaluate_conditions({'pointer': '/data/count', 'lt': 'three'}, document)
+        self.assertFalse(success, reason)
+        success, reason = responses.evaluate_conditions({'pointer': '/missing', 'equals': None}, document)
+        self.assertFalse(success, reason)
+        with self.assertRaises(ValueError):
+            responses.validate_conditions({'pointer': '/status', 'equal': 'done'})
+        # a misspelled operator fails the step instead of being ignored
+        success, reason = responses.evaluate_conditions({'pointer': '/status', 'equal': 'failed'}, document)
+        self.assertFalse(success)
+        self.assertIn('equal', reason)
+        serializer = StepSerializer(data={'success_condition': {'pointer': '/status', 'equal': 'done'}})
+        self.assertFalse(serializer.is_valid())
+        self.assertIn('success_condition', serializer.errors)
+
+    def test_response_cache(self):
+        response_cache = cache.ResponseCache(max_size=1)
+        requests = []
+
+        def request(headers):
+            requests.append(headers)
+            status_code = 304 if headers else 200
+            return SimpleNamespace(status_code=status_code, headers={'ETag': '"v1"'})
+
+        response, status = response_cache.fetch('a', 60, request)
+        self.assertEqual((response.status_code, status), (200, CACHE_MISS))
+        response, status = response_cache.fetch('a', 60, request)
+        self.assertEqual((response.status_code, status), (200, CACHE_HIT))
+        response, status = response_cache.fetch('b', 0, request)
+        self.assertEqual(status, CACHE_MISS)
+        # 'a' was evicted; 'b' is stale and revalidated
+        response, status = response_cache.fetch('b', 0, request)
+        self.assertEqual((response.status_code, status), (200, CACHE_REVALIDATED))
+        self.assertEqual(requests[-1], {'If-None-Match': '"v1"'})
+        self.assertEqual(response_cache.fetch('a', 60, request)[1], CACHE_MISS)
+
+    def test_response_cache_single_flight(self):
+        response_cache = cache.ResponseCache(max_size=8)
+        started, statuses = threading.Semaphore(0), []
+
+        def request(headers):
+            # hold the request open until the other threads are waiting on it
+            for _ in range(3):
+                started.acquire(timeout=5)
+            time.sleep(0.1)
+            return SimpleNamespace(status_code=500, headers={})
+
+        def fetch():
+            started.release()
+            statuses.append(response_cache.fetch('a', 60, request)[1])
+
+        threads = [threading.Thread(target=fetch) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(statuses), [CACHE_MISS, CACHE_SHARED, CACHE_SHARED])
+
+    def test_token_bucket(self):
+        bucket = throttle.TokenBucket(rate=10, burst=2)
+        self.assertEqual(bucket.consume(), 0)
+        self.assertEqual(bucket.consume(), 0)
+        self.assertAlmostEqual(bucket.consume(), 0.1, places=2)
+
+    def test_host_budget(self):
+        limits = {'https://partner.example.com': {'rate': 1, 'burst': 1, 'concurrency': 1}}
+        with mock.patch('cloud_tasks.throttle.RATE_LIMITS', limits), \
+                mock.patch('cloud_tasks.throttle.RATE_LIMIT_MAX_WAIT', 0):
+            with throttle.host_budget('https://partner.example.com/a/'):
+                with self.assertRaises(throttle.RateLimited):
+                    with throttle.host_budget('https://partner.example.com/b/'):
+                        pass
+            with self.assertRaises(throttle.RateLimited):
+                with throttle.host_budget('https://partner.example.com/c/'):
+                    pass
+            with throttle.host_budget('https://other.example.com/'):
+                pass
+
+    def test_concurrency_slots(self):
+        origin = 'https://slots.example.com'
+        first, second = throttle._acquire_slot(origin, 2), throttle._acquire_slot(origin, 2)
+        self.assertIsNotNone(first)
+        self.assertIsNotNone(second)
+        self.assertIsNone(throttle._acquire_slot(origin, 2))
+        # the lease of the first holder expires and its slot is taken over
+        caches[conf.RATE_LIMIT_CACHE].delete(first[0])
+        third = throttle._acquire_slot(origin, 2)
+        self.assertEqual(third[0], first[0])
+        # the late release of the expired lease does not free the slot of its new holder
+        throttle._release_slot(first)
+        self.assertIsNone(throttle._acquire_slot(origin, 2))
+        throttle._release_slot(second)
+        throttle._release_slot(third)
+        fourth = throttle._acquire_slot(origin, 2)
+        self.assertIsNotNone(fourth)
+        throttle._release_slot(fourth)
+
+    def test_admission_controller(self):
+        controller = admission.AdmissionController(limit=1, retry_after=10)
+        with controller.admit():
+            with self.assertRaises(admission.ExecutionsSaturated) as raised:
+                with controller.admit():
+                    pass
+            self.assertEqual(raised.exception.wait, 10)
+        with controller.admit():
+            pass
+        self.assertEqual(controller.stats(), {
+            'limit': 1, 'in_flight': 0, 'peak_in_flight': 1, 'admitted': 2, 'rejected': 1,
+        })
+
+    def test_clock_run_offsets(self):
+        clock = models.Clock(name='fast', cron='* * * * *', interval_seconds=15)
+        with mock.patch.object(models, 'USE_CLOUD_TASKS', True):
+            self.assertEqual(clock.run_offsets, [0, 15, 30, 45])
+            clock.interval_seconds = 25
+            self.assertEqual(clock.run_offsets, [0, 25, 50])
+        with mock.patch.object(models, 'USE_CLOUD_TASKS', False):
+            self.assertEqual(clock.run_offsets, [0])
+        clock.interval_seconds = 60
+        with self.assertRaises(ValidationError):
+            clock.clean()
+
+    def test_schedule_stagger_offset(self):
+        clock = models.Clock(name='hourly', cron='0 * * * *', stagger_seconds=30)
+        schedules = [models.TaskSchedule(pk=pk, name=f'schedule-{pk}', clock=clock) for pk in range(1, 50)]
+        with mock.patch.object(models, 'USE_CLOUD_TASKS', True):
+            offsets = [schedule.stagger_offset for schedule in schedules]
+            self.assertEqual(offsets, [schedule.stagger_offset for schedule in schedules])
+            self.assertTrue(all(0 <= offset <= 30 for offset in offsets))
+            self.assertGreater(len(set(offsets)), 1)
+            clock.interval_seconds = 10
+            self.assertTrue(all(0 <= schedule.stagger_offset < 10 for schedule in schedules))
+            schedules[0].stagger_seconds = 0
+            self.assertEqual(schedules[0].stagger_offset, 0)
+        with mock.patch.object(models, 'USE_CLOUD_TASKS', False):
+            self.assertEqual(schedules[1].stagger_offset, 0)
+
+    def test_clock_multiplex_name(self):
+        hourly = models.Clock(name='Hourly', cron='0 * * * *', timezone='UTC', multiplexed=True).clean()
+        also_hourly = models.Clock(name='Also Hourly', cron='0 * * * *', timezone='UTC', multiplexed=True).clean()
+        daily = models.Clock(name='Daily', cron='0 0 * * *', timezone='UTC', multiplexed=True).clean()
+        self.assertEqual(hourly.gcp_name, also_hourly.gcp_name)
+        self.assertNotEqual(hourly.gcp_name, daily.gcp_name)
+        self.assertTrue(hourly.gcp_name.startswith(MULTIPLEX_PREFIX))
+        hourly.multiplexed = False
+        self.assertEqual(hourly.clean().gcp_name, 'Hourly')
+        self.assertEqual(reverse('cloud_tasks:clock-multiplex-tick', kwargs={'group': also_hourly.gcp_name}),
+                         f'/cloud-tasks/api/clocks/multiplex/{also_hourly.gcp_name}/tick/')
+
+    def test_split_id_ranges(self):
+        self.assertEqual(utils.split_id_ranges([1, 2, 3, 7, 8, 9, 10], 3), [(1, 2), (3, 7), (8, 10)])
+        self.assertEqual(utils.split_id_ranges([4, 5], 3), [(4, 4), (5, 5)])
+        self.assertEqual(utils.split_id_ranges([], 3), [])
+
+    def test_get_queue(self):
+        lanes = {'urgent': 'tasks-urgent', 'bulk': ['tasks-bulk-0', 'tasks-bulk-1', 'tasks-bulk-2']}
+        with mock.patch.object(gtasks, 'QUEUES', lanes), mock.patch.object(gtasks, 'QUEUE', 'tasks'):
+            self.assertEqual(gtasks.get_queue(), 'tasks')
+            self.assertEqual(gtasks.get_queue('urgent', key=1), 'tasks-urgent')
+            self.assertEqual(gtasks.get_queue('other-queue'), 'other-queue')
+            shards = {gtasks.get_queue('bulk', key=key) for key in range(50)}
+            self.assertEqual(shards, set(lanes['bulk']))
+            self.assertEqual(gtasks.get_queue('bulk', key=7), gtasks.get_queue('bulk', key=7))
+
+    def test_queue_config(self):
+        queue = models.Queue(name='tasks-bulk', max_dispatches_per_second=5, max_attempts=3, min_backoff=1.5)
+        self.assertEqual(queue._config(queue.RATE_LIMIT_FIELDS), {'max_dispatches_per_second': 5})
+        self.assertEqual(queue._config(queue.RETRY_CONFIG_FIELDS), {
+            'max_attempts': 3, 'min_backoff': {'seconds': 1, 'nanos': 500000000},
+        })
+        # the burst size is picked by Cloud Tasks, and only read back
+        synced = SimpleNamespace(rate_limits=SimpleNamespace(max_burst_size=6))
+        with mock.patch.object(gtasks, 'ensure_queue', return_value=synced) as ensure_queue, \
+                mock.patch.object(models.Queue, 'save'):
+            self.assertTrue(queue.sync_queue()[0])
+        self.assertNotIn('max_burst_size', ensure_queue.call_args[0][1])
+        self.assertEqual(queue.max_burst_size, 6)
+
+    def test_backlog_summary(self):
+        old = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+        new = datetime.datetime(2020, 1, 2, tzinfo=datetime.timezone.utc)
+        tasks = [
+            {'url': 'https://example.com/tasks/1/execute/?task_execution_id=1', 'schedule_time': new},
+            {'url': 'https://example.com/tasks/1/execute/?task_execution_id=2', 'schedule_time': old},
+            {'url': 'https://example.com/clocks/1/tick/', 'schedule_time': new},
+        ]
+        with mock.patch.object(gtasks, 'list_tasks', return_value=iter(tasks)):
+            backlog = gtasks.get_backlog('tasks')
+        self.assertEqual(backlog['tasks'], 3)
+        self.assertEqual(backlog['oldest_schedule_time'], old)
+        self.assertGreater(backlog['oldest_age'], 0)
+        self.assertEqual(backlog['urls'], {
+            'https://example.com/tasks/1/execute/': 2, 'https://example.com/clocks/1/tick/': 1,
+        })
+
+    def test_clock_sync_coalesced(self):
+        clock = models.Clock(pk=1, name='hourly', cron='0 * * * *')
+        callbacks = []
+        with mock.patch.object(models.transaction, 'on_commit', callbacks.append), \
+                mock.patch.object(models._clock_syncs, 'pool') as pool:
+            clock.schedule_sync(is_new=True)
+            clock.schedule_sync(previous_gcp_name='hourly')
+            for callback in callbacks:
+                callback()
+        pool.submit.assert_called_once_with(models._clock_syncs.run, 1)
+        self.assertEqual(models._clock_syncs.pending.pop(1), (True, None))
+
+    def test_background_sync_resyncs_dirty(self):
+        synced = []
+
+        def sync(pk, state):
+            synced.append(state)
+            if len(synced) == 1:
+                # saved twice while the first sync runs
+                background.schedule(pk, 'second')
+                background.schedule(pk, 'third')
+                self.assertTrue(background.is_dirty(pk))
+
+        background = models.BackgroundSync('thing', sync, None)
+        with mock.patch.object(models.transaction, 'on_commit', lambda func: func()):
+            background.schedule(1, 'first')
+        self.assertEqual(synced, ['first', 'second'])
+        self.assertEqual((background.pending, background.running, background.dirty), ({}, set(), {}))
+
+    def test_clock_sync_pending_kept_while_dirty(self):
+        clock = mock.Mock()
+        clock.sync_job.return_value = (True, 'synced')
+        with mock.patch.object(models.Clock, 'objects') as objects, \
+                mock.patch.object(models._clock_syncs, 'is_dirty', return_value=True):
+            objects.filter.return_value.first.return_value = clock
+            models._sync_clock(1, (False, 'hourly'))
+            objects.filter.return_value.update.assert_not_called()
+        clock.sync_job.assert_called_once_with(False, 'hourly')
+        with mock.patch.object(models.Clock, 'objects') as objects:
+            objects.filter.return_value.first.return_value = clock
+            models._sync_clock(1, (False, 'hourly'))
+            objects.filter.return_value.update.assert_called_once_with(sync_pending=False)
+
+    def test_queue_save_syncs_in_background(self):
+        queue = models.Queue(pk=1, name='tasks-bulk')
+        callbacks = []
+        with mock.patch.object(models.models.Model, 'save'), \
+                mock.patch.object(models.transaction, 'on_commit', callbacks.append), \
+                mock.patch.object(models._queue_syncs, 'pool') as pool, \
+                mock.patch.object(gtasks, 'ensure_queue') as ensure_queue:
+            queue.save()
+            queue.save()
+            ensure_queue.assert_not_called()
+            for callback in callbacks:
+                callback()
+        pool.submit.assert_called_once_with(models._queue_syncs.run, 1)
+        self.assertIsNone(models._queue_syncs.pending.pop(1))
+
+    def test_clock_bulk_action(self):
+        def clock(pk, outcome):
+            _clock = mock.Mock(pk=pk, multiplexed=False)
+            _clock.name = f'clock-{pk}'
+            _clock.apply_action.side_effect = outcome
+            return _clock
+        clocks = [clock(1, [(True, 'paused')]), clock(2, ValueError('quota')), clock(3, [(False, 'not found')])]
+        results = models.Clock.bulk_action(clocks, PAUSE, workers=2)
+        self.assertEqual([result['id'] for result in results], [1, 2, 3])
+        self.assertEqual([result['success'] for result in results], [True, False, False])
+        self.assertIn('quota', results[1]['message'])
+        for _clock in clocks:
+            _clock.apply_action.assert_called_once_with(PAUSE)
+        with self.assertRaises(ValueError):
+            models.Clock.bulk_action(clocks, 'explode')
+
+    def test_clock_bulk_action_shared_job(self):
+        clocks = [models.Clock(pk=pk, name=f'clock-{pk}', gcp_name='every-hour', multiplexed=True, status=PAUSED)
+                  for pk in (1, 2)]
+        clocks.append(models.Clock(pk=3, name='clock-3', gcp_name='every-day', multiplexed=True, status=PAUSED))
+        with mock.patch.object(models.Clock, 'save') as save, \
+                mock.patch.object(models.Clock, 'objects'), \
+                mock.patch.object(models.Clock, 'reconcile_job', return_value=(True, 'reconciled')) as reconcile_job:
+            results = models.Clock.bulk_action(clocks, START, workers=2)
+        self.assertEqual(sorted(call[0][0] for call in reconcile_job.call_args_list), ['every-day', 'every-hour'])
+        self.assertEqual(save.call_count, 3)
+        self.assertEqual([clock.status for clock in clocks], [RUNNING] * 3)
+        self.assertEqual([result['id'] for result in results], [1, 2, 3])
+        self.assertTrue(all(result['success'] for result in results))
+
+    def test_token_bucket_acquire(self):
+        bucket = throttle.TokenBucket(rate=100, burst=1)
+        start = time.monotonic()
+        for _ in range(3):
+            bucket.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.015)
+
+    def test_replica_router(self):
+        replica_router = routers.ReplicaRouter()
+        with mock.patch.object(routers, 'READ_REPLICA', 'replica'), \
+                mock.patch.object(routers, 'replica_is_fresh', return_value=True) as replica_is_fresh:
+            with routers.pinning_scope():
+                self.assertEqual(replica_router.db_for_read(models.TaskExecution), 'replica')
+                self.assertIsNone(replica_router.db_for_read(get_user_model()))
+                replica_is_fresh.return_value = False
+                self.assertIsNone(replica_router.db_for_read(models.TaskExecution))
+                replica_is_fresh.return_value = True
+                self.assertIsNone(replica_router.db_for_write(models.TaskExecution))
+                # reads after a write see the write
+                self.assertIsNone(replica_router.db_for_read(models.TaskExecution))
+            with routers.pinning_scope():
+                self.assertEqual(replica_router.db_for_read(models.TaskExecution), 'replica')
+            self.assertFalse(replica_router.allow_migrate('replica', 'cloud_tasks'))
+        with routers.pinning_scope(), \
+                mock.patch('django.db.router.routers', [replica_router]):
+            self.assertEqual(routers.primary_alias(models.TaskExecution), 'default')
+            self.assertFalse(routers.is_pinned())
+
+    def test_approximate_count_paginator(self):
+        queryset = models.TaskExecution.objects.order_by('-queued_time')
+        with mock.patch.object(paginators, 'estimate_count', return_value=2000000):
+            paginator = paginators.ApproximateCountPaginator(queryset, 100)
+            self.assertEqual(paginator.count, 2000000)
+            self.assertEqual(paginator.num_pages, 20000)
+        # small and non-queryset lists are counted exactly
+        self.assertEqual(paginators.ApproximateCountPaginator([1, 2, 3], 2).num_pages, 2)
+
+    def test_step_snapshots(self):
+        step = models.Step(pk=7, name='ping', action='https://example.com/ping/', payload={'b': 1, 'a': 2})
+        with mock.patch.object(models.StepSnapshot, 'objects') as objects, \
+                mock.patch.object(models.StepSnapshot, '_known', set()), \
+                mock.patch.object(models.transaction, 'on_commit', lambda func, using=None: func()):
+            summary = step.summary()
+            self.assertEqual(step.summary(), summary)
+            objects.get_or_create.assert_called_once()
+            definition = objects.get_or_create.call_args[1]['defaults']['definition']
+            self.assertEqual(summary, {'id': 7, 'name': 'ping', 'snapshot': summary['snapshot']})
+            objects.filter.return_value.values_list.return_value = [(summary['snapshot'], definition)]
+            results = {'steps': [{'summary': summary, 'response': {'success': True}}], 'num_steps': 1}
+            expanded = models.StepSnapshot.expand(results)
+        self.assertEqual(expanded['steps'][0]['summary']['action'], 'https://example.com/ping/')
+        self.assertEqual(expanded['steps'][0]['summary']['snapshot'], summary['snapshot'])
+        self.assertEqual(expanded['num_steps'], 1)
+        self.assertNotIn('action', results['steps'][0]['summary'])
+        self.assertEqual(len(summary['snapshot']), 64)
+        # a snapshot stored in a transaction that rolls back is stored again by the next summary
+        with mock.patch.object(models.StepSnapshot, 'objects') as objects, \
+                mock.patch.object(models.StepSnapshot, '_known', set()), \
+                mock.patch.object(models.transaction, 'on_commit') as on_commit:
+            step.summary()
+            step.summary()
+            self.assertEqual(objects.get_or_create.call_count, 2)
+            on_commit.call_args[0][0]()
+            step.summary()
+            self.assertEqual(objects.get_or_create.call_count, 2)
+
+    def test_task_execution_filters(self):
+        request = APIRequestFactory().get('/', {
+            'failed_step': '3', 'failed_status_min': '500', 'results_contains': '{"all_completed": false}',
+        })
+        view = TaskExecutionViewSet(action='list', request=Request(request), format_kwarg=None)
+        sql = str(view.get_queryset().query)
+        self.assertIn('"failed_step_id" = 3', sql)
+        self.assertIn('"failed_status" >= 500', sql)
+        self.assertIn('@>', sql)
+        view.request = Request(APIRequestFactory().get('/', {'results_contains': '{'}))
+        with self.assertRaises(APIValidationError):
+            view.get_queryset()
+
+    def test_task_results_policy(self):
+        results = {'steps': [{'summary': {'id': 1}}], 'num_steps': 1, 'all_completed': True}
+        executions = [models.TaskExecution(pk=pk) for pk in range(1, 11)]
+        task = models.Task(name='busy')
+        self.assertEqual(task.retained_results(executions[0], results, True), results)
+        task.results_policy = RESULTS_FAILURES
+        self.assertEqual(task.retained_results(executions[0], results, False), results)
+        self.assertEqual(task.retained_results(executions[0], results, True), {
+            'num_steps': 1, 'all_completed': True, 'steps_retained': False,
+        })
+        task.results_policy, task.results_sample_rate = RESULTS_SAMPLED, 5
+        kept = [execution.pk for execution in executions if 'steps' in task.retained_results(execution, results, True)]
+        self.assertEqual(kept, [5, 10])
+        task.results_policy = RESULTS_SUMMARY
+        summary = task.retained_results(executions[0], results, False)
+        self.assertNotIn('steps', summary)
+        # a retry resumes after the steps that succeeded, even though their results were not kept
+        steps = [models.Step(pk=pk) for pk in (1, 2, 3)]
+        failed = models.TaskExecution(pk=11, results=summary, steps_completed=2)
+        self.assertEqual(failed.resume_index(steps), 2)
+        # the content of a map source is kept for a retry, the content of other steps is not
+        content = {'success': True, 'status': 200, 'content': [1, 2], 'is_json': True}
+        results = {'steps': [{'summary': {'id': 1}, 'response': content}, {'summary': {'id': 2}, 'response': content},
+                             {'summary': {'id': 3}, 'response': {**content, 'success': False}}]}
+        summary = task.retained_results(executions[0], results, False, map_sources={1})
+        self.assertFalse(summary['steps_retained'])
+        self.assertEqual(summary['steps'][0], results['steps'][0])
+        self.assertIsNone(summary['steps'][1]['response']['content'])
+        self.assertTrue(summary['steps'][1]['response']['success'])
+        failed = models.TaskExecution(pk=12, results=summary, steps_completed=2)
+        self.assertEqual(failed.resume_index(steps), 2)
+        steps[2].map_source_id = 1
+        self.assertEqual(steps[2].map_items(summary), [1, 2])
+        self.assertEqual(task.progress_results(results, {1})['steps'], summary['steps'])
+        self.assertNotIn('steps', task.retained_results(executions[0], results, True, map_sources={1}))
+
+    def test_archive_ndjson(self):
+        queued_time = datetime.datetime(2020, 5, 31, 23, 59, tzinfo=datetime.timezone.utc)
+        row = archive._row({'id': 1, 'queued_time': queued_time, 'duration': datetime.timedelta(seconds=1.5),
+                            'results': {'num_steps': 1}})
+        self.assertEqual(row['duration'], 1.5)
+        self.assertEqual(queued_time.strftime(archive.PARTITION_FORMATS['day']), '2020-05-31')
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'task_executions-1-2.ndjson.gz')
+            archive._write_ndjson(path, [row, {**row, 'id': 2}])
+            with gzip.open(path, 'rb') as file:
+                lines = [fastjson.loads(line) for line in file]
+        self.assertEqual([line['id'] for line in lines], [1, 2])
+        self.assertEqual(lines[0]['results'], {'num_steps': 1})
+        self.assertTrue(lines[0]['queued_time'].startswith('2020-05-31T23:59:00'))
+        with self.assertRaises(ValueError):
+            archive.export_executions('/tmp', file_format='csv')
+
+    def test_archive_delete(self):
+        queued_time = datetime.datetime(2020, 5, 31, tzinfo=datetime.timezone.utc)
+        results = {'steps': [{'summary': {'id': 1, 'snapshot': 'abc'}, 'response': {'success': True}}]}
+        rows = [{'id': pk, 'queued_time': queued_time, 'duration': None, 'status': SUCCESS, 'results': results}
+                for pk in (3, 7)]
+        executions, ranges, deleted = mock.Mock(), [[3, 7, 9], []], mock.Mock()
+
+        def filter_executions(**lookups):
+            if 'pk__gt' in lookups:
+                return mock.Mock(**{'order_by.return_value.values_list.return_value': ranges.pop(0)})
+            if 'pk__gte' in lookups:
+                # execution 5 was committed into the range after its ids were read, and 9 is not finished anymore
+                return mock.Mock(**{'order_by.return_value.values.return_value.iterator.return_value': iter(rows)})
+            return deleted
+
+        executions.filter.side_effect = filter_executions
+        with mock.patch.object(archive.TaskExecution, 'objects') as objects, \
+                mock.patch.object(archive.StepSnapshot, 'objects') as snapshots, \
+                tempfile.TemporaryDirectory() as directory:
+            objects.filter.return_value = executions
+            snapshots.filter.return_value.values_list.return_value = [('abc', {'id': 1, 'action': 'https://a.b/'})]
+            files = archive.export_executions(directory, delete=True)
+            with gzip.open(files[0]['path'], 'rb') as file:
+                lines = [fastjson.loads(line) for line in file]
+        self.assertIn(('status__in', (SUCCESS, FAILURE)), objects.filter.call_args[0][0].children)
+        self.assertEqual([file['executions'] for file in files], [2])
+        # the archive holds the definitions of the steps, read in one query per range
+        snapshots.filter.assert_called_once_with(hash__in={'abc'})
+        self.assertEqual(lines[1]['results']['steps'][0]['summary']['action'], 'https://a.b/')
+        # only the executions that were written are deleted
+        executions.filter.assert_any_call(pk__in=[3, 7])
+        deleted.delete.assert_called_once_with()
+
+    def test_stepwise_handoffs(self):
+        task = models.Task(pk=1, name='pipeline', dispatch=STEPWISE)
+        steps = [models.Step(pk=pk, name=f'step {pk}') for pk in (1, 2, 3)]
+        task_execution = models.TaskExecution(pk=5, task=task, queue='default')
+        manager = mock.Mock()
+        manager.all.return_value.order_by.return_value = steps
+        handoffs = []
+
+        def create_task(url, name, **kwargs):
+            # Cloud Tasks rejects a second task with the same name
+            if name in handoffs:
+                raise AlreadyExists(name)
+            handoffs.append(name)
+
+        def execute_step(step, **kwargs):
+            return True, 200, {'summary': {'id': step.pk}, 'response': {'success': True}}
+
+        with mock.patch.object(models, 'USE_CLOUD_TASKS', True), \
+                mock.patch.object(models.Task, 'steps', property(lambda obj: manager)), \
+                mock.patch.object(models.TaskExecution, 'objects') as objects, \
+                mock.patch.object(models.TaskExecution, 'save'), \
+                mock.patch.object(models.Step, 'execute', autospec=True, side_effect=execute_step) as step_execute, \
+                mock.patch.object(gtasks, 'create_task', side_effect=create_task):
+            objects.using.return_value.get.return_value = task_execution
+            task.enqueue(task_execution)
+            self.assertEqual(handoffs, ['pipeline__5__step-0'])
+            # each callback runs one step and hands off the next one
+            task.execute(task_execution.pk, step=0)
+            self.assertEqual(step_execute.call_count, 1)
+            self.assertEqual(handoffs[-1], 'pipeline__5__step-1')
+            self.assertEqual(task_execution.status, STARTED)
+            # a duplicate delivery runs nothing and does not hand off the next step again
+            task.execute(task_execution.pk, step=0)
+            self.assertEqual(step_execute.call_count, 1)
+            self.assertEqual(len(handoffs), 2)
+            task.execute(task_execution.pk, step=1)
+            task.execute(task_execution.pk, step=2)
+            self.assertEqual(step_execute.call_count, 3)
+            self.assertEqual(len(handoffs), 3)
+            self.assertEqual(task_execution.status, SUCCESS)
+
+    def test_map_step(self):
+        step = models.Step(pk=2, name='per tenant', action='https://example.com/tenants/{{item}}/', method='POST',
+                           map_source_id=1, map_pointer='/ids', map_concurrency=3)
+        source = {'summary': {'id': 1}, 'response': {'is_json': True, 'content': {'ids': list(range(10))}}}
+        results = {'steps': [source]}
+        lock, requested, in_flight = threading.Lock(), [], []
+        max_in_flight = [0]
+
+        class Session:
+            failing, rate_limited = (), ()
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc_info):
+                return False
+
+            def post(self, url, json=None):
+                item = int(url.rstrip('/').rsplit('/', 1)[1])
+                with lock:
+                    requested.append(item)
+                    in_flight.append(item)
+                    max_in_flight[0] = max(max_in_flight[0], len(in_flight))
+                time.sleep(0.01)
+                with lock:
+                    in_flight.remove(item)
+                if item in Session.rate_limited:
+                    raise throttle.RateLimited(wait=3)
+                status = 500 if item in Session.failing else 200
+                return SimpleNamespace(status_code=status, headers={'Content-Type': 'application/json'},
+                                       content=b'{}', text='{}')
+
+        with mock.patch.object(models.requests, 'create_session', return_value=Session()), \
+                mock.patch.object(throttle, 'host_budget', lambda url: contextlib.nullcontext()):
+            summary, success, status, content, reason = step.execute_map({'id': 2}, {}, results)
+            self.assertTrue(success)
+            self.assertEqual(sorted(requested), list(range(10)))
+            self.assertLessEqual(max_in_flight[0], 3)
+            self.assertEqual(content, {'items': 10, 'succeeded': 10, 'failed': 0, 'skipped': 0, 'failures': []})
+
+            # failures up to the threshold are tolerated; past it the remaining items are skipped
+            step.map_concurrency, step.map_failure_threshold = 1, 1
+            Session.failing = (1, 3, 5)
+            requested.clear()
+            summary, success, status, content, reason = step.execute_map({'id': 2}, {}, results)
+            self.assertFalse(success)
+            self.assertEqual(status, 500)
+            self.assertEqual(content['failed'], 2)
+            self.assertEqual([failure['index'] for failure in content['failures']], [1, 3])
+            self.assertEqual(content['succeeded'] + content['failed'] + content['skipped'], 10)
+            self.assertGreaterEqual(content['skipped'], 4)
+            self.assertIn('2 of 10 items failed', reason)
+
+            # a rate limited item defers the items that have not started, and the items that were requested are
+            # not requested again
+            Session.failing, Session.rate_limited = (), (2, )
+            requested.clear()
+            with self.assertRaises(throttle.RateLimited) as raised:
+                step.execute_map({'id': 2}, {}, results)
+            self.assertLess(len(requested), 10)
+            progress = raised.exception.map_progress
+            self.assertEqual(set(progress['succeeded']) | {2}, set(requested))
+            Session.rate_limited = ()
+            first_attempt, requested[:] = list(requested), []
+            summary, success, status, content, reason = step.execute_map(
+                {'id': 2}, {}, {**results, 'map_progress': {'2': progress}})
+            self.assertTrue(success)
+            self.assertEqual(content['succeeded'], 10)
+            self.assertEqual(set(requested) & set(progress['succeeded']), set())
+            self.assertEqual(sorted(requested + progress['succeeded']), list(range(10)))
+            self.assertIn(2, requested)
+            self.assertIn(2, first_attempt)
+
+    def test_map_step_url(self):
+        url = models.render_template('https://example.com/search/?q={{item.q}}&page={{index}}',
+                                     {'item': models.url_quoted({'q': 'a&b c/d'}), 'index': 1}, autoescape=False)
+        self.assertEqual(url, 'https://example.com/search/?q=a%26b%20c%2Fd&page=1')
+        self.assertEqual(models.render_template('{{item}}', {'item': 'a&b'}), 'a&amp;b')
+
+    def test_fastjson(self):
+        queued_time = datetime.datetime(2020, 5, 31, 23, 59, 30, tzinfo=datetime.timezone.utc)
+        # orjson when it is installed, and the standard library otherwise
+        for backend in {fastjson.orjson, None}:
+            with mock.patch.object(fastjson, 'orjson', backend):
+                self.assertEqual(fastjson.loads(fastjson.dumpb({'a': [1, 2.5, None, True]})),
+                                 {'a': [1, 2.5, None, True]})
+                self.assertTrue(fastjson.loads(fastjson.dumpb(queued_time)).startswith('2020-05-31T23:59:30'))
+                self.assertEqual(fastjson.loads(fastjson.dumps({1: 'a', 'label': gettext_lazy('ok')})),
+                                 {'1': 'a', 'label': 'ok'})
+                # integers wider than 64 bits, which orjson cannot encode
+                self.assertIn(b'1180591620717411303424', fastjson.dumpb({'n': 2 ** 70}))
+                self.assertIn('\n  "a": 1', fastjson.dumps({'a': 1}, indent=True))
+                # canonical form for hashing, the same with either backend
+                self.assertEqual(fastjson.dumps({'b': [1, 2], 'a': 'é'}, sort_keys=True), '{"a":"é","b":[1,2]}')
+                self.assertEqual(fastjson.loads(bytearray(b'[1]')), [1])
+                with self.assertRaises(fastjson.JSONDecodeError):
+                    fastjson.loads('{')
+                with self.assertRaises(TypeError):
+                    fastjson.loads(None)
+
+    def test_fast_json_renderer_and_parser(self):
+        data = {'id': 1, 'results': {'steps': [{'summary': {'id': 2}}]}, 'queued_time': datetime.date(2020, 5, 31)}
+        body = FastJSONRenderer().render(data)
+        self.assertEqual(FastJSONParser().parse(io.BytesIO(body)), {**data, 'queued_time': '2020-05-31'})
+        self.assertEqual(FastJSONRenderer().render(None), b'')
+        with self.assertRaises(ParseError):
+            FastJSONParser().parse(io.BytesIO(b'{"id": '))
+
+    def test_clock_bulk_endpoint(self):
+        view = ClockViewSet.as_view({'post': 'bulk'})
+        timekeeper = mock.Mock(is_authenticated=True, has_perm=lambda perm: perm == 'cloud_tasks.timekeeper')
+
+        def post(data, user=timekeeper):
+            request = APIRequestFactory().post('/', data, format='json')
+            force_authenticate(request, user=user)
+            return view(request)
+
+        with mock.patch.object(models.Clock, 'bulk_action', return_value=[]) as bulk_action:
+            # the clocks are given explicitly, or all of them on request
+            self.assertEqual(post({'action': PAUSE}).status_code, 400)
+            self.assertEqual(post({'action': PAUSE, 'ids': [1, 2]}).status_code, 200)
+            self.assertEqual(post({'action': PAUSE, 'all': True}).status_code, 200)
+            self.assertEqual(bulk_action.call_count, 2)
+            # deleting also requires the permission to delete clocks
+            self.assertEqual(post({'action': DELETE, 'ids': [1]}).status_code, 403)
+            self.assertEqual(bulk_action.call_count, 2)
+            deleter = mock.Mock(is_authenticated=True, has_perm=lambda perm: True)
+            self.assertEqual(post({'action': DELETE, 'ids': [1]}, user=deleter).status_code, 200)
+
+    def test_execution_progress(self):
+        task = models.Task(pk=2, name='inline')
+        steps = [models.Step(pk=pk, name=f'step {pk}') for pk in (1, 2, 3)]
+        # the third step maps over the response of the first one
+        steps[2].map_source_id = 1
+        task_execution = models.TaskExecution(pk=6, task=task, queue='default')
+        manager = mock.Mock()
+        manager.all.return_value.order_by.return_value = steps
+        writes = []
+
+        def execute_step(step, **kwargs):
+            return True, 200, {'summary': {'id': step.pk}, 'response': {'success': True}}
+
+        def save(execution, update_fields=None, **kwargs):
+            writes.append(update_fields)
+
+        with mock.patch.object(models, 'USE_CLOUD_TASKS', True), \
+                mock.patch.object(models.Task, 'steps', property(lambda obj: manager)), \
+                mock.patch.object(models.TaskExecution, 'objects') as objects, \
+                mock.patch.object(models.TaskExecution, 'save', autospec=True, side_effect=save), \
+                mock.patch.object(models.Step, 'execute', autospec=True, side_effect=execute_step):
+            objects.using.return_value.get.return_value = task_execution
+            task.execute(task_execution.pk)
+        self.assertEqual(task_execution.status, SUCCESS)
+        # the results are only written along with the progress of the map source, and at the end
+        self.assertEqual(writes, [None, ['steps_completed', 'context', 'results'], ['steps_completed', 'context'],
+                                  None])
+        # stepwise callbacks under the summary policy only write the trimmed results of the map source
+        task.dispatch, task.results_policy = STEPWISE, RESULTS_SUMMARY
+        writes.clear()
+        task_execution = models.TaskExecution(pk=9, task=task, queue='default')
+        with mock.patch.object(models, 'USE_CLOUD_TASKS', True), \
+                mock.patch.object(models.Task, 'steps', property(lambda obj: manager)), \
+                mock.patch.object(models.Task, 'enqueue'), \
+                mock.patch.object(models.TaskExecution, 'objects') as objects, \
+                mock.patch.object(models.TaskExecution, 'save', autospec=True, side_effect=save), \
+                mock.patch.object(models.Step, 'execute', autospec=True, side_effect=execute_step):
+            objects.using.return_value.get.return_value = task_execution
+            task.execute(task_execution.pk, step=0)
+            task.execute(task_execution.pk, step=1)
+        self.assertEqual(writes, [None, ['steps_completed', 'context', 'results'], None,
+                                  ['steps_completed', 'context']])
+        self.assertEqual(len(task_execution.results['steps']), 1)
+        # an attempt that was interrupted resumes after the steps it counted
+        interrupted = models.TaskExecution(pk=7, results={'steps': [{'summary': {'id': 1},
+                                                                       'response': {'success': True}}]},
+                                           steps_completed=2)
+        self.assertEqual(interrupted.resume_index(steps), 2)
+        self.assertEqual(models.TaskExecution(pk=8).resume_index(steps), 0)
+
+    def test_execute_callback_params(self):
+        view = TaskViewSet.as_view({'post': 'execute'})
+        request = APIRequestFactory().post('/?task_execution_id=5&step=one')
+        force_authenticate(request, user=mock.Mock(is_authenticated=True, has_perm=lambda perm: True))
+        with mock.patch.object(TaskViewSet, 'get_object', return_value=models.Task(pk=1)), \
+                mock.patch.object(models.Task, 'execute') as execute:
+            response = view(request, pk=1)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('step', response.data)
+        execute.assert_not_called()
@@ -0,0 +1,184 @@
+"""
+Per-host rate limits and concurrency budgets for step requests, configured with `TASKS_RATE_LIMITS`:
+
+    TASKS_RATE_LIMITS = {
+        'https://partner.example.com': {'rate': 10, 'burst': 20, 'concurrency': 5},
+    }
+
+`rate` is the sustained number of requests per second, `burst` the number of requests that may be made
+at once (defaults to `rate`), and `concurrency` the number of requests that may be in flight at once.
+Limits are shared by all processes through the Django cache `TASKS_RATE_LIMIT_CACHE`, which should be
+a cache with atomic adds and increments (e.g. Redis or Memcached). Each process also keeps a local token bucket
+so that it does not consult the shared cache while it is already over the limit.
+"""
+import math
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Optional, Tuple
+from urllib.parse import urlsplit
+
+from django.core.cache import caches
+from rest_framework.exceptions import Throttled
+
+from cloud_tasks.conf import RATE_LIMITS, RATE_LIMIT_CACHE, RATE_LIMIT_MAX_WAIT
+
+# seconds between attempts to get a concurrency slot
+CONCURRENCY_POLL_INTERVAL = 0.1
+# concurrency slots of crashed processes, or of requests that take longer, are reclaimed after this many seconds
+CONCURRENCY_LEASE_TIMEOUT = 600
+
+
+class RateLimited(Throttled):
+    """
+    The host of a step could not be requested within `TASKS_RATE_LIMIT_MAX_WAIT` seconds.
+    """
+    default_detail = 'Rate limit of the step host reached.'
+
+
+class TokenBucket:
+    """
+    Process-local token bucket.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self) -> float:
+        """
+        Take a token from the bucket.
+
+        :return: 0 if a token was taken, otherwise the number of seconds until one is available
+        """
+        with self.lock:
+            _now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (_now - self.updated) * self.rate)
+            self.updated = _now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """
+        Take a token from the bucket, waiting until one is available.
+        """
+        wait = self.consume()
+        while wait:
+            time.sleep(wait)
+            wait = self.consume()
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def get_origin(url: str) -> str:
+    parts = urlsplit(url)
+    return f'{parts.scheme}://{parts.netloc}'
+
+
+def _local_bucket(origin: str, rate: float, burst: float) -> TokenBucket:
+    with _buckets_lock:
+        if origin not in _buckets:
+            _buckets[origin] = TokenBucket(rate, burst)
+        return _buckets[origin]
+
+
+def _increment(key: str, timeout: float) -> int:
+    cache = caches[RATE_LIMIT_CACHE]
+    cache.add(key, 0, timeout=timeout)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # expired between add and incr
+        cache.add(key, 1, timeout=timeout)
+        return 1
+
+
+def _acquire_slot(origin: str, concurrency: int) -> Optional[Tuple[str, str]]:
+    """
+    Lease one of the `concurrency` slots of `origin`. Each slot is a cache key of its own, held by a single
+    request until it is released or its lease expires, so that a slot of a crashed process is reclaimed without
+    affecting the others.
+
+    :return: the key of the slot and the lease of the holder, or None if all of the slots are taken
+    """
+    cache = caches[RATE_LIMIT_CACHE]
+    keys = [f'cloud_tasks:concurrency:{origin}:{slot}' for slot in range(concurrency)]
+    taken = cache.get_many(keys)
+    lease = uuid.uuid4().hex
+    for key in keys:
+        # add only succeeds if no one else holds the slot
+        if key not in taken and cache.add(key, lease, timeout=CONCURRENCY_LEASE_TIMEOUT):
+            return key, lease
+    return None
+
+
+def _release_slot(slot: Tuple[str, str]):
+    key, lease = slot
+    cache = caches[RATE_LIMIT_CACHE]
+    # a lease that expired may have been taken over by another request
+    if cache.get(key) == lease:
+        cache.delete(key)
+
+
+def _consume_token(origin: str, rate: float, burst: float) -> float:
+    """
+    :return: 0 if a token was taken, otherwise the number of seconds until one may be available
+    """
+    wait = _local_bucket(origin, rate, burst).consume()
+    if wait:
+        return wait
+    # the shared budget allows `burst` requests per window of `burst / rate` seconds, which
+    # averages out to `rate` requests per second
+    window = max(burst / rate, 1)
+    _now = time.time()
+    window_start = math.floor(_now / window) * window
+    if _increment(f'cloud_tasks:rate:{origin}:{window_start}', window * 2) <= burst:
+        return 0
+    return window_start + window - _now
+
+
+@contextmanager
+def host_budget(url: str):
+    """
+    Wait until the rate limit and concurrency budget of the origin of `url` allow a request, and hold
+    a concurrency slot for the duration of the block.
+
+    :param url: url to be requested
+    :raises RateLimited: if the budget does not allow a request within `TASKS_RATE_LIMIT_MAX_WAIT` seconds
+    """
+    origin = get_origin(url)
+    limits = RATE_LIMITS.get(origin)
+    if not limits:
+        yield
+        return
+    rate, concurrency = limits.get('rate'), limits.get('concurrency')
+    burst = limits.get('burst', rate)
+    deadline = time.monotonic() + RATE_LIMIT_MAX_WAIT
+    while True:
+        wait, slot = 0, None
+        if concurrency:
+            slot = _acquire_slot(origin, concurrency)
+        if concurrency and slot is None:
+            wait = CONCURRENCY_POLL_INTERVAL
+        elif rate:
+            wait = _consume_token(origin, rate, burst)
+            if wait and slot:
+                _release_slot(slot)
+        if not wait:
+            break
+        if time.monotonic() + wait > deadline:
+            raise RateLimited(wait=math.ceil(wait))
+        time.sleep(wait)
+    try:
+        yield
+    finally:
+        if slot:
+            _release_slot(slot)
@@ -7,6 +7,7 @@ from cloud_tasks import api
 
 router = routers.DefaultRouter()
 router.register(r'clocks', api.ClockViewSet)
+router.register(r'queues', api.QueueViewSet)
 router.register(r'tasks', api.TaskViewSet)
 router.register(r'steps', api.StepViewSet)
 router.register(r'task_executions', api.TaskExecutionViewSet)
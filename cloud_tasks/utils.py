@@ -21,6 +21,7 @@ SOFTWARE.
 """
 
 import inspect
+from typing import List, Sequence, Tuple
 
 from django.urls.base import reverse
 
@@ -50,3 +51,36 @@ def named_method_params(method, args, kwargs):
 
 def hardcode_reverse(view_name, args=None, kwargs=None):
     return f'{conf.ROOT_URL}{reverse(view_name, args=args, kwargs=kwargs)}'
+
+
+def resolve_json_pointer(document, pointer: str):
+    """
+    Resolve a JSON pointer (RFC 6901, e.g. /data/0/id) against a parsed JSON document.
+
+    :raises LookupError: if the pointer does not resolve to a value
+    """
+    if not pointer:
+        return document
+    if not pointer.startswith('/'):
+        raise LookupError(f'JSON pointer {pointer} must start with "/".')
+    for token in pointer[1:].split('/'):
+        token = token.replace('~1', '/').replace('~0', '~')
+        if isinstance(document, list) and token.isdigit() and int(token) < len(document):
+            document = document[int(token)]
+        elif isinstance(document, dict) and token in document:
+            document = document[token]
+        else:
+            raise LookupError(f'JSON pointer {pointer} does not resolve; no value at {token}.')
+    return document
+
+
+def split_id_ranges(ids: Sequence[int], shards: int) -> List[Tuple[int, int]]:
+    """
+    Split sorted ids into at most `shards` contiguous, inclusive (min_id, max_id) ranges of about the same size.
+    """
+    shards = min(shards, len(ids))
+    if shards < 1:
+        return []
+    lows = [ids[len(ids) * shard // shards] for shard in range(shards)]
+    highs = [low - 1 for low in lows[1:]] + [ids[-1]]
+    return list(zip(lows, highs))